@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmark for the per request cost of opening a storage.
+
+Compares building a new session factory for every storage (the former
+behaviour of :class:`Storage` and `scoped_session`) with the cached
+session factory and the thread scoped session.
+
+Usage::
+
+    python benchmarks/bench_session.py [number]
+"""
+import sys
+import timeit
+from sqlalchemy.orm import sessionmaker
+from tedega_storage.rdbms import get_engine
+from tedega_storage.rdbms.storage import get_session
+
+
+def uncached(engine):
+    session = sessionmaker(bind=engine)()
+    session.close()
+
+
+def cached(engine):
+    session = get_session(engine)
+    session.close()
+
+
+def scoped(engine):
+    session = get_session(engine, "thread")
+    session.close()
+
+
+def main(number=20000):
+    engine = get_engine()
+    for func in (uncached, cached, scoped):
+        seconds = min(timeit.repeat(lambda: func(engine),
+                                    repeat=3, number=number))
+        print("{:10} {:8.2f} us per storage".format(
+            func.__name__, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark for the SQLite profiles.
+
+Measures the throughput of inserts with one commit per item (the write
+latency of a request) and of reads by id for every profile in
+:data:`tedega_storage.rdbms.engine.SQLITE_PROFILES`. Each profile uses
+a new database file in a temporary directory.
+
+Usage::
+
+    python benchmarks/bench_sqlite.py [number]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import sqlalchemy as sa
+from sqlalchemy.orm import declarative_base
+from tedega_storage.rdbms.engine import SQLITE_PROFILES, build_engine
+from tedega_storage.rdbms.storage import Storage
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = "items"
+    id = sa.Column("id", sa.Integer, primary_key=True)
+    name = sa.Column("name", sa.String)
+
+
+def insert(engine, number):
+    ids = []
+    for idx in range(number):
+        with Storage(engine) as storage:
+            item = Item(name="item {}".format(idx))
+            ids.append(storage.create(item))
+    return ids
+
+
+def read(engine, ids):
+    for item_id in ids:
+        with Storage(engine) as storage:
+            storage.read(Item, item_id)
+
+
+def main(number=2000):
+    directory = tempfile.mkdtemp()
+    try:
+        for profile in sorted(SQLITE_PROFILES):
+            uri = "sqlite:///{}".format(
+                os.path.join(directory, "{}.db".format(profile)))
+            engine = build_engine({"uri": uri, "sqlite_profile": profile})
+            Base.metadata.create_all(engine)
+            start = time.time()
+            ids = insert(engine, number)
+            inserted = time.time() - start
+            start = time.time()
+            read(engine, ids)
+            loaded = time.time() - start
+            engine.dispose()
+            print("{:12} {:10.0f} inserts/s {:10.0f} reads/s".format(
+                profile, number / inserted, number / loaded))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmark for the per item cost of serialising items.
+
+Compares inspecting the mapper on every call (the former behaviour of
+:meth:`BaseItem.get_values`) with the cached field metadata and the
+batch serializer :func:`get_values_many`.
+
+Usage::
+
+    python benchmarks/bench_values.py [number of items]
+"""
+import sys
+import timeit
+import sqlalchemy as sa
+from tedega_storage.rdbms import RDBMSStorageBase, BaseItem
+from tedega_storage.rdbms.base import get_values_many
+from tedega_storage.rdbms.mixins import Protocol
+
+
+class Wide(Protocol, BaseItem, RDBMSStorageBase):
+    __tablename__ = "bench_values"
+    name = sa.Column("name", sa.String)
+    description = sa.Column("description", sa.String)
+    count = sa.Column("count", sa.Integer)
+    price = sa.Column("price", sa.Float)
+
+
+def uncached(items, fields):
+    result = []
+    for item in items:
+        values = {}
+        for field in [attr.key for attr in sa.inspect(item).attrs]:
+            if fields is None or field in fields:
+                values[field] = getattr(item, field)
+        result.append(values)
+    return result
+
+
+def cached(items, fields):
+    return [item.get_values(fields) for item in items]
+
+
+def many(items, fields):
+    return get_values_many(items, fields)
+
+
+def main(number=1000):
+    items = []
+    for i in range(number):
+        item = Wide()
+        item.set_values({"id": i, "name": "name", "description": "text",
+                         "count": i, "price": 1.0})
+        items.append(item)
+    for fields in (None, ["id", "name", "count"]):
+        print("fields={}".format(fields))
+        for func in (uncached, cached, many):
+            seconds = min(timeit.repeat(lambda: func(items, fields),
+                                        repeat=7, number=10))
+            print("  {:10} {:8.2f} us per item".format(
+                func.__name__, seconds / 10 / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -10,10 +10,14 @@ with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
 requirements = [
-    'sqlalchemy',
+    'sqlalchemy>=1.4,<2.0',
     # TODO: put package requirements here
 ]
 
+extras = {
+    'asyncio': ['sqlalchemy[asyncio]>=1.4,<2.0', 'aiosqlite'],
+}
+
 test_requirements = [
     # TODO: put package test requirements here
 ]
@@ -29,6 +33,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extras,
     license="MIT license",
     zip_safe=False,
     keywords='tedega_storage',
@@ -1,5 +1,9 @@
-from .storage import (
+from .engine import (
     ENGINE,
+    configure_engine,
+    get_engine
+)
+from .storage import (
     scoped_session
 )
 from .base import (
@@ -8,4 +12,5 @@ from .base import (
 )
 
 __all__ = [ENGINE, RDBMSStorageBase, BaseItem,
+           configure_engine, get_engine,
            get_storage, init_storage, scoped_session]
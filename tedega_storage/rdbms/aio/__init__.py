@@ -0,0 +1,10 @@
+"""Async storage API. Requires the asyncio extension of SQLAlchemy and
+an async driver like aiosqlite or asyncpg."""
+from .storage import (
+    AsyncStorage,
+    get_storage,
+    init_storage,
+    scoped_session
+)
+
+__all__ = [AsyncStorage, get_storage, init_storage, scoped_session]
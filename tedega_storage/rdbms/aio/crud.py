@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Async counterpart of :mod:`tedega_storage.rdbms.crud`. The functions
+take an :class:`AsyncStorage` and behave like the functions of the same
+name in the sync API.
+
+.. warning::
+    This API is an internal API and is **not** meant to be used directly!
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.orm.exc import StaleDataError
+from tedega_view import NotFound
+from tedega_storage.rdbms.base import BaseItem
+from tedega_storage.rdbms.crud import ConflictError
+from tedega_storage.rdbms.indexes import record_search
+from tedega_storage.rdbms.instrumentation import instrumented
+from tedega_storage.rdbms.mixins import Versioned
+from tedega_storage.rdbms.query import (
+    build_page,
+    build_search,
+    parse_include
+)
+
+
+async def _check_version(storage, clazz, instance, expected_version):
+    """Async counterpart of
+    :func:`tedega_storage.rdbms.crud._check_version`."""
+    if expected_version is None or instance.version == expected_version:
+        return
+    try:
+        await storage.session.refresh(instance)
+    except sa.exc.InvalidRequestError:
+        raise NotFound()
+    if instance.version != expected_version:
+        raise ConflictError("{} {} has version {} instead of {}".format(
+            clazz.__name__, instance.id, instance.version, expected_version))
+
+
+@instrumented
+async def search(storage, clazz, limit=20, offset=0, search="", sort="",
+                 cursor=None, include=None):
+    """Will return all instances of `clazz`.
+
+    .. seealso::
+
+        :func:`tedega_storage.rdbms.crud.search`
+
+    :storage: Async session to the database.
+    :clazz: Class of which the instances should be loaded.
+    :limit: Limit number of result to N entries
+    :offset: Return entries with an offset of N
+    :sort: Define sort and ordering
+    :cursor: Continuation token for keyset pagination
+    :include: Define relations which should be loaded
+    :returns: List of instances of clazz
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
+    options = parse_include(clazz, include)
+    statement, params, keys = build_search(clazz, limit, offset, search,
+                                           sort, cursor)
+    record_search(clazz, search, sort)
+    if options:
+        statement = statement.options(*options)
+    result = await storage.session.execute(statement, params)
+    items = result.scalars().all()
+    if cursor is None:
+        return items
+    return build_page(items, limit, sort, keys)
+
+
+@instrumented
+async def create(storage, clazz, values):
+    """Will return a new instance of `clazz` initiated with the given
+    `values`.
+
+    .. seealso::
+
+        :func:`tedega_storage.rdbms.crud.create`
+
+    :storage: Async session to the database.
+    :clazz: Class of which an instance should be created.
+    :values: Dictionary of values used for initialisation.
+    :returns: Instance of clazz
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(values, dict):
+        raise TypeError("Create must be called with a values of type {}".format(dict))
+    factory = clazz.get_factory(storage)
+    try:
+        instance = factory.create(**values)
+    except TypeError as e:
+        raise TypeError("{}.{}".format(factory.__class__.__name__, e))
+
+    await storage.create(instance)
+    return instance
+
+
+@instrumented
+async def read(storage, clazz, item_id, include=None):
+    """Will return a instance of `clazz`.
+
+    .. seealso::
+
+        :func:`tedega_storage.rdbms.crud.read`
+
+    :storage: Async session to the database.
+    :clazz: Class of which an instance should be loaded.
+    :item_id: ID of the item which should be loaded.
+    :include: Define relations which should be loaded
+    :returns: Instance of clazz
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(item_id, int):
+        raise TypeError("item_id must be called with a value of type {}".format(int))
+    options = parse_include(clazz, include)
+    factory = clazz.get_factory(storage)
+    try:
+        if options:
+            instance = await factory.load(item_id, options)
+        else:
+            instance = await factory.load(item_id)
+    except sa.orm.exc.NoResultFound:
+        raise NotFound()
+    return instance
+
+
+@instrumented
+async def update(storage, clazz, item_id, values, return_changes=False,
+                 expected_version=None):
+    """Will update a instance of `clazz` with the given values.
+
+    .. seealso::
+
+        :func:`tedega_storage.rdbms.crud.update`
+
+    :storage: Async session to the database.
+    :clazz: Class of which an instance should be loaded.
+    :item_id: ID of the item which should be loaded.
+    :values: Dictionary of values used for initialisation.
+    :return_changes: If True the names of the changed fields are
+        returned as well.
+    :expected_version: Version of the item the changes are based on.
+    :returns: Instance of clazz or tuple of the instance and the list
+        of changed fields
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(item_id, int):
+        raise TypeError("item_id must be called with a value of type {}".format(int))
+    if not isinstance(values, dict):
+        raise TypeError("Create must be called with a values of type {}".format(dict))
+    if expected_version is not None and not issubclass(clazz, Versioned):
+        raise TypeError("expected_version requires a clazz of type {}".format(Versioned))
+    factory = clazz.get_factory(storage)
+    try:
+        instance = await factory.load(item_id)
+    except sa.orm.exc.NoResultFound:
+        raise NotFound()
+    await _check_version(storage, clazz, instance, expected_version)
+    if issubclass(clazz, Versioned) and "version" in values:
+        values = dict(values)
+        del values["version"]
+    changed = instance.set_values(values)
+    if changed:
+        try:
+            await storage.update(instance)
+        except StaleDataError:
+            raise ConflictError("{} {} was changed concurrently".format(
+                clazz.__name__, item_id))
+    if return_changes:
+        return instance, changed
+    return instance
+
+
+@instrumented
+async def delete(storage, clazz, item_id, expected_version=None):
+    """Will delete a instance of `clazz`.
+
+    .. seealso::
+
+        :func:`tedega_storage.rdbms.crud.delete`
+
+    :storage: Async session to the database.
+    :clazz: Class of which an instance should be loaded.
+    :item_id: ID of the item which should be loaded.
+    :expected_version: Version of the item the deletion is based on.
+    """
+    if expected_version is not None and not issubclass(clazz, Versioned):
+        raise TypeError("expected_version requires a clazz of type {}".format(Versioned))
+    factory = clazz.get_factory(storage)
+    try:
+        instance = await factory.load(item_id)
+    except sa.orm.exc.NoResultFound:
+        raise NotFound()
+    await _check_version(storage, clazz, instance, expected_version)
+    await storage.delete(instance)
+    if expected_version is not None:
+        try:
+            await storage.session.flush()
+        except StaleDataError:
+            raise ConflictError("{} {} was changed concurrently".format(
+                clazz.__name__, item_id))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Async counterpart of :mod:`tedega_storage.rdbms.storage` built on
+the asyncio extension of SQLAlchemy."""
+import threading
+import weakref
+from contextlib import asynccontextmanager
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
+from tedega_storage.rdbms.base import RDBMSStorageBase
+from tedega_storage.rdbms.engine import DEFAULT_ENGINE, get_async_engine
+from tedega_storage.rdbms.storage import TRANSACTIONS
+
+SESSIONMAKERS = weakref.WeakKeyDictionary()
+"""Cached async session factories by engine."""
+_lock = threading.Lock()
+
+
+def get_sessionmaker(engine):
+    """Returns the async session factory for the given `engine`. The
+    factory is only created once per engine. Loaded items are not
+    expired on commit as reloading them implicitly is not possible
+    with asyncio.
+
+    :engine: Async engine the sessions are bound to.
+    :returns: Session factory
+    """
+    factory = SESSIONMAKERS.get(engine.sync_engine)
+    if factory is None:
+        with _lock:
+            factory = SESSIONMAKERS.get(engine.sync_engine)
+            if factory is None:
+                factory = sessionmaker(bind=engine, class_=AsyncSession,
+                                       expire_on_commit=False)
+                SESSIONMAKERS[engine.sync_engine] = factory
+    return factory
+
+
+@asynccontextmanager
+async def scoped_session(name=DEFAULT_ENGINE):
+    session = get_sessionmaker(get_async_engine(name))()
+    try:
+        yield session
+        await session.commit()
+    except BaseException:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+class AsyncStorage(object):
+    """Async storage. Use it as async context manager to commit the
+    session on exit or rollback on errors."""
+
+    def __init__(self, engine, transaction="savepoint"):
+        """
+        :engine: Async engine the session is bound to.
+        :transaction: Transaction strategy for writes. See
+            :data:`tedega_storage.rdbms.storage.TRANSACTIONS`.
+        """
+        if transaction not in TRANSACTIONS:
+            raise ValueError("Unsupported transaction strategy {}".format(
+                transaction))
+        self.engine = engine
+        self.transaction = transaction
+        self.session = get_sessionmaker(engine)()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, e_type, e_value, tb):
+        try:
+            if e_type is not None:
+                await self.session.rollback()
+            else:
+                await self.session.commit()
+        finally:
+            await self.session.close()
+        return False
+
+    async def create(self, item):
+        if self.transaction == "deferred":
+            self.session.add(item)
+            return item.id
+        if self.transaction == "flush":
+            self.session.add(item)
+            await self.session.flush()
+            return item.id
+        transaction = await self.session.begin_nested()
+        try:
+            self.session.add(item)
+            await transaction.commit()
+            item_id = item.id
+        except BaseException:
+            await transaction.rollback()
+            raise
+        return item_id
+
+    async def read(self, clazz, id=None, options=None):
+        if id is None:
+            result = await self.session.execute(sa.select(clazz))
+            return result.scalars().all()
+        if options:
+            result = await self.session.execute(
+                sa.select(clazz).where(clazz.id == id).options(*options))
+            item = result.unique().scalar_one_or_none()
+            if item is None:
+                raise NoResultFound()
+            return item
+        item = await self.session.get(clazz, id)
+        if item is None:
+            raise NoResultFound()
+        return item
+
+    async def update(self, item):
+        if (self.transaction == "deferred" or
+                not self.session.is_modified(item)):
+            return None
+        return await self.session.flush()
+
+    async def delete(self, item):
+        await self.session.delete(item)
+
+
+def get_storage(name=DEFAULT_ENGINE, transaction="savepoint"):
+    return AsyncStorage(get_async_engine(name), transaction)
+
+
+async def init_storage(name=DEFAULT_ENGINE):
+    async with get_async_engine(name).begin() as connection:
+        await connection.run_sync(RDBMSStorageBase.metadata.create_all)
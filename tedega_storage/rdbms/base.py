@@ -3,20 +3,120 @@
 import uuid
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
-from tedega_storage.rdbms.storage import ENGINE, STORAGE
+from tedega_storage.rdbms.engine import DEFAULT_ENGINE, get_engine
+from tedega_storage.rdbms.storage import STORAGE
 from tedega_storage.rdbms.datatypes import UUID
+from tedega_storage.rdbms.indexes import create_indexes
+from tedega_storage.rdbms.query import coerce_value
 
 
-def get_storage():
-    return STORAGE(ENGINE)
+def get_storage(name=DEFAULT_ENGINE, scope=None, cache=None,
+                transaction="savepoint", detector=None):
+    return STORAGE(get_engine(name), scope, cache, transaction, detector)
 
 
-def init_storage():
-    RDBMSStorageBase.metadata.create_all(ENGINE)
+def init_storage(name=DEFAULT_ENGINE):
+    engine = get_engine(name)
+    RDBMSStorageBase.metadata.create_all(engine)
+    # Indexes of existing tables are not created by create_all.
+    create_indexes(RDBMSStorageBase, engine)
 
 
 RDBMSStorageBase = declarative_base()
 
+FIELDS = {}
+"""Cached field metadata by class. See :func:`get_fields`."""
+COLUMNS = {}
+"""Cached column attributes by class. See :func:`get_columns`."""
+
+
+def get_fields(clazz):
+    """Returns the names of all mapped attributes of `clazz` as tuple
+    and as frozenset. The result is computed once per class.
+
+    :clazz: Mapped class.
+    :returns: Tuple of (tuple of fieldnames, frozenset of fieldnames)
+    """
+    fields = FIELDS.get(clazz)
+    if fields is None:
+        names = tuple(attr.key for attr in sa.inspect(clazz).attrs)
+        fields = FIELDS[clazz] = (names, frozenset(names))
+    return fields
+
+
+@sa.event.listens_for(sa.orm.Mapper, "after_configured")
+def reset_fields():
+    """Listen for the 'after_configured' event. Make sure that the
+    cached fields include attributes added by newly configured mappers
+    e.g backrefs."""
+    FIELDS.clear()
+    COLUMNS.clear()
+
+
+def get_columns(clazz):
+    """Returns a dictionary of the mapped column attributes of `clazz`
+    by name. The result is computed once per class.
+
+    :clazz: Mapped class.
+    :returns: Dictionary of fieldnames and column attributes.
+    """
+    columns = COLUMNS.get(clazz)
+    if columns is None:
+        columns = COLUMNS[clazz] = dict(
+            (prop.key, getattr(clazz, prop.key))
+            for prop in sa.inspect(clazz).column_attrs)
+    return columns
+
+
+def _same_value(column, current, value):
+    """Returns True if `value` equals the `current` value of `column`.
+    Strings are converted into the python type of the column before they
+    are compared."""
+    if column is not None and isinstance(value, str):
+        try:
+            value = coerce_value(column, value)
+        except (ValueError, TypeError, ArithmeticError):
+            return False
+    return current == value
+
+
+def _get_values(item, names):
+    """Returns the values of the given fields of `item`. Loaded values
+    are taken from the instance dictionary directly. Only the remaining
+    fields (e.g expired or lazy loaded) go through the attribute."""
+    state = item.__dict__
+    values = {}
+    for name in names:
+        if name in state:
+            values[name] = state[name]
+        else:
+            values[name] = getattr(item, name)
+    return values
+
+
+def get_values_many(items, fields=None):
+    """Returns the values of all `items` as list of dictionaries. The
+    fields of each class are only looked up once.
+
+    :items: List of :class:`BaseItem` objects.
+    :fields: List of fieldnames which should be included.
+    :returns: List of dictionaries of values.
+    """
+    if fields is not None:
+        fields = frozenset(fields)
+    names_by_class = {}
+    result = []
+    for item in items:
+        clazz = type(item)
+        names = names_by_class.get(clazz)
+        if names is None:
+            names = get_fields(clazz)[0]
+            if fields is not None:
+                names = tuple(name for name in names if name in fields)
+            names_by_class[clazz] = names
+        result.append(_get_values(item, names))
+    return result
+
 
 class BaseFactory(object):
 
@@ -33,12 +133,20 @@ class BaseFactory(object):
         """
         return self.clazz()
 
-    def load(self, item_id):
+    def load(self, item_id, options=None):
         """Will create a new :class:`Base` object.
+        :options: Optional list of loader options.
+        :returns: :class:`Base` object.
+
+        """
+        return self.storage.read(self.clazz, item_id, options)
+
+    def load_by_uuid(self, item_uuid):
+        """Will load the :class:`Base` object with the given uuid.
         :returns: :class:`Base` object.
 
         """
-        return self.storage.read(self.clazz, item_id)
+        return self.storage.read_by_uuid(self.clazz, item_uuid)
 
 
 class BaseItem(object):
@@ -71,28 +179,39 @@ class BaseItem(object):
 
     @property
     def fields(self):
-        mapper = sa.inspect(self)
-        return [column.key for column in mapper.attrs]
+        return get_fields(type(self))[0]
 
     def get_values(self, fields=None):
         """Returns the values of the item as a dictionary.
         :fields: List of fieldnames which should be included.
         :returns: Dictionary of values of the item.
         """
-        values = {}
-        for field in self.fields:
-            if fields is None or field in fields:
-                values[field] = getattr(self, field)
-        return values
+        if fields is None:
+            return _get_values(self, self.fields)
+        fields = frozenset(fields)
+        return _get_values(self, [field for field in self.fields
+                                  if field in fields])
 
     def set_values(self, values):
         """Will set values of the item based on the given dictionary. If
         the dictionary contains values which are not part of the item
-        (within self.fields) the value will be silently ignored.
+        (within self.fields) the value will be silently ignored. Values
+        which equal the loaded values of the item are not set, so the
+        item is not marked as modified by them.
 
         :values: Dictionary of values.
+        :returns: List of the names of the changed fields.
         """
+        state = self.__dict__
+        columns = get_columns(type(self))
+        changed = []
         for field in self.fields:
             value = values.get(field)
-            if value is not None:
-                setattr(self, field, value)
+            if value is None:
+                continue
+            if field in state and _same_value(columns.get(field),
+                                              state[field], value):
+                continue
+            setattr(self, field, value)
+            changed.append(field)
+        return changed
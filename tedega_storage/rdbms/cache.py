@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Second level cache for items loaded by their id.
+
+The cache is disabled by default. It is enabled for all storages with
+:func:`configure_cache` or for a single storage by passing an
+:class:`IdentityCache` to :class:`Storage`. Cached are only the values
+of the columns of an item, keyed by class and id. On a hit a new item
+is built from these values and added to the session of the storage
+without querying the database.
+
+Entries are invalidated by `crud.update` and `crud.delete`, by the bulk
+and set based operations of :class:`Storage` and whenever the ORM
+flushes an UPDATE or DELETE of a cached item. Items are only stored
+after the commit of a transaction which did not write, so values which
+are rolled back never get into the cache. Values read before the item
+was invalidated by another transaction are not stored either.
+"""
+import itertools
+import threading
+import time
+import weakref
+from collections import OrderedDict
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+_clock = getattr(time, "monotonic", time.time)
+
+
+class CacheBackend(object):
+    """Interface for the backends of the cache. The backend counts the
+    hits, misses and evictions in the attributes of the same name."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the value stored for `key` or None."""
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        """Will store `value` for `key`."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Will remove the value stored for `key` if there is one."""
+        raise NotImplementedError()
+
+    def clear(self):
+        """Will remove all values."""
+        raise NotImplementedError()
+
+    def stats(self):
+        """Returns a dictionary with the counters of the backend."""
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class LRUBackend(CacheBackend):
+    """In-process backend which keeps at most `maxsize` values. The
+    least recently used value is evicted first. If `ttl` is given values
+    are evicted after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        super(LRUBackend, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires < _clock():
+                del self._data[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._data.pop(key)
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else _clock() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+PENDING = "tedega_storage_cache_pending"
+"""Key of the values to store on commit in the info of a session."""
+WRITTEN = "tedega_storage_cache_written"
+"""Key of the flag in the info of a session which is set once the
+transaction of the session writes."""
+
+INVALIDATIONS = 10000
+"""Number of invalidated keys an :class:`IdentityCache` remembers to
+discard values which were read before the invalidation."""
+
+_sequence = itertools.count(1)
+"""Counter which orders reads and invalidations of all caches."""
+_caches = weakref.WeakSet()
+"""All instances of :class:`IdentityCache` for the invalidation on
+flush."""
+
+
+class IdentityCache(object):
+    """Read-through cache for items keyed by (class, id).
+
+    :backend: :class:`CacheBackend` which stores the values. Defaults
+        to a :class:`LRUBackend`.
+    :classes: Optional list of classes which should be cached. If not
+        given all classes are cached.
+    """
+
+    def __init__(self, backend=None, classes=None):
+        self.backend = backend if backend is not None else LRUBackend()
+        self.classes = None if classes is None else frozenset(classes)
+        self.generations = {}
+        self.invalidations = OrderedDict()
+        """Sequence number of the last invalidation by key."""
+        self.floor = 0
+        """Sequence number of the last forgotten invalidation."""
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def _key(self, key):
+        """Returns the key in the backend for the given identity key.
+        The key includes the generation of the class, so all items of a
+        class are invalidated by incrementing it."""
+        return (self.generations.get(key[0], 0),) + tuple(key)
+
+    def caches(self, clazz):
+        """Returns True if items of `clazz` are cached."""
+        return self.classes is None or clazz in self.classes
+
+    def get(self, session, clazz, item_id):
+        """Returns the item of `clazz` with the given `item_id`. An item
+        which is already loaded in `session` is returned as it is. Else
+        the item is built from the cached values and added to `session`.
+
+        :session: Session of the storage.
+        :clazz: Class of the item.
+        :item_id: ID of the item.
+        :returns: Instance of clazz or None if the item is not cached.
+        """
+        key = identity_key(clazz, item_id)
+        item = session.identity_map.get(key)
+        if item is not None:
+            return item
+        values = self.backend.get(self._key(key))
+        if values is None:
+            return None
+        item = sa.inspect(clazz).class_manager.new_instance()
+        for field, value in values.items():
+            set_committed_value(item, field, value)
+        make_transient_to_detached(item)
+        session.add(item)
+        return item
+
+    def set(self, item):
+        """Will store the values of the columns of `item`. Items with
+        pending changes are not stored. The values of an item in a
+        session are stored once the transaction of the session commits,
+        and only if the transaction did not write and the item was not
+        invalidated in the meantime. Values read within a transaction
+        which writes may never be committed.
+
+        :item: Persistent instance of a cached class.
+        """
+        state = sa.inspect(item)
+        if state.modified or state.key is None:
+            return
+        session = state.session
+        if session is not None and session.info.get(WRITTEN):
+            return
+        values = dict((prop.key, state.dict.get(prop.key))
+                      for prop in state.mapper.column_attrs)
+        key = self._key(state.key)
+        if session is None:
+            self.backend.set(key, values)
+        else:
+            session.info.setdefault(PENDING, []).append(
+                (self, key, values, next(_sequence)))
+
+    def store(self, key, values, sequence):
+        """Will store the `values` read at `sequence` for the `key` of
+        the backend unless the key was invalidated since then."""
+        with self._lock:
+            if self.invalidations.get(key, self.floor) < sequence:
+                self.backend.set(key, values)
+
+    def invalidate(self, clazz, item_id):
+        """Will remove the item of `clazz` with `item_id` from the cache.
+        """
+        self.invalidate_key(identity_key(clazz, item_id))
+
+    def invalidate_key(self, key):
+        """Will remove the item with the identity `key` from the cache.
+        Values of the item which were read before are not stored
+        anymore."""
+        key = self._key(key)
+        with self._lock:
+            self.invalidations.pop(key, None)
+            self.invalidations[key] = next(_sequence)
+            while len(self.invalidations) > INVALIDATIONS:
+                _, self.floor = self.invalidations.popitem(last=False)
+            self.backend.delete(key)
+
+    def invalidate_class(self, clazz):
+        """Will remove all items of `clazz` from the cache. The entries
+        are not removed from the backend but can not be found anymore
+        and are evicted over time."""
+        mapper = sa.inspect(clazz)
+        key = mapper.identity_key_from_primary_key(
+            [None] * len(mapper.primary_key))[0]
+        self.generations[key] = self.generations.get(key, 0) + 1
+
+    def clear(self):
+        """Will remove all items from the cache."""
+        with self._lock:
+            self.invalidations.clear()
+            self.floor = next(_sequence)
+            self.backend.clear()
+
+    def stats(self):
+        """Returns a dictionary with the hit, miss and eviction counters
+        of the backend."""
+        return self.backend.stats()
+
+
+CACHE = None
+"""Cache used by storages which are created without an explicit
+cache."""
+
+
+def configure_cache(backend=None, classes=None):
+    """Will enable the cache for all storages created afterwards.
+
+    :backend: :class:`CacheBackend` which stores the values. Defaults
+        to a :class:`LRUBackend`.
+    :classes: Optional list of classes which should be cached.
+    :returns: :class:`IdentityCache`
+    """
+    global CACHE
+    CACHE = IdentityCache(backend, classes)
+    return CACHE
+
+
+def disable_cache():
+    """Will disable the cache for all storages created afterwards."""
+    global CACHE
+    CACHE = None
+
+
+def get_cache():
+    """Returns the configured :class:`IdentityCache` or None."""
+    return CACHE
+
+
+@event.listens_for(sa.orm.Mapper, "after_update")
+@event.listens_for(sa.orm.Mapper, "after_delete")
+def invalidate_on_flush(mapper, connection, target):
+    """Listen for the 'after_update' and 'after_delete' events and
+    remove the changed item from all caches."""
+    if len(_caches) == 0:
+        return
+    key = sa.inspect(target).key
+    if key is None:
+        return
+    for cache in list(_caches):
+        cache.invalidate_key(key)
+
+
+@event.listens_for(sa.orm.Session, "after_flush")
+def written_on_flush(session, flush_context):
+    """Listen for the 'after_flush' event and mark the transaction of
+    `session` as writing."""
+    if len(_caches) != 0:
+        session.info[WRITTEN] = True
+
+
+@event.listens_for(sa.orm.Session, "do_orm_execute")
+def written_on_execute(orm_execute_state):
+    """Listen for the 'do_orm_execute' event and mark the transaction
+    of the session as writing for all statements but SELECT."""
+    if len(_caches) != 0 and not orm_execute_state.is_select:
+        orm_execute_state.session.info[WRITTEN] = True
+
+
+@event.listens_for(sa.orm.Session, "after_commit")
+def store_on_commit(session):
+    """Listen for the 'after_commit' event and store the values of the
+    items read by the committed transaction if it did not write and the
+    items were not invalidated after they were read."""
+    if session.in_nested_transaction():
+        return
+    pending = session.info.pop(PENDING, None)
+    if pending and not session.info.get(WRITTEN):
+        for cache, key, values, sequence in pending:
+            cache.store(key, values, sequence)
+
+
+@event.listens_for(sa.orm.Session, "after_transaction_end")
+def discard_on_end(session, transaction):
+    """Listen for the 'after_transaction_end' event and forget the
+    values and the flag of the ended transaction, e.g on rollback."""
+    if transaction.parent is None:
+        session.info.pop(PENDING, None)
+        session.info.pop(WRITTEN, None)
@@ -12,53 +12,181 @@ and writing to the database.
     This API is an internal API and is **not** meant to be used directly!
 
 """
+from datetime import datetime
+import uuid
 import sqlalchemy as sa
-from tedega_view import NotFound, ClientError
+from sqlalchemy.orm.exc import StaleDataError
+from tedega_view import ClientError, NotFound
 from tedega_storage.rdbms.base import BaseItem
+from tedega_storage.rdbms.indexes import record_search
+from tedega_storage.rdbms.instrumentation import instrumented
+from tedega_storage.rdbms.mixins import Versioned
+from tedega_storage.rdbms.query import (
+    COUNTS,
+    Page,
+    build_count,
+    build_page,
+    build_search,
+    parse_include,
+    parse_search,
+    split_fields
+)
+from tedega_storage.rdbms.storage import BULK_CHUNK_SIZE, STREAM_BATCH_SIZE
+
+
+class ConflictError(ClientError):
+    """Raised if an item of a :class:`mixins.Versioned` class was
+    changed or deleted by someone else since the expected version was
+    read. The client should read the item again and retry."""
+
+
+def _check_version(storage, clazz, instance, expected_version):
+    """Will raise a :class:`ConflictError` if `instance` does not have
+    the `expected_version`. A loaded instance which does not match is
+    refreshed first, as it may have been loaded before the version was
+    read by the client."""
+    if expected_version is None or instance.version == expected_version:
+        return
+    try:
+        storage.session.refresh(instance)
+    except sa.exc.InvalidRequestError:
+        raise NotFound()
+    if instance.version != expected_version:
+        raise ConflictError("{} {} has version {} instead of {}".format(
+            clazz.__name__, instance.id, instance.version, expected_version))
 
 
-def search(storage, clazz, limit=20, offset=0, search="", sort=""):
+@instrumented
+def search(storage, clazz, limit=20, offset=0, search="", sort="",
+           cursor=None, fields=None, total=None, include=None):
     """Will return all instances of `clazz`.
 
+    If `cursor` is given the items are paged by keyset instead of
+    offset: `offset` is ignored and the next page is selected with a
+    ``WHERE (sort keys, id) > (values of the last item)`` condition, so
+    every page costs the same independent of its position. Pass an empty
+    string to get the first page and the `cursor` attribute of the
+    returned :class:`query.Page` to get the next one. The `id` is always
+    added as last sort key to make the order unique. Sort keys must not
+    contain NULL values in this mode.
+
+    If `fields` is given only the columns of these fields are selected
+    and dictionaries with the values of the fields are returned instead
+    of instances of `clazz`.
+
+    If `total` is given a :class:`query.Page` is returned which has the
+    number of all items matching the search in its `total` attribute.
+    See :func:`count` for the supported modes.
+
+    If `include` is given the named relations are loaded for all items
+    of the page with a constant number of queries instead of one query
+    per item on first access. It can not be combined with `fields`.
+
     :storage: Session to the database.
     :clazz: Class of which the instances should be loaded.
     :limit: Limit number of result to N entries
     :offset: Return entries with an offset of N
+    :search: Define search filters. See :mod:`query` for the syntax
     :sort: Define sort and ordering
+    :cursor: Continuation token for keyset pagination
+    :fields: List of fieldnames which should be returned
+    :total: Mode to count all matching items ("exact" or "estimate")
+    :include: Define relations which should be loaded
     :returns: List of instances of clazz
     """
     if not issubclass(clazz, BaseItem):
         raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
 
-    query = storage.session.query(clazz)
+    fields = split_fields(fields)
+    options = parse_include(clazz, include)
+    if options and fields is not None:
+        raise ClientError("Relations can not be included with fields")
+    statement, params, keys = build_search(clazz, limit, offset, search,
+                                           sort, cursor, fields)
+    record_search(clazz, search, sort)
+    if options:
+        statement = statement.options(*options)
+    result = storage.session.execute(statement, params)
+    if fields is None:
+        items = result.scalars().all()
+    else:
+        items = result.all()
+    if cursor is not None:
+        items = build_page(items, limit, sort, keys)
+    if total is not None:
+        if not isinstance(items, Page):
+            items = Page(items)
+        items.total = count(storage, clazz, search, total)
+    if fields is not None:
+        items[:] = [dict((key, getattr(row, key)) for key in fields)
+                    for row in items]
+    return items
+
+
+@instrumented
+def count(storage, clazz, search="", mode="exact"):
+    """Will return the number of instances of `clazz` matching the given
+    `search` filter.
+
+    In "exact" mode the items are counted within the current
+    transaction. In "estimate" mode the row estimate from the table
+    statistics is used on PostgreSQL if there is no search filter.
+    Otherwise the exact count is cached per database for
+    :data:`query.COUNT_TTL` seconds.
 
-    # Handle search filters.
-    if search != "":
-        try:
-            for _filter in search.split("|"):
-                key, value = _filter.split("::")
-                query = query.filter(getattr(clazz, key) == value)
-        except ValueError:
-            raise ClientError("Can not parse search filter")
-        except AttributeError:
-            # Key in search filter is not existing
-            raise ClientError("One of the fields in search filter is invalid")
-
-    # Handle sort and ordering.
-    if sort != "":
-        try:
-            for key in sort.split("|"):
-                if key.startswith("-"):
-                    query = query.order_by(sa.desc(getattr(clazz, key.strip("-"))))
-                else:
-                    query = query.order_by(getattr(clazz, key.strip("+")))
-        except AttributeError:
-            # Key in search filter is not existing
-            raise ClientError("One of the fields in sort definition is invalid")
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be counted.
+    :search: Define search filters
+    :mode: "exact" or "estimate"
+    :returns: Number of items
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Count must be called with a clazz of type {}".format(BaseItem))
+    if mode not in ("exact", "estimate"):
+        raise ValueError("Unknown count mode {}".format(mode))
+    statement, params = build_count(clazz, search)
+    if mode == "exact":
+        return storage.session.execute(statement, params).scalar()
+
+    bind = storage.session.get_bind(clazz, clause=statement)
+    if search == "" and bind.dialect.name == "postgresql":
+        estimate = storage.session.execute(
+            sa.text("SELECT reltuples FROM pg_class "
+                    "WHERE oid = CAST(:table AS regclass)"),
+            {"table": clazz.__table__.fullname}).scalar()
+        # Tables which were never analyzed report -1 or 0.
+        if estimate is not None and estimate > 0:
+            return int(estimate)
+    # Counts of different databases must not be mixed.
+    key = (bind.url, clazz, search)
+    total = COUNTS.get(key)
+    if total is None:
+        total = storage.session.execute(statement, params).scalar()
+        COUNTS.set(key, total)
+    return total
+
+
+def stream(storage, clazz, search="", sort="", batch_size=STREAM_BATCH_SIZE):
+    """Will yield all instances of `clazz` matching the given `search`
+    filter in the order defined by `sort`. Unlike :func:`search` the
+    items are not loaded at once but fetched in batches of `batch_size`
+    rows, so memory stays bounded independent of the size of the result.
 
-    return query.slice(offset, limit).all()
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be loaded.
+    :search: Define search filters
+    :sort: Define sort and ordering
+    :batch_size: Number of rows fetched at once
+    :returns: Generator of instances of clazz
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
+    statement, params, keys = build_search(clazz, None, 0, search, sort, None)
+    record_search(clazz, search, sort)
+    return storage.stream(clazz, batch_size, statement, params)
 
 
+@instrumented
 def create(storage, clazz, values):
     """Will return a new instance of `clazz`. The new instance will be
     added to the given `storage` session and is initiated with the given
@@ -91,9 +219,11 @@ def create(storage, clazz, values):
     return instance
 
 
-def read(storage, clazz, item_id):
+@instrumented
+def read(storage, clazz, item_id, include=None):
     """Will return a instance of `clazz`. The instance is read from the
-    given `storage` session.
+    given `storage` session. Relations given in `include` are loaded
+    together with the instance (see :func:`search`).
 
     .. seealso::
 
@@ -106,6 +236,7 @@ def read(storage, clazz, item_id):
     :storage: Session to the database.
     :clazz: Class of which an instance should be loaded.
     :item_id: ID of the item which should be loaded.
+    :include: Define relations which should be loaded
     :returns: Instance of clazz
 
     """
@@ -113,18 +244,97 @@ def read(storage, clazz, item_id):
         raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
     if not isinstance(item_id, int):
         raise TypeError("item_id must be called with a value of type {}".format(int))
+    options = parse_include(clazz, include)
     factory = clazz.get_factory(storage)
     try:
-        instance = factory.load(item_id)
+        if options:
+            instance = factory.load(item_id, options)
+        else:
+            instance = factory.load(item_id)
+    except sa.orm.exc.NoResultFound:
+        raise NotFound()
+    return instance
+
+
+@instrumented
+def read_by_uuid(storage, clazz, item_uuid):
+    """Will return the instance of `clazz` with the given `item_uuid`.
+    The instance is read with the unique index on the uuid column.
+
+    .. seealso::
+
+        `load_by_uuid` method of the specific factory of `clazz`
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+    `item_uuid` must be of type :class:`uuid.UUID` or a string with a
+    valid UUID. If not a TypeError will be raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which an instance should be loaded.
+    :item_uuid: UUID of the item which should be loaded.
+    :returns: Instance of clazz
+
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Read must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(item_uuid, uuid.UUID):
+        try:
+            item_uuid = uuid.UUID(item_uuid)
+        except (TypeError, ValueError, AttributeError):
+            raise TypeError("item_uuid must be called with a value of type {}".format(uuid.UUID))
+    factory = clazz.get_factory(storage)
+    try:
+        instance = factory.load_by_uuid(item_uuid)
     except sa.orm.exc.NoResultFound:
         raise NotFound()
     return instance
 
 
-def update(storage, clazz, item_id, values):
+@instrumented
+def read_many(storage, clazz, item_ids):
+    """Will return the instances of `clazz` with the given `item_ids` in
+    the same order. Instances which are not already loaded are read
+    with one query.
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+    `item_ids` must be a list of integers. If not a TypeError will be
+    raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be loaded.
+    :item_ids: List of IDs of the items which should be loaded.
+    :returns: List of instances of clazz
+
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Read must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(item_ids, list):
+        raise TypeError("item_ids must be called with a value of type {}".format(list))
+    for item_id in item_ids:
+        if not isinstance(item_id, int):
+            raise TypeError("item_id must be called with a value of type {}".format(int))
+    try:
+        return storage.read_many(clazz, item_ids)
+    except sa.orm.exc.NoResultFound:
+        raise NotFound()
+
+
+@instrumented
+def update(storage, clazz, item_id, values, return_changes=False,
+           expected_version=None):
     """Will update a instance of `clazz`. The instance is read from the
     given `storage` session and then updated with the given values. Values
     for attributes which are not part of `clazz` are silently ignored.
+    Values which equal the current values of the instance are ignored as
+    well. If nothing changed no SQL is emitted.
+
+    If `clazz` is :class:`mixins.Versioned` the `expected_version` can
+    be given. A :class:`ConflictError` is raised if the item has another
+    version or is changed by another transaction before the update is
+    flushed. In the latter case the transaction of the `storage` is
+    rolled back. The `version` itself can not be set with `values`.
 
     .. seealso::
 
@@ -141,7 +351,11 @@ def update(storage, clazz, item_id, values):
     :clazz: Class of which an instance should be loaded.
     :item_id: ID of the item which should be loaded.
     :values: Dictionary of values used for initialisation.
-    :returns: Instance of clazz
+    :return_changes: If True the names of the changed fields are
+        returned as well.
+    :expected_version: Version of the item the changes are based on.
+    :returns: Instance of clazz or tuple of the instance and the list
+        of changed fields
     """
     if not issubclass(clazz, BaseItem):
         raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
@@ -149,20 +363,43 @@ def update(storage, clazz, item_id, values):
         raise TypeError("item_id must be called with a value of type {}".format(int))
     if not isinstance(values, dict):
         raise TypeError("Create must be called with a values of type {}".format(dict))
+    if expected_version is not None and not issubclass(clazz, Versioned):
+        raise TypeError("expected_version requires a clazz of type {}".format(Versioned))
+    # The changes must be based on the current values.
+    storage.use_primary()
     factory = clazz.get_factory(storage)
     try:
         instance = factory.load(item_id)
     except sa.orm.exc.NoResultFound:
         raise NotFound()
-    instance.set_values(values)
-    storage.update(instance)
+    _check_version(storage, clazz, instance, expected_version)
+    if issubclass(clazz, Versioned) and "version" in values:
+        values = dict(values)
+        del values["version"]
+    changed = instance.set_values(values)
+    if changed:
+        try:
+            storage.update(instance)
+        except StaleDataError:
+            raise ConflictError("{} {} was changed concurrently".format(
+                clazz.__name__, item_id))
+        if storage.cache is not None:
+            storage.cache.invalidate(clazz, item_id)
+    if return_changes:
+        return instance, changed
     return instance
 
 
-def delete(storage, clazz, item_id):
+@instrumented
+def delete(storage, clazz, item_id, expected_version=None):
     """Will delete a instance of `clazz`. The instance will be removed
     from the database.
 
+    If `clazz` is :class:`mixins.Versioned` the `expected_version` can
+    be given. The deletion is flushed immediately then and a
+    :class:`ConflictError` is raised if the item has another version or
+    was changed by another transaction.
+
     .. seealso::
 
         `create` method of the specific factory of `clazz`
@@ -174,11 +411,314 @@ def delete(storage, clazz, item_id):
     :storage: Session to the database.
     :clazz: Class of which an instance should be loaded.
     :item_id: ID of the item which should be loaded.
+    :expected_version: Version of the item the deletion is based on.
     :returns: Instance of clazz
     """
+    if expected_version is not None and not issubclass(clazz, Versioned):
+        raise TypeError("expected_version requires a clazz of type {}".format(Versioned))
+    # The changes must be based on the current values.
+    storage.use_primary()
     factory = clazz.get_factory(storage)
     try:
         instance = factory.load(item_id)
     except sa.orm.exc.NoResultFound:
         raise NotFound()
+    _check_version(storage, clazz, instance, expected_version)
     storage.delete(instance)
+    if expected_version is not None:
+        try:
+            storage.session.flush()
+        except StaleDataError:
+            raise ConflictError("{} {} was changed concurrently".format(
+                clazz.__name__, item_id))
+    if storage.cache is not None:
+        storage.cache.invalidate(clazz, item_id)
+
+
+@instrumented
+def bulk_create(storage, clazz, values, chunk_size=BULK_CHUNK_SIZE):
+    """Will create one new instance of `clazz` for each dictionary in
+    `values` and insert them in batches of `chunk_size` rows.
+
+    .. seealso::
+
+        Create method of the specific factory of `clazz`
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+    `values` must be a list of dicts. If not a TypeError will be raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be created.
+    :values: List of dictionaries of values used for initialisation.
+    :chunk_size: Maximum number of rows per statement.
+    :returns: List of ids in the order of `values`
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Create must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(values, list):
+        raise TypeError("Create must be called with a values of type {}".format(list))
+    factory = clazz.get_factory(storage)
+    items = []
+    for item_values in values:
+        if not isinstance(item_values, dict):
+            raise TypeError("Create must be called with a values of type {}".format(dict))
+        try:
+            items.append(factory.create(**item_values))
+        except TypeError as e:
+            raise TypeError("{}.{}".format(factory.__class__.__name__, e))
+    return storage.bulk_create(clazz, items, chunk_size)
+
+
+@instrumented
+def bulk_update(storage, clazz, values, chunk_size=BULK_CHUNK_SIZE):
+    """Will update the instances of `clazz` without loading them. Each
+    dictionary in `values` must contain the `id` of the item which
+    should be updated. Like in `set_values` of :class:`BaseItem` values
+    which are None or not part of `clazz` are silently ignored. If
+    `clazz` has an `updated` field it is set to the current time.
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+    `values` must be a list of dicts with an integer `id`. If not a
+    TypeError will be raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be updated.
+    :values: List of dictionaries of values.
+    :chunk_size: Maximum number of rows per statement.
+    :returns: List of ids in the order of `values`
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Update must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(values, list):
+        raise TypeError("Update must be called with a values of type {}".format(list))
+    fields = set(prop.key for prop in sa.inspect(clazz).column_attrs)
+    fields.discard("id")
+    if issubclass(clazz, Versioned):
+        fields.discard("version")
+    updated = datetime.utcnow() if hasattr(clazz, "updated") else None
+    rows = []
+    for item_values in values:
+        if not isinstance(item_values, dict):
+            raise TypeError("Update must be called with a values of type {}".format(dict))
+        if not isinstance(item_values.get("id"), int):
+            raise TypeError("id must be called with a value of type {}".format(int))
+        row = dict((key, value) for key, value in item_values.items()
+                   if key in fields and value is not None)
+        if updated is not None:
+            row["updated"] = updated
+        row["id"] = item_values["id"]
+        rows.append(row)
+    try:
+        return storage.bulk_update(clazz, rows, chunk_size)
+    except sa.orm.exc.NoResultFound:
+        raise NotFound()
+
+
+def _set_values(clazz, values):
+    """Returns the values for a set based update of `clazz`. Values
+    which are None or not part of `clazz` are ignored. If `clazz` has an
+    `updated` field it is set to the current time like the
+    'before_update' listener of :class:`mixins.Protocol` does for single
+    items. The version of :class:`mixins.Versioned` items is
+    incremented."""
+    versioned = issubclass(clazz, Versioned)
+    fields = set(prop.key for prop in sa.inspect(clazz).column_attrs)
+    fields.discard("id")
+    if versioned:
+        fields.discard("version")
+    values = dict((key, value) for key, value in values.items()
+                  if key in fields and value is not None)
+    if values and hasattr(clazz, "updated"):
+        values["updated"] = datetime.utcnow()
+    if values and versioned:
+        values["version"] = clazz.version + 1
+    return values
+
+
+@instrumented(rows=int)
+def update_where(storage, clazz, search, values):
+    """Will update all instances of `clazz` matching the given `search`
+    with one statement without loading them. Like in `set_values` of
+    :class:`BaseItem` values which are None or not part of `clazz` are
+    silently ignored. If `clazz` has an `updated` field it is set to
+    the current time. An empty `search` updates all instances.
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+    `values` must be of type dict. If not a TypeError will be raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be updated.
+    :search: Define search filters. See :mod:`query` for the syntax
+    :values: Dictionary of values.
+    :returns: Number of updated instances
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Update must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(values, dict):
+        raise TypeError("Update must be called with a values of type {}".format(dict))
+    criteria = parse_search(clazz, search)
+    values = _set_values(clazz, values)
+    if not values:
+        return 0
+    return storage.update_where(clazz, criteria, values)
+
+
+@instrumented(rows=int)
+def delete_where(storage, clazz, search):
+    """Will delete all instances of `clazz` matching the given `search`
+    with one statement without loading them. An empty `search` deletes
+    all instances.
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be deleted.
+    :search: Define search filters. See :mod:`query` for the syntax
+    :returns: Number of deleted instances
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Delete must be called with a clazz of type {}".format(BaseItem))
+    return storage.delete_where(clazz, parse_search(clazz, search))
+
+
+def _bulk_upsert(storage, clazz, values, chunk_size):
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Upsert must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(values, list):
+        raise TypeError("Upsert must be called with a values of type {}".format(list))
+    columns = [prop.key for prop in sa.inspect(clazz).column_attrs
+               if prop.key != "id"]
+    fields = set(columns)
+    fields.discard("uuid")
+    # Existing rows are looked up before the upsert.
+    storage.use_primary()
+    versioned = issubclass(clazz, Versioned)
+    if versioned:
+        # Set by the database, new rows start with version 1.
+        fields.discard("version")
+    updated = datetime.utcnow() if hasattr(clazz, "updated") else None
+    factory = clazz.get_factory(storage)
+    groups = {}
+    uuids = set()
+    for index, item_values in enumerate(values):
+        if not isinstance(item_values, dict):
+            raise TypeError("Upsert must be called with a values of type {}".format(dict))
+        item_uuid = item_values.get("uuid")
+        if not isinstance(item_uuid, uuid.UUID):
+            try:
+                item_uuid = uuid.UUID(item_uuid)
+            except (TypeError, ValueError, AttributeError):
+                raise TypeError("uuid must be called with a value of type {}".format(uuid.UUID))
+        if item_uuid in uuids:
+            raise TypeError("uuid must be unique within values")
+        uuids.add(item_uuid)
+        try:
+            item = factory.create()
+        except TypeError as e:
+            raise TypeError("{}.{}".format(factory.__class__.__name__, e))
+        if versioned and "version" in item_values:
+            item_values = dict(item_values)
+            del item_values["version"]
+        item.set_values(item_values)
+        item.uuid = item_uuid
+        if updated is not None:
+            item.updated = updated
+        row = dict((key, getattr(item, key)) for key in columns)
+        # Only the given values are changed in existing rows.
+        keys = [key for key, value in item_values.items()
+                if key in fields and value is not None]
+        if updated is not None and "updated" not in keys:
+            keys.append("updated")
+        groups.setdefault(tuple(sorted(keys)), []).append((index, row))
+    results = [None] * len(values)
+    for keys, rows in groups.items():
+        upserted = storage.bulk_upsert(clazz, [row for _, row in rows],
+                                       keys, chunk_size)
+        for (index, _), result in zip(rows, upserted):
+            results[index] = result
+    return results
+
+
+@instrumented
+def upsert(storage, clazz, values):
+    """Will create a new instance of `clazz` with the given `values` or
+    update the existing instance with the same uuid in one statement.
+    Like in `set_values` of :class:`BaseItem` values which are None or
+    not part of `clazz` are silently ignored for existing instances.
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+    `values` must be of type dict with a `uuid`. If not a TypeError will
+    be raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which the instance should be created or updated.
+    :values: Dictionary of values.
+    :returns: Tuple of the id and True if the instance was created
+    """
+    return _bulk_upsert(storage, clazz, [values], BULK_CHUNK_SIZE)[0]
+
+
+def _count_upserted(result):
+    created, updated = result
+    return len(created) + len(updated)
+
+
+@instrumented(rows=_count_upserted)
+def bulk_upsert(storage, clazz, values, chunk_size=BULK_CHUNK_SIZE):
+    """Will create new instances of `clazz` or update the existing
+    instances with the same uuid for each dictionary in `values`. The
+    native upsert of the database is used with one statement per batch
+    of `chunk_size` rows (see :meth:`Storage.bulk_upsert`), so
+    concurrent upserts of the same uuid do not fail. Values which are
+    None or not part of `clazz` are not changed in existing instances.
+    If `clazz` has an `updated` field it is set to the current time.
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+    `values` must be a list of dicts with unique uuids. If not a
+    TypeError will be raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be created or updated.
+    :values: List of dictionaries of values.
+    :chunk_size: Maximum number of rows per statement.
+    :returns: Tuple of the list of ids of the created and the list of
+        ids of the updated instances in the order of `values`
+    """
+    results = _bulk_upsert(storage, clazz, values, chunk_size)
+    return ([item_id for item_id, created in results if created],
+            [item_id for item_id, created in results if not created])
+
+
+@instrumented
+def bulk_delete(storage, clazz, item_ids, chunk_size=BULK_CHUNK_SIZE):
+    """Will delete the instances of `clazz` with the given `item_ids`
+    without loading them.
+
+    `clazz` must be a subclass of :class:`BaseItem`. If not a TypeError
+    will be raised.
+    `item_ids` must be a list of integers. If not a TypeError will be
+    raised.
+
+    :storage: Session to the database.
+    :clazz: Class of which the instances should be deleted.
+    :item_ids: List of IDs of the items which should be deleted.
+    :chunk_size: Maximum number of ids per statement.
+    :returns: List of ids in the order of `item_ids`
+    """
+    if not issubclass(clazz, BaseItem):
+        raise TypeError("Delete must be called with a clazz of type {}".format(BaseItem))
+    if not isinstance(item_ids, list):
+        raise TypeError("item_ids must be called with a value of type {}".format(list))
+    for item_id in item_ids:
+        if not isinstance(item_id, int):
+            raise TypeError("item_id must be called with a value of type {}".format(int))
+    try:
+        return storage.bulk_delete(clazz, item_ids, chunk_size)
+    except sa.orm.exc.NoResultFound:
+        raise NotFound()
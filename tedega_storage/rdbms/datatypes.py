@@ -1,23 +1,100 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-# import uuid
+import uuid
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql
 
 
 class UUID(sa.TypeDecorator):
-    """Json Datatype is used to implement a field which can store a UUID"""
+    """UUID Datatype is used to implement a field which can store a
+    UUID. The native UUID type is used on PostgreSQL, a BINARY(16) on
+    MySQL and a 16 byte BLOB on all other databases. Values are returned
+    as :class:`uuid.UUID`. Strings are accepted as values too."""
 
-    impl = sa.String
+    impl = sa.LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=True))
+        if dialect.name == "mysql":
+            return dialect.type_descriptor(mysql.BINARY(16))
+        return dialect.type_descriptor(sa.LargeBinary(16))
+
+    @property
+    def python_type(self):
+        return uuid.UUID
 
     def process_bind_param(self, value, dialect):
-        if value is not None:
-            return str(value)
-
-    # This code is not reached by tests, although this should happen
-    # because the correct type is set after reading the value from the
-    # DB. So for know I will comment this code out to get 100% code
-    # coverage again. But leave this code as a reminder here in case I
-    # am running into trouble later.
-    # def process_result_value(self, value, dialect):
-    #     if value is not None:
-    #         return uuid.UUID(value)
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(str(value))
+        if dialect.name == "postgresql":
+            return value
+        return value.bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, uuid.UUID):
+            return value
+        if isinstance(value, bytes) and len(value) == 16:
+            return uuid.UUID(bytes=value)
+        # Values of columns which are not migrated yet are still stored
+        # as strings. See :func:`migrate_uuid_column`.
+        if isinstance(value, bytes):
+            value = value.decode("ascii")
+        return uuid.UUID(value)
+
+
+def migrate_uuid_column(connection, table, column="uuid", key="id",
+                        chunk_size=500):
+    """Will convert the UUIDs stored as strings in `column` of `table`
+    by older versions of :class:`UUID` into the current storage format.
+    On PostgreSQL the column is changed to the native UUID type, on
+    MySQL to BINARY(16). On all other databases the string values are
+    rewritten as 16 byte binaries in place. The migration must run
+    within a transaction and can safely be repeated.
+
+    :connection: Connection to the database.
+    :table: Name of the table.
+    :column: Name of the column which holds the UUIDs.
+    :key: Name of the primary key column of the table.
+    :chunk_size: Maximum number of rows updated with one statement.
+    :returns: Number of converted rows or None if the column was
+        converted by the database.
+    """
+    preparer = connection.dialect.identifier_preparer
+    quoted_table = preparer.quote(table)
+    quoted_column = preparer.quote(column)
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(
+            "ALTER TABLE {0} ALTER COLUMN {1} TYPE uuid USING {1}::uuid"
+            .format(quoted_table, quoted_column))
+        return None
+    if connection.dialect.name == "mysql":
+        connection.exec_driver_sql(
+            "ALTER TABLE {0} MODIFY {1} VARBINARY(36)"
+            .format(quoted_table, quoted_column))
+        connection.exec_driver_sql(
+            "UPDATE {0} SET {1} = UNHEX(REPLACE({1}, '-', '')) "
+            "WHERE LENGTH({1}) = 36".format(quoted_table, quoted_column))
+        connection.exec_driver_sql(
+            "ALTER TABLE {0} MODIFY {1} BINARY(16)"
+            .format(quoted_table, quoted_column))
+        return None
+    # Read the raw values without conversion to find the rows which
+    # still store a string.
+    raw = sa.table(table, sa.column(key), sa.column(column))
+    rows = [(row[0], row[1]) for row in connection.execute(
+        sa.select([raw.c[key], raw.c[column]]))
+        if row[1] is not None and not
+        (isinstance(row[1], bytes) and len(row[1]) == 16)]
+    typed = sa.table(table, sa.column(key), sa.column(column, UUID()))
+    statement = typed.update().where(
+        typed.c[key] == sa.bindparam("_key")).values(
+            {column: sa.bindparam("_value", type_=UUID())})
+    for start in range(0, len(rows), chunk_size):
+        connection.execute(statement, [
+            {"_key": row_key, "_value": value}
+            for row_key, value in rows[start:start + chunk_size]])
+    return len(rows)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Detection of N+1 queries for debugging and tests.
+
+A :class:`QueryDetector` counts the statements executed by the sessions
+of the storages it is attached to. The statements are grouped by
+logical operation, which is the call of a function of the crud API (see
+:func:`tedega_storage.rdbms.instrumentation.instrumented`). Statements
+outside of the crud API, e.g calls of :class:`Storage` methods, form one
+operation named "other" per storage. An operation violates the budget if
+it executes more than `max_statements` statements or the same statement
+more than `max_repeats` times. The latter is the typical sign of lazy
+loads of relations in a loop, e.g when calling `get_values` for a page
+of items. Violations are reported with a :class:`QueryBudgetWarning` or
+raise a :class:`QueryBudgetError`.
+
+The detector is either passed to a single storage or activated for all
+storages created within a `with` block::
+
+    with QueryDetector(max_repeats=1, mode="raise"):
+        with get_storage() as storage:
+            items = search(storage, Item)
+            get_values_many(items)
+
+See :mod:`tedega_storage.testing` for a pytest fixture.
+"""
+import threading
+import warnings
+import weakref
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from tedega_storage.rdbms.instrumentation import (
+    OTHER,
+    current_operation,
+    track_operations
+)
+
+MODES = ("warn", "raise")
+"""Supported ways to report violations."""
+TRANSACTION_STATEMENTS = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT",
+                          "RELEASE")
+"""Prefixes of statements which are not counted."""
+
+CONNECTIONS = weakref.WeakKeyDictionary()
+"""Detectors by connection of the sessions they are attached to."""
+DETECTOR = None
+"""Detector for storages which are created without an explicit
+detector."""
+
+
+class QueryBudgetWarning(UserWarning):
+    """Warning for operations which exceed the query budget."""
+
+
+class QueryBudgetError(AssertionError):
+    """Error for operations which exceed the query budget."""
+
+
+class OperationReport(object):
+    """Statements executed by one operation.
+
+    :name: Name of the operation.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+        self.shapes = {}
+
+    @property
+    def repeats(self):
+        """Returns the highest number of executions of one statement."""
+        return max(self.shapes.values()) if self.shapes else 0
+
+    def __repr__(self):
+        return "<OperationReport {} statements={} repeats={}>".format(
+            self.name, self.statements, self.repeats)
+
+
+class QueryDetector(object):
+    """Counts the statements of the attached sessions per operation.
+
+    :max_statements: Maximum number of statements per operation or None.
+    :max_repeats: Maximum number of executions of the same statement
+        per operation or None.
+    :mode: "warn" to issue a :class:`QueryBudgetWarning` or "raise" to
+        raise a :class:`QueryBudgetError` as soon as an operation
+        exceeds the budget.
+    """
+
+    def __init__(self, max_statements=None, max_repeats=None, mode="warn"):
+        if mode not in MODES:
+            raise ValueError("Unsupported mode {}".format(mode))
+        self.max_statements = max_statements
+        self.max_repeats = max_repeats
+        self.mode = mode
+        self.reports = []
+        """List of :class:`OperationReport` in the order of execution."""
+        self.violations = []
+        """List of messages of the violations of the budget."""
+        self._operations = {}
+        self._previous = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        global DETECTOR
+        self._previous.append(DETECTOR)
+        DETECTOR = self
+        return self
+
+    def __exit__(self, e_type, e_value, tb):
+        global DETECTOR
+        DETECTOR = self._previous.pop()
+        return False
+
+    def attach(self, session):
+        """Will count the statements of `session` until :meth:`detach`
+        is called."""
+        track_operations()
+        event.listen(session, "after_begin", self._after_begin)
+
+    def detach(self, session):
+        """Will stop counting the statements of `session`."""
+        event.remove(session, "after_begin", self._after_begin)
+        track_operations(False)
+
+    def _after_begin(self, session, transaction, connection):
+        CONNECTIONS[connection] = self
+
+    def reset(self):
+        """Will forget all counted statements and violations."""
+        with self._lock:
+            self.reports = []
+            self.violations = []
+            self._operations = {}
+
+    @property
+    def statements(self):
+        """Returns the number of counted statements."""
+        return sum(report.statements for report in self.reports)
+
+    def count(self, connection, statement):
+        """Will count the `statement` executed on `connection` for the
+        running operation and report violations of the budget."""
+        operation = current_operation()
+        # Operations are told apart by identity. Statements outside of
+        # operations are grouped per connection.
+        key = operation if operation is not None else connection
+        with self._lock:
+            current = self._operations.get(id(key))
+            if current is None or current[0] is not key:
+                report = OperationReport(
+                    operation.name if operation is not None else OTHER)
+                self.reports.append(report)
+                self._operations[id(key)] = (key, report)
+            else:
+                report = current[1]
+            report.statements += 1
+            repeats = report.shapes.get(statement, 0) + 1
+            report.shapes[statement] = repeats
+            messages = []
+            if (self.max_statements is not None and
+                    report.statements == self.max_statements + 1):
+                messages.append(
+                    "Operation {} executed more than {} statements".format(
+                        report.name, self.max_statements))
+            if (self.max_repeats is not None and
+                    repeats == self.max_repeats + 1):
+                messages.append(
+                    "Operation {} executed the same statement more than {} "
+                    "times (N+1 query?): {}".format(
+                        report.name, self.max_repeats, statement))
+            self.violations.extend(messages)
+        for message in messages:
+            if self.mode == "raise":
+                raise QueryBudgetError(message)
+            warnings.warn(message, QueryBudgetWarning, stacklevel=2)
+
+
+def get_detector():
+    """Returns the active :class:`QueryDetector` or None."""
+    return DETECTOR
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    """Listen for the 'before_cursor_execute' event and count the
+    statement for the detector attached to the session of `conn`."""
+    if len(CONNECTIONS) == 0:
+        return
+    detector = CONNECTIONS.get(conn)
+    if detector is None or statement.startswith(TRANSACTION_STATEMENTS):
+        return
+    detector.count(conn, statement)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Factory and registry for the engines used by the storage.
+
+Engines are identified by a name and are created lazily on first use
+with :func:`get_engine`. The settings of an engine are either
+registered with :func:`configure_engine` or read from the environment.
+The settings of the default engine are read from the variables
+`TEDEGA_STORAGE_URI`, `TEDEGA_STORAGE_POOL_SIZE`,
+`TEDEGA_STORAGE_MAX_OVERFLOW`, `TEDEGA_STORAGE_POOL_TIMEOUT`,
+`TEDEGA_STORAGE_POOL_RECYCLE`, `TEDEGA_STORAGE_POOL_PRE_PING` and
+`TEDEGA_STORAGE_ECHO`, `TEDEGA_STORAGE_SQLITE_PROFILE`,
+`TEDEGA_STORAGE_SQLITE_PRAGMAS`, `TEDEGA_STORAGE_REPLICAS` and
+`TEDEGA_STORAGE_REPLICA_STRATEGY`. The settings for an engine named
+`foo` are read from the same variables with an additional `FOO_` after
+the `TEDEGA_STORAGE_` prefix, e.g `TEDEGA_STORAGE_FOO_URI`.
+"""
+import os
+import re
+import threading
+import weakref
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.event import listen
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_ENGINE = "default"
+"""Name of the engine which is used if no name is given."""
+DEFAUL_DB_URI = "sqlite:///default.db"
+
+SQLITE_PRAGMAS = ("journal_mode", "synchronous", "mmap_size", "cache_size",
+                  "temp_store", "busy_timeout")
+"""Names of the pragmas which can be set for SQLite databases."""
+
+SQLITE_PROFILES = {
+    "default": {},
+    "performance": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,
+        "cache_size": -65536,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+}
+"""Predefined pragmas for SQLite databases by name. "default" keeps the
+defaults of SQLite (rollback journal, full sync). "performance" uses a
+write ahead log which is only synced on checkpoints, a memory mapped
+database file and a 64 MiB page cache. Committed transactions may be
+lost on power failure but the database stays consistent. "durable"
+uses the write ahead log with a sync on every commit."""
+
+_pragma_value = re.compile(r"^-?\w+$")
+
+
+def _parse_pragmas(value):
+    """Returns a dictionary of the pragmas in the given string of
+    `name=value` pairs separated by commas."""
+    pragmas = {}
+    for pair in value.split(","):
+        if pair.strip():
+            key, pragma = pair.split("=")
+            pragmas[key.strip()] = pragma.strip()
+    return pragmas
+
+
+POOL_SETTINGS = {
+    "pool_size": int,
+    "max_overflow": int,
+    "pool_timeout": float,
+    "pool_recycle": int,
+    "pool_pre_ping": lambda value: value.lower() in ("1", "true", "yes"),
+    "echo": lambda value: value.lower() in ("1", "true", "yes"),
+    "sqlite_profile": str,
+    "sqlite_pragmas": _parse_pragmas,
+    "replicas": lambda value: [name.strip() for name in value.split(",")
+                               if name.strip()],
+    "replica_strategy": str,
+}
+"""Names of the supported engine settings and the functions to convert
+their values when read from the environment."""
+
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+}
+"""Drivers used for the async engines if the URI does not name a
+driver which supports asyncio."""
+
+ENGINES = {}
+"""Already created engines by name."""
+ASYNC_ENGINES = {}
+"""Already created async engines by name."""
+SETTINGS = {}
+"""Settings registered with :func:`configure_engine` by name."""
+NAMES = weakref.WeakKeyDictionary()
+"""Names of the created engines by engine."""
+ROUTING_SETTINGS = ("replicas", "replica_strategy")
+"""Settings which are used for the sessions of an engine and not for
+the engine itself. See :mod:`tedega_storage.rdbms.routing`."""
+_lock = threading.Lock()
+
+
+def sqlite_do_connect(dbapi_connection, connection_record):
+    # disable pysqlite's emitting of the BEGIN statement entirely.
+    # also stops it from emitting COMMIT before any DDL.
+    dbapi_connection.isolation_level = None
+
+
+def sqlite_do_begin(conn):
+    # emit our own BEGIN
+    conn.exec_driver_sql("BEGIN")
+
+
+def get_sqlite_pragmas(profile=None, pragmas=None):
+    """Returns the pragmas of the given SQLite `profile` updated with
+    the given `pragmas`.
+
+    :profile: Name of the profile. See :data:`SQLITE_PROFILES`.
+    :pragmas: Dictionary of additional pragmas.
+    :returns: Dictionary of pragmas.
+    """
+    if profile is None:
+        profile = "default"
+    if profile not in SQLITE_PROFILES:
+        raise ValueError("Unknown SQLite profile {}".format(profile))
+    result = dict(SQLITE_PROFILES[profile])
+    for key, value in (pragmas or {}).items():
+        if key not in SQLITE_PRAGMAS:
+            raise TypeError("Unknown SQLite pragma {}".format(key))
+        if not _pragma_value.match(str(value)):
+            raise ValueError("Invalid value for SQLite pragma {}".format(key))
+        result[key] = value
+    return result
+
+
+def sqlite_set_pragmas(pragmas):
+    """Returns a listener for the 'connect' event which sets the given
+    `pragmas` on every new connection."""
+    statements = ["PRAGMA {}={}".format(key, pragmas[key])
+                  for key in SQLITE_PRAGMAS if key in pragmas]
+
+    def sqlite_do_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+    return sqlite_do_pragmas
+
+
+def configure_engine(name=DEFAULT_ENGINE, uri=None, **settings):
+    """Will register the settings for the engine with the given `name`.
+    An already created engine with this name is disposed and will be
+    recreated with the new settings on next use.
+
+    :name: Name of the engine.
+    :uri: Database URI. Defaults to the URI from the environment.
+    :settings: Engine and pool settings. See :data:`POOL_SETTINGS`.
+    """
+    for key in settings:
+        if key not in POOL_SETTINGS:
+            raise TypeError("Unknown engine setting {}".format(key))
+    with _lock:
+        SETTINGS[name] = dict(settings, uri=uri)
+        engine = ENGINES.pop(name, None)
+        ASYNC_ENGINES.pop(name, None)
+    if engine is not None:
+        engine.dispose()
+
+
+def get_settings(name=DEFAULT_ENGINE):
+    """Returns the settings for the engine with the given `name`. The
+    settings registered with :func:`configure_engine` take precedence
+    over the settings from the environment.
+
+    :name: Name of the engine.
+    :returns: Dictionary with the uri and the engine settings.
+    """
+    if name == DEFAULT_ENGINE:
+        prefix = "TEDEGA_STORAGE_"
+    else:
+        prefix = "TEDEGA_STORAGE_{}_".format(name.upper())
+    settings = {"uri": os.environ.get(prefix + "URI")}
+    for key, convert in POOL_SETTINGS.items():
+        value = os.environ.get(prefix + key.upper())
+        if value is not None:
+            settings[key] = convert(value)
+    for key, value in SETTINGS.get(name, {}).items():
+        if value is not None:
+            settings[key] = value
+    if settings["uri"] is None:
+        if name != DEFAULT_ENGINE:
+            raise KeyError("No URI configured for engine {}".format(name))
+        settings["uri"] = DEFAUL_DB_URI
+    return settings
+
+
+def build_engine(settings):
+    """Will create a new engine for the given `settings`.
+
+    :settings: Dictionary with the uri and the engine settings.
+    :returns: Engine
+    """
+    settings = dict(settings)
+    uri = settings.pop("uri")
+    for key in ROUTING_SETTINGS:
+        settings.pop(key, None)
+    pragmas = get_sqlite_pragmas(settings.pop("sqlite_profile", None),
+                                 settings.pop("sqlite_pragmas", None))
+    settings.setdefault("echo", False)
+    url = make_url(uri)
+    if (pragmas and url.get_backend_name() == "sqlite" and
+            url.database not in (None, "", ":memory:")):
+        # Pragmas are set per connection, which is only worth it if the
+        # connections are pooled. SQLAlchemy uses no pool for SQLite
+        # files by default.
+        settings.setdefault("poolclass", QueuePool)
+        settings.setdefault("connect_args", {"check_same_thread": False})
+    engine = create_engine(url, **settings)
+    _setup_engine(engine, pragmas)
+    return engine
+
+
+def build_async_engine(settings):
+    """Will create a new async engine for the given `settings`. The
+    driver is replaced by the one from :data:`ASYNC_DRIVERS` unless the
+    URI already names a driver which supports asyncio.
+
+    :settings: Dictionary with the uri and the engine settings.
+    :returns: :class:`sqlalchemy.ext.asyncio.AsyncEngine`
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+    settings = dict(settings)
+    url = make_url(settings.pop("uri"))
+    for key in ROUTING_SETTINGS:
+        settings.pop(key, None)
+    pragmas = get_sqlite_pragmas(settings.pop("sqlite_profile", None),
+                                 settings.pop("sqlite_pragmas", None))
+    backend = url.get_backend_name()
+    if not url.get_dialect().is_async and backend in ASYNC_DRIVERS:
+        url = url.set(drivername="{}+{}".format(backend,
+                                                ASYNC_DRIVERS[backend]))
+    settings.setdefault("echo", False)
+    engine = create_async_engine(url, **settings)
+    _setup_engine(engine.sync_engine, pragmas)
+    return engine
+
+
+def _setup_engine(engine, pragmas=None):
+    """Will install the dialect specific event listeners on `engine`.
+    The given `pragmas` are set on every new connection to a SQLite
+    database."""
+    if engine.url.get_backend_name() == "sqlite":
+        #  SQLite doesn not support nested transactions directly.
+        #  But there is a workaround. See
+        #  http://docs.sqlalchemy.org/en/rel_1_0/dialects/sqlite.html#pysqlite-serializable
+        #  for more details.
+        listen(engine, "connect", sqlite_do_connect)
+        listen(engine, "begin", sqlite_do_begin)
+        if pragmas:
+            listen(engine, "connect", sqlite_set_pragmas(pragmas))
+
+
+def get_engine(name=DEFAULT_ENGINE):
+    """Returns the engine with the given `name`. The engine is created
+    on first use.
+
+    :name: Name of the engine.
+    :returns: Engine
+    """
+    engine = ENGINES.get(name)
+    if engine is None:
+        with _lock:
+            engine = ENGINES.get(name)
+            if engine is None:
+                engine = build_engine(get_settings(name))
+                ENGINES[name] = engine
+                NAMES[engine] = name
+    return engine
+
+
+def get_engine_name(engine):
+    """Returns the name of the given `engine` or None if the engine was
+    not created by :func:`get_engine`."""
+    return NAMES.get(engine)
+
+
+def get_async_engine(name=DEFAULT_ENGINE):
+    """Returns the async engine with the given `name`. The engine uses
+    the same settings as the engine returned by :func:`get_engine` and
+    is created on first use.
+
+    :name: Name of the engine.
+    :returns: :class:`sqlalchemy.ext.asyncio.AsyncEngine`
+    """
+    engine = ASYNC_ENGINES.get(name)
+    if engine is None:
+        with _lock:
+            engine = ASYNC_ENGINES.get(name)
+            if engine is None:
+                engine = build_async_engine(get_settings(name))
+                ASYNC_ENGINES[name] = engine
+    return engine
+
+
+def dispose_engines():
+    """Will dispose all created engines and close their pooled
+    connections. The engines are recreated on next use. Async engines
+    are only dropped from the registry as disposing them needs to be
+    awaited."""
+    with _lock:
+        engines = list(ENGINES.values())
+        ENGINES.clear()
+        ASYNC_ENGINES.clear()
+    for engine in engines:
+        engine.dispose()
+
+
+class EngineProxy(object):
+    """Stand-in for the engine with the given name which forwards all
+    attribute access to the engine returned by :func:`get_engine`. Used
+    to keep the module level `ENGINE` without creating the engine on
+    import."""
+
+    def __init__(self, name=DEFAULT_ENGINE):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_engine(self.name), attr)
+
+    def __repr__(self):
+        return "<EngineProxy {}>".format(self.name)
+
+
+ENGINE = EngineProxy()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Indexes for the fields which are used to search and sort items.
+
+Items declare the fields clients may filter and sort on. Each entry is
+either the name of a field or a tuple of names for a composite index::
+
+    class Ticket(Protocol, BaseItem, RDBMSStorageBase):
+        __tablename__ = "tickets"
+        __searchable__ = ("state", ("owner", "priority"))
+        __sortable__ = ("created", ("state", "created"))
+
+:func:`tedega_storage.rdbms.init_storage` creates the indexes for these
+declarations, also for tables which already exist. Indexes for sortable
+fields end with the `id`, which :func:`crud.search` adds as last sort
+key in keyset mode.
+
+The :class:`IndexAdvisor` records the shapes of the searches which are
+actually executed and reports the shapes no index is declared for.
+:meth:`IndexAdvisor.explain` asks the database for the plan of each
+recorded shape (SQLite and PostgreSQL) and reports full table scans and
+sorts without an index::
+
+    advisor = configure_advisor()
+    ...
+    for report in advisor.missing_indexes():
+        print(report)
+"""
+import json
+import threading
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from tedega_storage.rdbms.query import _split_search, build_search, get_field
+
+EQUALITY_OPERATORS = ("eq", "in", "isnull")
+"""Operators which allow to use further columns of an index."""
+
+ADVISOR = None
+"""Advisor which records the searches or None if disabled."""
+
+
+def _entries(definitions):
+    """Returns the entries of a `__searchable__` or `__sortable__`
+    declaration as tuples of field names without sort direction."""
+    for entry in definitions or ():
+        if isinstance(entry, str):
+            entry = (entry,)
+        yield tuple(key.lstrip("+-") for key in entry)
+
+
+def index_columns(clazz):
+    """Returns the tuples of the names of the columns which should be
+    indexed for the `__searchable__` and `__sortable__` declarations of
+    `clazz`. A ValueError is raised for unknown fields.
+
+    :clazz: Mapped class.
+    :returns: List of tuples of column names.
+    """
+    definitions = list(_entries(getattr(clazz, "__searchable__", None)))
+    for entry in _entries(getattr(clazz, "__sortable__", None)):
+        if "id" not in entry:
+            entry = entry + ("id",)
+        definitions.append(entry)
+    indexed = _leading_columns(clazz.__table__, indexes=False)
+    result = []
+    for entry in definitions:
+        try:
+            columns = tuple(get_field(clazz, key).property.columns[0].name
+                            for key in entry)
+        except AttributeError as e:
+            raise ValueError("{} has no field {}".format(clazz.__name__, e))
+        if columns not in result:
+            result.append(columns)
+    # Indexes which are the prefix of another index are not needed.
+    return [columns for columns in result
+            if not _covered(indexed + [other for other in result
+                                       if other != columns], columns)]
+
+
+def _leading_columns(table, indexes=True):
+    """Returns the tuples of the columns of the primary key and unique
+    constraints of `table` and of its `indexes`."""
+    leading = [tuple(column.name for column in table.primary_key)]
+    for constraint in table.constraints:
+        if isinstance(constraint, sa.UniqueConstraint):
+            leading.append(tuple(column.name for column in constraint))
+    if indexes:
+        leading.extend(tuple(column.name for column in index.columns)
+                       for index in table.indexes)
+    return leading
+
+
+def _covered(leading, columns):
+    """Returns True if one of the tuples of columns in `leading` starts
+    with `columns`."""
+    return any(existing[:len(columns)] == columns for existing in leading)
+
+
+def declare_indexes(base):
+    """Will add the indexes for the declarations of all classes mapped
+    with the declarative `base` to their tables.
+
+    :base: Declarative base.
+    :returns: List of the declared :class:`sqlalchemy.Index`.
+    """
+    indexes = []
+    for mapper in base.registry.mappers:
+        table = mapper.local_table
+        if not isinstance(table, sa.Table):
+            continue
+        for columns in index_columns(mapper.class_):
+            if _covered(_leading_columns(table), columns):
+                continue
+            name = "ix_{}_{}".format(table.name, "_".join(columns))
+            indexes.append(sa.Index(name, *[table.c[column]
+                                            for column in columns]))
+    return indexes
+
+
+def create_indexes(base, engine):
+    """Will create the indexes for the declarations of all classes
+    mapped with the declarative `base` which do not exist yet in the
+    database of `engine`.
+
+    :base: Declarative base.
+    :engine: Engine of the database.
+    """
+    declare_indexes(base)
+    for table in base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN of a select statement."""
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "sqlite")
+def _explain_sqlite(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, "postgresql")
+def _explain_postgresql(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement,
+                                                       **kw)
+
+
+def _sqlite_full_scan(line, table):
+    """Returns True if the `line` of a SQLite query plan scans `table`
+    without an index or sorts without an index."""
+    words = line.split()
+    if words[:1] == ["SCAN"] and " USING " not in line:
+        # "SCAN TABLE name" before SQLite 3.36, "SCAN name" after.
+        return table in words[1:3]
+    return line.startswith("USE TEMP B-TREE FOR ORDER BY")
+
+
+def _pg_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", ()):
+        for node in _pg_nodes(child):
+            yield node
+
+
+class ShapeReport(object):
+    """Searches of one shape recorded by the :class:`IndexAdvisor`.
+
+    :clazz: Class of the searched items.
+    :filters: Tuple of (key, operator) tuples of the conditions which
+        must match. Alternatives of "~" conditions are not included.
+    :sort: Tuple of the sort keys.
+    :search: Search string of the first search of this shape. Used as
+        example for :meth:`IndexAdvisor.explain`.
+    """
+
+    def __init__(self, clazz, filters, sort, search):
+        self.clazz = clazz
+        self.filters = filters
+        self.sort = sort
+        self.search = search
+        self.count = 0
+        self.plan = None
+        """Lines of the plan after :meth:`IndexAdvisor.explain`."""
+        self.full_scan = None
+        """True if the plan scans the whole table or sorts without an
+        index. None if not explained."""
+
+    @property
+    def columns(self):
+        """Returns the tuple of the columns of the suggested index:
+        the columns compared for equality, then the first column
+        compared by range or the sort keys."""
+        columns = []
+        ranges = []
+        for key, operator in self.filters:
+            if operator in EQUALITY_OPERATORS:
+                columns.append(key)
+            else:
+                ranges.append(key)
+        if ranges:
+            columns.append(ranges[0])
+        elif self.sort:
+            columns.extend(self.sort)
+        result = []
+        for key in columns:
+            name = get_field(self.clazz, key).property.columns[0].name
+            if name not in result:
+                result.append(name)
+        return tuple(result)
+
+    @property
+    def missing(self):
+        """Returns True if no index of the table starts with the first
+        column of the suggested index."""
+        columns = self.columns
+        return bool(columns) and not _covered(
+            _leading_columns(self.clazz.__table__), columns[:1])
+
+    def __repr__(self):
+        return "<ShapeReport {} filters={} sort={} count={} index={}>".format(
+            self.clazz.__name__, self.filters, self.sort, self.count,
+            self.columns)
+
+
+class IndexAdvisor(object):
+    """Records the shapes of the searches of :func:`crud.search` and
+    reports the shapes which are not supported by an index. Only the
+    shapes and one example search per shape are kept."""
+
+    def __init__(self):
+        self.shapes = {}
+        """Dictionary of :class:`ShapeReport` by class and shape."""
+        self._lock = threading.Lock()
+
+    def record(self, clazz, search, sort):
+        """Will count a search of `clazz` with the given `search` and
+        `sort` definitions."""
+        shape, _ = _split_search(search)
+        # Groups of alternatives ("~") can not use a composite index.
+        filters = tuple(group[0][:2] for group in shape if len(group) == 1)
+        keys = tuple(key.lstrip("+-") for key in sort.split("|") if key)
+        key = (clazz, filters, keys)
+        with self._lock:
+            report = self.shapes.get(key)
+            if report is None:
+                report = self.shapes[key] = ShapeReport(clazz, filters, keys,
+                                                        search)
+            report.count += 1
+
+    def reset(self):
+        """Will forget all recorded searches."""
+        with self._lock:
+            self.shapes = {}
+
+    def reports(self):
+        """Returns the list of :class:`ShapeReport` ordered by the
+        number of searches."""
+        with self._lock:
+            reports = list(self.shapes.values())
+        return sorted(reports, key=lambda report: -report.count)
+
+    def missing_indexes(self):
+        """Returns the list of :class:`ShapeReport` of the shapes for
+        which the table has no matching index. The `columns` of each
+        report are the suggested index."""
+        return [report for report in self.reports() if report.missing]
+
+    def explain(self, storage):
+        """Will run EXPLAIN for the example search of each recorded
+        shape and set the `plan` and `full_scan` of the reports. Only
+        SQLite and PostgreSQL are supported.
+
+        :storage: Storage of the database.
+        :returns: List of :class:`ShapeReport` with a full scan.
+        """
+        dialect = storage.session.get_bind().dialect.name
+        if dialect not in ("sqlite", "postgresql"):
+            raise NotImplementedError(
+                "EXPLAIN is not supported on {}".format(dialect))
+        result = []
+        for report in self.reports():
+            statement, params, _ = build_search(
+                report.clazz, 20, 0, report.search, "|".join(report.sort),
+                None)
+            rows = storage.session.execute(Explain(statement), params).all()
+            table = report.clazz.__table__.name
+            if dialect == "sqlite":
+                report.plan = [row[-1] for row in rows]
+                report.full_scan = any(_sqlite_full_scan(line, table)
+                                       for line in report.plan)
+            else:
+                plan = rows[0][0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                nodes = list(_pg_nodes(plan[0]["Plan"]))
+                report.plan = [node["Node Type"] for node in nodes]
+                report.full_scan = any(
+                    (node["Node Type"] == "Seq Scan" and
+                     node.get("Relation Name") == table) or
+                    node["Node Type"] == "Sort" for node in nodes)
+            if report.full_scan:
+                result.append(report)
+        return result
+
+
+def configure_advisor(advisor=None):
+    """Will enable the recording of the searches.
+
+    :advisor: :class:`IndexAdvisor`. Defaults to a new one.
+    :returns: The advisor.
+    """
+    global ADVISOR
+    ADVISOR = advisor if advisor is not None else IndexAdvisor()
+    return ADVISOR
+
+
+def disable_advisor():
+    """Will disable the recording of the searches."""
+    global ADVISOR
+    ADVISOR = None
+
+
+def get_advisor():
+    """Returns the configured :class:`IndexAdvisor` or None."""
+    return ADVISOR
+
+
+def record_search(clazz, search, sort):
+    """Will record the search with the configured advisor if there is
+    one."""
+    advisor = ADVISOR
+    if advisor is not None:
+        advisor.record(clazz, search, sort)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Instrumentation of the storage operations.
+
+The instrumentation is disabled by default and enabled with
+:func:`configure_instrumentation`. Then every function of the crud API
+is measured as an operation named like the function. For each operation
+the latency, the number of executed statements and the number of
+returned or changed items are reported to a :class:`MetricsSink`.
+Every statement is measured with the `before_cursor_execute` and
+`after_cursor_execute` events of all engines and reported with the name
+of the operation which executed it ("other" for statements outside of
+the crud API).
+
+Statements taking longer than the configured threshold are logged to
+the `tedega_storage.slow_query` logger. The values of the bound
+parameters are not logged.
+
+:class:`PrometheusSink` keeps histograms and counters in memory and
+renders them in the text format of Prometheus::
+
+    sink = configure_instrumentation(PrometheusSink(), slow_query=0.5)
+    ...
+    body = sink.export()
+"""
+import functools
+import inspect
+import logging
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import contextvars
+    _operation = contextvars.ContextVar("tedega_storage_operation")
+except ImportError:  # pragma: no cover
+    contextvars = None
+    _operation = None
+
+log = logging.getLogger("tedega_storage.slow_query")
+_clock = getattr(time, "perf_counter", time.time)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+"""Default upper bounds in seconds of the buckets of the histograms."""
+OTHER = "other"
+"""Name of the operation for statements outside of the crud API."""
+
+
+class MetricsSink(object):
+    """Interface for the receivers of the measured values. All methods
+    are called synchronously and must be thread safe."""
+
+    def observe_operation(self, operation, seconds, statements, rows):
+        """Called after an operation finished.
+
+        :operation: Name of the operation.
+        :seconds: Duration of the operation.
+        :statements: Number of statements executed by the operation.
+        :rows: Number of items returned or changed by the operation.
+        """
+
+    def observe_statement(self, operation, statement, seconds, rows):
+        """Called after a statement was executed.
+
+        :operation: Name of the operation which executed the statement.
+        :statement: SQL of the statement.
+        :seconds: Duration of the statement.
+        :rows: Number of affected rows or -1 if not known.
+        """
+
+    def observe_slow_statement(self, operation, statement, parameters,
+                               seconds):
+        """Called for statements slower than the configured threshold.
+
+        :operation: Name of the operation which executed the statement.
+        :statement: SQL of the statement.
+        :parameters: Redacted parameters. See :func:`redact`.
+        :seconds: Duration of the statement.
+        """
+
+
+class Histogram(object):
+    """Cumulative histogram of observed values."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PrometheusSink(MetricsSink):
+    """Sink which aggregates the measured values by operation and
+    renders them in the text format of Prometheus with :meth:`export`.
+
+    :buckets: Upper bounds in seconds of the buckets of the histograms.
+    :prefix: Prefix of the names of the metrics.
+    """
+
+    def __init__(self, buckets=BUCKETS, prefix="tedega_storage"):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.operations = {}
+        self.statements = {}
+        self.rows = {}
+        self.slow_statements = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, histograms, operation):
+        histogram = histograms.get(operation)
+        if histogram is None:
+            histogram = histograms[operation] = Histogram(self.buckets)
+        return histogram
+
+    def observe_operation(self, operation, seconds, statements, rows):
+        with self._lock:
+            self._histogram(self.operations, operation).observe(seconds)
+            self.rows[operation] = self.rows.get(operation, 0) + rows
+
+    def observe_statement(self, operation, statement, seconds, rows):
+        with self._lock:
+            self._histogram(self.statements, operation).observe(seconds)
+
+    def observe_slow_statement(self, operation, statement, parameters,
+                               seconds):
+        with self._lock:
+            self.slow_statements[operation] = \
+                self.slow_statements.get(operation, 0) + 1
+
+    def export(self):
+        """Returns the metrics in the text format of Prometheus."""
+        lines = []
+        with self._lock:
+            for name, text, histograms in (
+                    ("operation_seconds", "Latency of storage operations.",
+                     self.operations),
+                    ("statement_seconds", "Latency of SQL statements.",
+                     self.statements)):
+                name = "{}_{}".format(self.prefix, name)
+                lines.append("# HELP {} {}".format(name, text))
+                lines.append("# TYPE {} histogram".format(name))
+                for operation in sorted(histograms):
+                    histogram = histograms[operation]
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.counts):
+                        lines.append('{}_bucket{{operation="{}",le="{}"}} {}'
+                                     .format(name, operation, bound, count))
+                    lines.append('{}_bucket{{operation="{}",le="+Inf"}} {}'
+                                 .format(name, operation, histogram.count))
+                    lines.append('{}_sum{{operation="{}"}} {}'.format(
+                        name, operation, repr(histogram.sum)))
+                    lines.append('{}_count{{operation="{}"}} {}'.format(
+                        name, operation, histogram.count))
+            for name, text, counters in (
+                    ("rows_total", "Items returned by storage operations.",
+                     self.rows),
+                    ("slow_statements_total", "SQL statements slower than "
+                     "the threshold.", self.slow_statements)):
+                name = "{}_{}".format(self.prefix, name)
+                lines.append("# HELP {} {}".format(name, text))
+                lines.append("# TYPE {} counter".format(name))
+                for operation in sorted(counters):
+                    lines.append('{}{{operation="{}"}} {}'.format(
+                        name, operation, counters[operation]))
+        return "\n".join(lines) + "\n"
+
+
+SINK = None
+"""Sink of the measured values or None if the instrumentation is
+disabled."""
+SLOW_QUERY = None
+"""Threshold in seconds above which statements are logged."""
+TRACKING = 0
+"""Number of active users of :func:`current_operation` besides the
+sink, e.g :class:`tedega_storage.rdbms.detector.QueryDetector`. The
+operations are tracked if a sink is configured or this is not 0."""
+_lock = threading.Lock()
+
+
+def configure_instrumentation(sink=None, slow_query=None):
+    """Will enable the instrumentation.
+
+    :sink: :class:`MetricsSink` which receives the measured values.
+        Defaults to a new :class:`PrometheusSink`.
+    :slow_query: Optional threshold in seconds. Statements taking longer
+        are logged.
+    :returns: The sink.
+    """
+    global SINK, SLOW_QUERY
+    if contextvars is None:  # pragma: no cover
+        raise RuntimeError("Instrumentation requires contextvars")
+    SINK = sink if sink is not None else PrometheusSink()
+    SLOW_QUERY = slow_query
+    return SINK
+
+
+def disable_instrumentation():
+    """Will disable the instrumentation."""
+    global SINK, SLOW_QUERY
+    SINK = None
+    SLOW_QUERY = None
+
+
+def get_sink():
+    """Returns the configured :class:`MetricsSink` or None."""
+    return SINK
+
+
+def track_operations(enable=True):
+    """Will enable the tracking of the running operation independent of
+    the sink. Every call with `enable` must be matched by a call with
+    `enable=False`."""
+    global TRACKING
+    with _lock:
+        TRACKING += 1 if enable else -1
+
+
+def redact(parameters):
+    """Returns the given statement `parameters` with all values replaced
+    by "?". The keys of named parameters are kept."""
+    if isinstance(parameters, dict):
+        return dict((key, "?") for key in parameters)
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany
+            return [redact(params) for params in parameters]
+        return ["?"] * len(parameters)
+    return "?"
+
+
+class Operation(object):
+    """Counters of the running operation."""
+
+    __slots__ = ("name", "statements")
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = 0
+
+
+def current_operation():
+    """Returns the running :class:`Operation` or None."""
+    if _operation is None:  # pragma: no cover
+        return None
+    return _operation.get(None)
+
+
+def count_items(result):
+    """Returns the number of items in the `result` of an operation: the
+    length of a list, 0 for None and 1 for anything else."""
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def instrumented(func=None, rows=count_items):
+    """Decorator which measures calls of `func` as an operation named
+    like the function if the instrumentation is enabled. Coroutine
+    functions are supported. Use ``@instrumented(rows=...)`` for
+    operations whose result is not counted by :func:`count_items`.
+
+    :rows: Function which returns the number of items for the result
+        of `func`.
+    """
+    if func is None:
+        return functools.partial(instrumented, rows=rows)
+    name = func.__name__
+
+    def finish(sink, token, operation, start, result):
+        _operation.reset(token)
+        if sink is not None:
+            sink.observe_operation(name, _clock() - start,
+                                   operation.statements, rows(result))
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            sink = SINK
+            if sink is None and not TRACKING:
+                return await func(*args, **kwargs)
+            operation = Operation(name)
+            token = _operation.set(operation)
+            start = _clock()
+            result = None
+            try:
+                result = await func(*args, **kwargs)
+            finally:
+                finish(sink, token, operation, start, result)
+            return result
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        sink = SINK
+        if sink is None and not TRACKING:
+            return func(*args, **kwargs)
+        operation = Operation(name)
+        token = _operation.set(operation)
+        start = _clock()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            finish(sink, token, operation, start, result)
+        return result
+    return wrapper
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    """Listen for the 'before_cursor_execute' event and remember the
+    start time of the statement."""
+    if SINK is None:
+        return
+    conn.info.setdefault("tedega_storage_start", []).append(_clock())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    """Listen for the 'after_cursor_execute' event and report the
+    statement to the sink."""
+    sink = SINK
+    starts = conn.info.get("tedega_storage_start")
+    if sink is None or not starts:
+        return
+    seconds = _clock() - starts.pop()
+    operation = current_operation()
+    if operation is not None:
+        operation.statements += 1
+        name = operation.name
+    else:
+        name = OTHER
+    sink.observe_statement(name, statement, seconds, cursor.rowcount)
+    if SLOW_QUERY is not None and seconds >= SLOW_QUERY:
+        parameters = redact(parameters)
+        log.warning("Slow query in %s (%.3fs): %s; parameters: %s",
+                    name, seconds, statement, parameters)
+        sink.observe_slow_statement(name, statement, parameters, seconds)
+
+
+@event.listens_for(Engine, "handle_error")
+def abort_statement(context):
+    """Listen for the 'handle_error' event and forget the start time of
+    the failed statement."""
+    connection = context.connection
+    if connection is None:
+        return
+    starts = connection.info.get("tedega_storage_start")
+    if starts:
+        starts.pop()
@@ -4,6 +4,7 @@
 from datetime import datetime
 import sqlalchemy as sa
 from sqlalchemy import event
+from sqlalchemy.ext.declarative import declared_attr
 
 
 class Protocol(object):
@@ -27,3 +28,28 @@ def protocol_update(mapper, connection, target):
     """
     if hasattr(target, "updated"):
         target.updated = datetime.utcnow()
+
+
+class Versioned(object):
+    """Mixin which adds optimistic concurrency control to Items. The
+    `version` is incremented by every UPDATE of the item through the
+    ORM. The UPDATE and DELETE statements of the ORM only match the row
+    if it still has the version which was loaded. Otherwise a
+    StaleDataError is raised on flush, which `crud.update` and
+    `crud.delete` report as :class:`crud.ConflictError`.
+
+    The set based and bulk updates and upserts of `crud` and
+    :class:`Storage` increment the version too. The version can not be
+    set through the values of the crud API."""
+
+    version = sa.Column("version", sa.Integer, nullable=False)
+    """Number of the version of the dataset, starting with 1."""
+
+    @declared_attr
+    def __mapper_args__(cls):
+        return {"version_id_col": cls.version}
+
+    def __init__(self):
+        super(Versioned, self).__init__()
+        # Set for inserts bypassing the ORM, e.g `Storage.bulk_create`.
+        self.version = 1
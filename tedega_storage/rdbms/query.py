@@ -0,0 +1,643 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Parser for the search, sort and fields definitions used by
+:func:`crud.search` and helpers to build the query for them.
+
+A search definition is a list of filters separated by "|". All filters
+must match. Each filter is a list of conditions separated by "~" of
+which at least one must match. A condition has the form
+``key:operator:value``. The operator can be omitted for equality which
+gives the ``key::value`` form. Supported operators are:
+
+========  ==========================================================
+eq        Equal (default)
+ne        Not equal
+gt, ge    Greater than, greater or equal
+lt, le    Less than, less or equal
+in        Equal to one of the values separated by ","
+prefix    Starts with the value, see below
+isnull    Is NULL if the value is "true", is not NULL if it is "false"
+========  ==========================================================
+
+Values are converted into the python type of the column before they
+are compared, so the database can compare them with the column without
+a cast and use existing indexes. Example::
+
+    search="state::open|priority:ge:3|owner:isnull:true~owner:in:1,2"
+
+A "prefix" condition on a text column compares with the range of the
+strings starting with the value, so an index on the column can be used,
+and with LIKE for the exact semantics. It is case sensitive unless the
+collation of the column is case insensitive, e.g the "_ci" collations of
+MySQL. Other columns are compared with LIKE only.
+
+A "|", "~", "," or backslash in a value is escaped with a backslash,
+e.g ``name::a\\|b`` or ``name:in:a\\,b,c``. Other backslashes are kept.
+A "~" which is not followed by a condition is part of the value, so
+``name::a~b`` compares with "a~b".
+
+A sort definition is a list of keys separated by "|". Keys starting
+with "-" are sorted descending.
+
+An include definition is a list of relations separated by "|" which are
+loaded together with the items. Nested relations are given as path
+separated by ".", e.g ``include="children.toys|owner"``. Collections
+are loaded with one additional SELECT ... IN per relation for all
+items, single items are joined into the query.
+"""
+import base64
+import json
+import re
+import uuid
+from datetime import date, datetime, time
+from decimal import Decimal
+import sqlalchemy as sa
+from tedega_view import ClientError
+from tedega_storage.rdbms.cache import LRUBackend
+
+DATETIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+                    "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S",
+                    "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+"""Accepted formats for datetime values in search filters."""
+TIME_FORMATS = ("%H:%M:%S.%f", "%H:%M:%S", "%H:%M")
+"""Accepted formats for time values in search filters."""
+TRUE_VALUES = ("1", "true", "yes")
+"""Accepted values for true in search filters."""
+FALSE_VALUES = ("0", "false", "no")
+"""Accepted values for false in search filters."""
+OPERATORS = ("eq", "ne", "gt", "ge", "lt", "le", "in", "prefix", "isnull")
+"""Supported operators in search filters."""
+ESCAPE = "\\"
+"""Character which escapes separators in the values of search filters."""
+_ESCAPED = re.compile(r"\\([|~,\\])")
+_CONDITION = re.compile(r"\w+:\w*:")
+MAX_CHAR = chr(0x10FFFF)
+"""Highest character, used for the upper bound of prefix ranges."""
+STATEMENT_CACHE_SIZE = 256
+"""Maximum number of prepared search statements kept in the cache."""
+STATEMENTS = LRUBackend(maxsize=STATEMENT_CACHE_SIZE)
+"""Cache of prepared search statements. See :func:`build_search`."""
+COUNT_TTL = 60
+"""Seconds an estimated total is cached."""
+COUNTS = LRUBackend(maxsize=1024, ttl=COUNT_TTL)
+"""Cache of estimated totals by class and search."""
+
+
+class Page(list):
+    """List of items returned by :func:`crud.search` in keyset mode or
+    if a total was requested. The `cursor` attribute holds the
+    continuation token for the next page or None if there are no more
+    items. The `total` attribute holds the number of all items matching
+    the search."""
+
+    cursor = None
+    total = None
+
+
+def get_field(clazz, key):
+    """Returns the mapped column `key` of `clazz`. An AttributeError is
+    raised if `clazz` has no such column."""
+    if key not in sa.inspect(clazz).column_attrs:
+        raise AttributeError(key)
+    return getattr(clazz, key)
+
+
+def _parse_datetime(value, formats=DATETIME_FORMATS):
+    for format in formats:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Can not parse {}".format(value))
+
+
+def _parse_bool(value):
+    value = value.lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError("Can not parse {}".format(value))
+
+
+def coerce_value(field, value):
+    """Returns the given string `value` converted into the python type
+    of the column `field`. Values of columns with an unknown python
+    type are returned unchanged. A ValueError is raised if the value
+    can not be converted.
+
+    :field: Mapped column.
+    :value: String value.
+    :returns: Converted value.
+    """
+    try:
+        python_type = field.type.python_type
+    except NotImplementedError:
+        return value
+    if isinstance(value, python_type):
+        return value
+    if python_type is bool:
+        return _parse_bool(value)
+    if python_type is datetime:
+        return _parse_datetime(value)
+    if python_type is date:
+        return _parse_datetime(value).date()
+    if python_type is time:
+        return _parse_datetime(value, TIME_FORMATS).time()
+    if python_type in (int, float, Decimal, uuid.UUID):
+        try:
+            return python_type(value)
+        except ArithmeticError:
+            raise ValueError("Can not convert {}".format(value))
+    return value
+
+
+def _split(text, separator):
+    """Returns the parts of `text` separated by `separator` unless it is
+    escaped. The escapes are kept in the parts."""
+    if ESCAPE not in text:
+        return text.split(separator)
+    parts = [""]
+    escaped = False
+    for char in text:
+        if escaped:
+            parts[-1] += char
+            escaped = False
+        elif char == separator:
+            parts.append("")
+        else:
+            parts[-1] += char
+            escaped = char == ESCAPE
+    return parts
+
+
+def _unescape(value):
+    """Returns `value` with the escapes of separators removed."""
+    if ESCAPE not in value:
+        return value
+    return _ESCAPED.sub(r"\1", value)
+
+
+def _split_search(search):
+    """Returns the shape of the given search string and the values of
+    its conditions. The shape is a tuple of groups of (key, operator,
+    flag) tuples where flag is the value of "isnull" conditions and None
+    for all other operators. The values of the remaining conditions are
+    returned in the same order, as tuple of strings for "in" conditions
+    and as string otherwise."""
+    shape = []
+    values = []
+    if search != "":
+        try:
+            for _filter in _split(search, "|"):
+                conditions = []
+                for part in _split(_filter, "~"):
+                    if conditions and not _CONDITION.match(part):
+                        conditions[-1] += "~" + part
+                    else:
+                        conditions.append(part)
+                group = []
+                for condition in conditions:
+                    key, operator, value = condition.split(":", 2)
+                    operator = operator or "eq"
+                    if operator not in OPERATORS:
+                        raise ClientError("One of the operators in search filter is invalid")
+                    if operator == "isnull":
+                        group.append((key, operator,
+                                      _parse_bool(_unescape(value))))
+                    else:
+                        group.append((key, operator, None))
+                        if operator == "in":
+                            value = tuple(_unescape(v)
+                                          for v in _split(value, ","))
+                        else:
+                            value = _unescape(value)
+                        values.append(value)
+                shape.append(tuple(group))
+        except ValueError:
+            raise ClientError("Can not parse search filter")
+    return tuple(shape), values
+
+
+def _is_text(field):
+    """Returns True if the python type of the column `field` is str."""
+    try:
+        return field.type.python_type is str
+    except NotImplementedError:
+        return False
+
+
+def _prefix_range(value):
+    """Returns the lower and upper bound of the strings starting with
+    `value`. The upper bound is `value` with its last character
+    incremented."""
+    head = value.rstrip(MAX_CHAR)
+    if head == "":
+        return value, value + MAX_CHAR
+    code = ord(head[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        # Surrogates can not be encoded.
+        code = 0xE000
+    return value, head[:-1] + chr(code)
+
+
+def _bind_value(field, operator, value):
+    """Returns the value which is bound for a condition with the given
+    string `value`. For "prefix" conditions on text columns this is the
+    tuple of the bounds of the range (see :func:`_prefix_range`) and the
+    LIKE pattern. The
+    `value` of "in" conditions is the tuple of strings from
+    :func:`_split_search`."""
+    if operator == "in":
+        return [coerce_value(field, v) for v in value]
+    if operator == "prefix":
+        pattern = value.replace("/", "//").replace("%", "/%")
+        pattern = pattern.replace("_", "/_") + "%"
+        if _is_text(field):
+            return _prefix_range(value) + (pattern,)
+        # Other columns are compared as strings with LIKE only.
+        return pattern
+    return coerce_value(field, value)
+
+
+def _compare(field, operator, value):
+    """Returns the criterion for a condition. `value` is either the
+    bound value or a bind parameter. For "isnull" conditions it is the
+    flag from the shape of the search."""
+    if operator == "eq":
+        return field == value
+    if operator == "ne":
+        return field != value
+    if operator == "gt":
+        return field > value
+    if operator == "ge":
+        return field >= value
+    if operator == "lt":
+        return field < value
+    if operator == "le":
+        return field <= value
+    if operator == "in":
+        return field.in_(value)
+    if operator == "prefix":
+        if isinstance(value, tuple):
+            # The range lets the database use an index on the column,
+            # which it does not for LIKE on SQLite and most collations
+            # of PostgreSQL. Depending on the collation the range also
+            # contains strings which do not start with the value, so
+            # LIKE is kept as residual filter.
+            return sa.and_(field >= value[0], field < value[1],
+                           field.like(value[2], escape="/"))
+        return field.like(value, escape="/")
+    if value:
+        return field.is_(None)
+    return field.isnot(None)
+
+
+def _build_criteria(clazz, shape, bind):
+    """Returns the list of criteria for the given shape of a search.
+    `bind` is called with the field and operator of each condition but
+    "isnull" and returns the value or bind parameter to compare with."""
+    criteria = []
+    try:
+        for group in shape:
+            conditions = []
+            for key, operator, flag in group:
+                field = get_field(clazz, key)
+                if operator == "isnull":
+                    conditions.append(_compare(field, operator, flag))
+                else:
+                    conditions.append(_compare(field, operator,
+                                               bind(field, operator)))
+            if len(conditions) == 1:
+                criteria.append(conditions[0])
+            else:
+                criteria.append(sa.or_(*conditions))
+    except AttributeError:
+        # Key in search filter is not existing
+        raise ClientError("One of the fields in search filter is invalid")
+    return criteria
+
+
+def parse_search(clazz, search):
+    """Returns a list of filter criteria for the given search string."""
+    shape, values = _split_search(search)
+    values = iter(values)
+    try:
+        return _build_criteria(clazz, shape, lambda field, operator:
+                               _bind_value(field, operator, next(values)))
+    except (ValueError, ArithmeticError):
+        raise ClientError("Can not parse search filter")
+
+
+def parse_sort(clazz, sort):
+    """Returns a list of (key, field, descending) tuples for the given
+    sort string."""
+    keys = []
+    if sort != "":
+        try:
+            for key in sort.split("|"):
+                if key.startswith("-"):
+                    key = key.strip("-")
+                    keys.append((key, get_field(clazz, key), True))
+                else:
+                    key = key.strip("+")
+                    keys.append((key, get_field(clazz, key), False))
+        except AttributeError:
+            # Key in search filter is not existing
+            raise ClientError("One of the fields in sort definition is invalid")
+    return keys
+
+
+def parse_fields(clazz, fields):
+    """Returns a list of (key, field) tuples for the given fields. The
+    fields are either given as list or as string separated by "|"."""
+    try:
+        return [(key, get_field(clazz, key)) for key in split_fields(fields)]
+    except AttributeError:
+        # Key in fields definition is not existing
+        raise ClientError("One of the fields in fields definition is invalid")
+
+
+def _load_option(option, relation):
+    """Returns the loader option for `relation` chained to `option`."""
+    collection = relation.property.uselist
+    if option is None:
+        return (sa.orm.selectinload(relation) if collection
+                else sa.orm.joinedload(relation))
+    return (option.selectinload(relation) if collection
+            else option.joinedload(relation))
+
+
+def parse_include(clazz, include):
+    """Returns a list of loader options for the relations in the given
+    include definition. The relations are either given as list or as
+    string separated by "|"."""
+    options = []
+    if not include:
+        return options
+    if isinstance(include, str):
+        include = include.split("|")
+    for path in include:
+        option = None
+        current = clazz
+        for key in path.split("."):
+            relations = sa.inspect(current).relationships
+            if key not in relations:
+                # Key in include definition is not existing
+                raise ClientError("One of the relations in include "
+                                  "definition is invalid")
+            option = _load_option(option, getattr(current, key))
+            current = relations[key].mapper.class_
+        options.append(option)
+    return options
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return ["datetime", value.isoformat()]
+    if isinstance(value, date):
+        return ["date", value.isoformat()]
+    if isinstance(value, time):
+        return ["time", value.isoformat()]
+    if isinstance(value, uuid.UUID):
+        return ["uuid", str(value)]
+    if isinstance(value, Decimal):
+        return ["decimal", str(value)]
+    if isinstance(value, bytes):
+        return ["bytes", base64.b64encode(value).decode("ascii")]
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, list):
+        kind, value = value
+        if kind == "datetime":
+            value = _parse_datetime(value)
+        elif kind == "date":
+            value = _parse_datetime(value).date()
+        elif kind == "time":
+            value = _parse_datetime(value, TIME_FORMATS).time()
+        elif kind == "uuid":
+            value = uuid.UUID(value)
+        elif kind == "decimal":
+            value = Decimal(value)
+        elif kind == "bytes":
+            value = base64.b64decode(value.encode("ascii"), validate=True)
+        else:
+            raise ValueError("Unknown type {}".format(kind))
+    return value
+
+
+def _encode_cursor(sort, values):
+    """Returns an opaque continuation token for the given sort string
+    and the values of the sort keys of the last item on a page."""
+    try:
+        data = json.dumps([sort, [_encode_value(value) for value in values]])
+    except (TypeError, ValueError):
+        raise ClientError("Sort keys can not be used with a cursor")
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor, sort):
+    """Returns the values of the sort keys stored in the continuation
+    token `cursor`. The token must have been created for the same sort
+    string."""
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        cursor_sort, values = json.loads(data.decode("utf-8"))
+        values = [_decode_value(value) for value in values]
+    except (TypeError, ValueError, UnicodeError, ArithmeticError):
+        raise ClientError("Can not parse cursor")
+    if cursor_sort != sort:
+        raise ClientError("Cursor does not match sort definition")
+    return values
+
+
+def _seek(statement, keys):
+    """Returns `statement` filtered to the items following the item with
+    the values bound to the parameters "s0", "s1", ... for the sort
+    `keys`. If all keys are sorted in the same direction a row value
+    comparison is used which can be answered by a single index range
+    scan."""
+    fields = [field for key, field, descending in keys]
+    values = [sa.bindparam("s{}".format(idx), type_=field.type)
+              for idx, field in enumerate(fields)]
+    directions = set(descending for key, field, descending in keys)
+    if len(directions) == 1:
+        if directions.pop():
+            return statement.where(sa.tuple_(*fields) < sa.tuple_(*values))
+        return statement.where(sa.tuple_(*fields) > sa.tuple_(*values))
+    clauses = []
+    for idx, (key, field, descending) in enumerate(keys):
+        equal = [fields[i] == values[i] for i in range(idx)]
+        if descending:
+            clauses.append(sa.and_(*(equal + [field < values[idx]])))
+        else:
+            clauses.append(sa.and_(*(equal + [field > values[idx]])))
+    return statement.where(sa.or_(*clauses))
+
+
+def _prepare_search(clazz, shape, sort, fields, mode):
+    """Returns the select statement for a search of the given shape.
+    Values of the conditions, paging and the cursor are replaced by bind
+    parameters.
+
+    :returns: Tuple of the statement, the list of (name, field,
+        operator) tuples of the parameters for the conditions and the
+        list of sort keys.
+    """
+    binders = []
+
+    def bind(field, operator):
+        name = "p{}".format(len(binders))
+        binders.append((name, field, operator))
+        if operator == "prefix" and _is_text(field):
+            return (sa.bindparam(name), sa.bindparam(name + "_next"),
+                    sa.bindparam(name + "_like"))
+        return sa.bindparam(name, expanding=(operator == "in"))
+
+    keys = parse_sort(clazz, sort)
+    if mode in ("first", "seek") and "id" not in [key for key, _, _ in keys]:
+        keys.append(("id", clazz.id, keys[-1][2] if keys else False))
+
+    if mode == "count":
+        statement = sa.select(sa.func.count()).select_from(clazz)
+    elif fields is None:
+        statement = sa.select(clazz)
+    else:
+        # Columns needed to build the cursor are selected as well.
+        columns = [key for key, _ in parse_fields(clazz, fields)]
+        for key, _, _ in keys:
+            if key not in columns:
+                columns.append(key)
+        statement = sa.select(*[getattr(clazz, key).label(key)
+                                for key in columns])
+
+    # Handle search filters.
+    for criterion in _build_criteria(clazz, shape, bind):
+        statement = statement.where(criterion)
+
+    # Handle sort and ordering.
+    for key, field, descending in keys:
+        if descending:
+            statement = statement.order_by(sa.desc(field))
+        else:
+            statement = statement.order_by(field)
+
+    if mode == "seek":
+        statement = _seek(statement, keys)
+    if mode == "slice":
+        statement = statement.offset(sa.bindparam("_offset", type_=sa.Integer))
+    if mode not in ("all", "count"):
+        statement = statement.limit(sa.bindparam("_limit", type_=sa.Integer))
+    return statement, binders, keys
+
+
+def _prepared(clazz, shape, sort, fields, mode):
+    """Returns the prepared statement from :func:`_prepare_search` for
+    the given arguments from the cache."""
+    cache_key = (clazz, shape, sort, fields, mode)
+    prepared = STATEMENTS.get(cache_key)
+    if prepared is None:
+        prepared = _prepare_search(clazz, shape, sort, fields, mode)
+        STATEMENTS.set(cache_key, prepared)
+    return prepared
+
+
+def _bind_params(binders, values):
+    """Returns the parameters for the conditions of a prepared
+    statement."""
+    params = {}
+    try:
+        for (name, field, operator), value in zip(binders, values):
+            value = _bind_value(field, operator, value)
+            if isinstance(value, tuple):
+                (params[name], params[name + "_next"],
+                 params[name + "_like"]) = value
+            else:
+                params[name] = value
+    except (ValueError, ArithmeticError):
+        raise ClientError("Can not parse search filter")
+    return params
+
+
+def build_search(clazz, limit, offset, search, sort, cursor, fields=None):
+    """Returns the select statement and its parameters for the given
+    search. The statements are cached by class, shape of the search
+    filter, sort definition, fields and paging mode. Only the values
+    of the conditions, paging and cursor differ between calls.
+
+    :clazz: Class of which the instances should be loaded.
+    :limit: Limit number of result to N entries or None for all
+    :offset: Return entries with an offset of N
+    :search: Define search filters
+    :sort: Define sort and ordering
+    :cursor: Continuation token for keyset pagination or None
+    :fields: Tuple of fieldnames which should be selected or None
+    :returns: Tuple of the statement, the dictionary of parameters and
+        the list of sort keys.
+    """
+    shape, values = _split_search(search)
+    if limit is None:
+        mode = "all"
+    elif cursor is None:
+        mode = "slice"
+    elif cursor == "":
+        mode = "first"
+    else:
+        mode = "seek"
+    statement, binders, keys = _prepared(clazz, shape, sort, fields, mode)
+    params = _bind_params(binders, values)
+    if mode == "slice":
+        # Same semantics as Query.slice(offset, limit).
+        params["_offset"] = offset
+        params["_limit"] = max(limit - offset, 0)
+    elif mode != "all":
+        params["_limit"] = limit
+    if mode == "seek":
+        values = _decode_cursor(cursor, sort)
+        if len(values) != len(keys):
+            raise ClientError("Cursor does not match sort definition")
+        for idx, value in enumerate(values):
+            params["s{}".format(idx)] = value
+    return statement, params, keys
+
+
+def build_count(clazz, search):
+    """Returns the select statement and its parameters to count the
+    items matching the given search. The statements are cached like the
+    statements of :func:`build_search`.
+
+    :clazz: Class of which the instances should be counted.
+    :search: Define search filters
+    :returns: Tuple of the statement and the dictionary of parameters.
+    """
+    shape, values = _split_search(search)
+    statement, binders, keys = _prepared(clazz, shape, "", None, "count")
+    return statement, _bind_params(binders, values)
+
+
+def build_page(items, limit, sort, keys):
+    """Returns a :class:`Page` of `items` with the continuation token
+    for the next page in keyset mode."""
+    page = Page(items)
+    if len(page) == limit:
+        values = [getattr(page[-1], key) for key, _, _ in keys]
+        page.cursor = _encode_cursor(sort, values)
+    return page
+
+
+def split_fields(fields):
+    """Returns the given fields as tuple. The fields are either given
+    as list or as string separated by "|"."""
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split("|")
+    return tuple(fields)
+
+
+def search_cache_stats():
+    """Returns a dictionary with the hit, miss and eviction counters of
+    the cache of prepared search statements."""
+    return STATEMENTS.stats()
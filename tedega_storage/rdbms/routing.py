@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Routing of read-only statements to replicas of the database.
+
+Replicas are engines configured like any other engine. They are assigned
+to the primary engine with the `replicas` setting::
+
+    configure_engine("replica1", "postgresql://replica1/db")
+    configure_engine("replica2", "postgresql://replica2/db")
+    configure_engine(uri="postgresql://primary/db",
+                     replicas=["replica1", "replica2"],
+                     replica_strategy="least_connections")
+
+or with `TEDEGA_STORAGE_REPLICAS=replica1,replica2` in the environment.
+
+Sessions of an engine with replicas send SELECT statements to one of the
+replicas. All other statements and flushes go to the primary. Once a
+session has written or has pending changes all further statements of
+the session go to the primary too, so the changes of a storage are
+visible within the same storage. Operations which write based on read
+items, e.g `crud.update`, switch the session to the primary before they
+read. The replica is chosen once per session
+either round-robin ("round_robin") or by the lowest number of checked
+out connections ("least_connections").
+"""
+import itertools
+import threading
+import weakref
+from sqlalchemy import event, orm
+from tedega_storage.rdbms.engine import (
+    get_engine,
+    get_engine_name,
+    get_settings
+)
+
+STRATEGIES = ("round_robin", "least_connections")
+"""Supported strategies to choose a replica."""
+
+CONNECTIONS = weakref.WeakKeyDictionary()
+"""Number of checked out connections by engine. Only tracked for the
+replicas of routers using the "least_connections" strategy."""
+_lock = threading.Lock()
+
+
+def _count_checkout(engine):
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["tedega_storage_counted"] = True
+        with _lock:
+            CONNECTIONS[engine] += 1
+    return checkout
+
+
+def _count_checkin(engine):
+    def checkin(dbapi_connection, connection_record):
+        # Connections checked out before the tracking started are not
+        # counted.
+        if connection_record.info.pop("tedega_storage_counted", False):
+            with _lock:
+                CONNECTIONS[engine] -= 1
+    return checkin
+
+
+def track_connections(engine):
+    """Will count the checked out connections of `engine` in
+    :data:`CONNECTIONS`."""
+    with _lock:
+        if engine in CONNECTIONS:
+            return
+        CONNECTIONS[engine] = 0
+    event.listen(engine, "checkout", _count_checkout(engine))
+    event.listen(engine, "checkin", _count_checkin(engine))
+
+
+class Router(object):
+    """Chooses the engine for the sessions of a primary engine.
+
+    :primary: Engine for writes.
+    :replicas: List of engines for reads.
+    :strategy: Name of the strategy to choose a replica. See
+        :data:`STRATEGIES`.
+    """
+
+    def __init__(self, primary, replicas, strategy="round_robin"):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unsupported replica strategy {}".format(
+                strategy))
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self._cycle = itertools.cycle(self.replicas)
+        self._lock = threading.Lock()
+        if strategy == "least_connections":
+            for replica in self.replicas:
+                track_connections(replica)
+
+    def replica(self):
+        """Returns the engine of the replica which should be used for a
+        new session or the primary if there are no replicas."""
+        if not self.replicas:
+            return self.primary
+        if self.strategy == "least_connections":
+            return min(self.replicas, key=lambda engine: CONNECTIONS[engine])
+        with self._lock:
+            return next(self._cycle)
+
+
+def get_router(engine):
+    """Returns a :class:`Router` for the given `engine` if replicas are
+    configured for it. Else None is returned.
+
+    :engine: Primary engine.
+    :returns: :class:`Router` or None
+    """
+    name = get_engine_name(engine)
+    if name is None:
+        return None
+    settings = get_settings(name)
+    if not settings.get("replicas"):
+        return None
+    return Router(engine, [get_engine(replica)
+                           for replica in settings["replicas"]],
+                  settings.get("replica_strategy", "round_robin"))
+
+
+def _is_read(clause):
+    """Returns True if `clause` is a SELECT without FOR UPDATE."""
+    return (getattr(clause, "is_select", False) and
+            getattr(clause, "_for_update_arg", None) is None)
+
+
+class RoutingSession(orm.Session):
+    """Session which sends read-only statements to a replica. Set
+    `use_primary` to True to send all statements to the primary.
+
+    :router: :class:`Router` of the primary engine.
+    """
+
+    def __init__(self, router=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.router = router
+        self.use_primary = False
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.router is None:
+            return super(RoutingSession, self).get_bind(mapper, clause,
+                                                        **kwargs)
+        if not self.use_primary:
+            if (self._flushing or not _is_read(clause) or
+                    self._new or self._deleted or
+                    self.identity_map.check_modified()):
+                self.use_primary = True
+        if self.use_primary:
+            return self.router.primary
+        if self._replica is None:
+            self._replica = self.router.replica()
+        return self._replica
+
+    def to_primary(self):
+        """Will send all further statements to the primary. Items which
+        were read from a replica and are not modified are expired, so
+        they are read again from the primary on next access."""
+        if self.use_primary:
+            return
+        self.use_primary = True
+        replica = self._replica
+        if replica is not None and replica is not self.router.primary:
+            for item in list(self.identity_map.values()):
+                if not orm.attributes.instance_state(item).modified:
+                    self.expire(item)
+
+    def close(self):
+        super(RoutingSession, self).close()
+        self.use_primary = False
+        self._replica = None
@@ -1,65 +1,294 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
+import threading
+import uuid
+import weakref
 from contextlib import contextmanager
+import sqlalchemy as sa
+from sqlalchemy import orm
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.event import listen
-from sqlalchemy import create_engine
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm.util import identity_key
+from tedega_storage.rdbms.cache import get_cache
+from tedega_storage.rdbms.detector import get_detector
+from tedega_storage.rdbms.engine import DEFAULT_ENGINE, get_engine
+from tedega_storage.rdbms.routing import RoutingSession, get_router
+# Kept importable from this module for backwards compatibility.
+from tedega_storage.rdbms.engine import (  # noqa
+    ENGINE,
+    sqlite_do_connect,
+    sqlite_do_begin
+)
+
+BULK_CHUNK_SIZE = 500
+"""Default number of rows per statement used for bulk operations."""
+STREAM_BATCH_SIZE = 1000
+"""Default number of rows fetched at once when streaming items."""
+TRANSACTIONS = ("savepoint", "flush", "deferred")
+"""Supported transaction strategies of :class:`Storage`. "savepoint"
+wraps every create in a SAVEPOINT and flushes on update, "flush" only
+flushes the session and "deferred" leaves all writes to the commit on
+exit of the storage."""
+
+try:
+    import contextvars
+    _context = contextvars.ContextVar("tedega_storage_session_scope")
+except ImportError:  # pragma: no cover
+    contextvars = None
+
+SESSIONMAKERS = weakref.WeakKeyDictionary()
+"""Cached session factories by engine."""
+SCOPED_SESSIONS = weakref.WeakKeyDictionary()
+"""Cached scoped session registries by engine and scope."""
+SCOPE_USERS = "tedega_storage_scope_users"
+"""Key of the number of users of a scoped session in its info."""
+ROLLBACK_ONLY = "tedega_storage_rollback_only"
+"""Key of the flag in the info of a scoped session which is set if an
+inner user failed."""
+_lock = threading.Lock()
+
+
+def context_scope():
+    """Scope function for scoped sessions which returns a token unique
+    for the current context (see :mod:`contextvars`). The token is
+    created on first use in a context and inherited by contexts copied
+    from it afterwards."""
+    token = _context.get(None)
+    if token is None:
+        token = object()
+        _context.set(token)
+    return token
+
+
+SCOPES = {
+    "thread": None,
+    "context": context_scope
+}
+"""Supported scopes for scoped sessions and their scope functions. A
+scope function of None means thread local."""
+
+
+def get_sessionmaker(engine):
+    """Returns the session factory for the given `engine`. The factory
+    is only created once per engine. If replicas are configured for the
+    engine the sessions route reads to the replicas. See
+    :mod:`tedega_storage.rdbms.routing`.
+
+    :engine: Engine the sessions are bound to.
+    :returns: Session factory
+    """
+    factory = SESSIONMAKERS.get(engine)
+    if factory is None:
+        with _lock:
+            factory = SESSIONMAKERS.get(engine)
+            if factory is None:
+                router = get_router(engine)
+                if router is None:
+                    factory = sessionmaker(bind=engine)
+                else:
+                    factory = sessionmaker(bind=engine, class_=RoutingSession,
+                                           router=router)
+                SESSIONMAKERS[engine] = factory
+    return factory
+
+
+def get_scoped_session(engine, scope="thread"):
+    """Returns the scoped session registry of the given `engine` for
+    the given `scope`. Calling the registry returns the same session
+    within a thread ("thread") or a context of :mod:`contextvars`
+    ("context") until `remove()` is called on the registry.
+
+    :engine: Engine the sessions are bound to.
+    :scope: Name of the scope. See :data:`SCOPES`.
+    :returns: :class:`sqlalchemy.orm.scoped_session`
+    """
+    if scope not in SCOPES or (scope == "context" and contextvars is None):
+        raise ValueError("Unsupported session scope {}".format(scope))
+    registries = SCOPED_SESSIONS.get(engine)
+    if registries is None or scope not in registries:
+        # Created outside of the lock as get_sessionmaker takes it too.
+        factory = get_sessionmaker(engine)
+        with _lock:
+            registries = SCOPED_SESSIONS.setdefault(engine, {})
+            if scope not in registries:
+                registries[scope] = orm.scoped_session(
+                    factory, scopefunc=SCOPES[scope])
+    return registries[scope]
+
+
+def get_session(engine, scope=None):
+    """Returns a new session for the given `engine` or the session of
+    the current `scope` if a scope is given. Sessions of a scope must
+    be handed back with :func:`release_session`.
+
+    :engine: Engine the session is bound to.
+    :scope: Name of the scope or None.
+    :returns: Session
+    """
+    if scope is None:
+        return get_sessionmaker(engine)()
+    session = get_scoped_session(engine, scope)()
+    session.info[SCOPE_USERS] = session.info.get(SCOPE_USERS, 0) + 1
+    return session
+
+
+def release_session(engine, scope, session, failed=False):
+    """Will hand back a session returned by :func:`get_session`. Only
+    the outermost user of a scoped session ends the transaction: inner
+    users flush their changes or, if they `failed`, mark the transaction
+    for rollback. The outermost user commits the transaction, or rolls
+    it back if it or an inner user failed, and closes the session. The
+    session of a "context" scope is then removed from the registry, as
+    every context gets a new session which would otherwise be kept
+    forever.
+
+    :engine: Engine the session is bound to.
+    :scope: Name of the scope or None.
+    :session: Session
+    :failed: True if the user ends with an exception.
+    """
+    if scope is not None:
+        users = session.info.get(SCOPE_USERS, 1) - 1
+        session.info[SCOPE_USERS] = users
+        if users > 0:
+            if failed:
+                session.info[ROLLBACK_ONLY] = True
+                return
+            try:
+                session.flush()
+            except:
+                session.info[ROLLBACK_ONLY] = True
+                raise
+            return
+    try:
+        if failed or session.info.pop(ROLLBACK_ONLY, False):
+            session.rollback()
+        else:
+            session.commit()
+    finally:
+        session.close()
+        if scope == "context":
+            get_scoped_session(engine, scope).remove()
 
 
 @contextmanager
-def scoped_session():
-    Session = sessionmaker(bind=ENGINE)
-    session = Session()
+def scoped_session(name=DEFAULT_ENGINE, scope=None):
+    engine = get_engine(name)
+    session = get_session(engine, scope)
     try:
         yield session
-        session.commit()
     except:
-        session.rollback()
+        release_session(engine, scope, session, failed=True)
         raise
-    finally:
-        session.close()
+    release_session(engine, scope, session)
+
+
+def _chunks(items, size):
+    """Will yield successive slices of `items` with at most `size`
+    elements."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _sqlite_upsert(dialect):
+    """Returns True if the SQLite library supports INSERT ... ON
+    CONFLICT DO UPDATE (SQLite 3.24)."""
+    version = getattr(dialect.dbapi, "sqlite_version_info", (0,))
+    return tuple(version) >= (3, 24, 0)
+
 
+def _version_column(clazz):
+    """Returns the version column of `clazz` (see
+    :class:`mixins.Versioned`) or None."""
+    return sa.inspect(clazz).version_id_col
 
-def sqlite_do_connect(dbapi_connection, connection_record):
-    # disable pysqlite's emitting of the BEGIN statement entirely.
-    # also stops it from emitting COMMIT before any DDL.
-    dbapi_connection.isolation_level = None
 
+def _upsert_set(update, new, version):
+    """Returns the SET clause of an upsert which takes the columns in
+    `update` from the `new` row and increments the `version` column if
+    given."""
+    set_ = dict((key, new[key]) for key in update)
+    if version is not None:
+        set_[version.key] = version + 1
+    return set_
 
-def sqlite_do_begin(conn):
-    # emit our own BEGIN
-    conn.execute("BEGIN")
-    return ENGINE
+
+def _columns(clazz):
+    """Returns a dictionary mapping the attribute keys of the mapped
+    columns of `clazz` to the keys of the columns in the table."""
+    mapper = sa.inspect(clazz)
+    return dict((prop.key, prop.columns[0].key)
+                for prop in mapper.column_attrs)
 
 
 class Storage(object):
     """Docstring for Storage. """
 
-    def __init__(self, engine=None):
+    def __init__(self, engine=None, scope=None, cache=None,
+                 transaction="savepoint", detector=None):
         """TODO: to be defined1.
 
         :engine: TODO
+        :scope: Name of the scope of the session. If given the storage
+            uses the session of the current thread or context instead
+            of a new one. See :func:`get_scoped_session`.
+        :cache: :class:`IdentityCache` used to read items by id.
+            Defaults to the configured cache.
+        :transaction: Transaction strategy for writes. See
+            :data:`TRANSACTIONS`. "savepoint" keeps a failed create from
+            spoiling the outer transaction at the cost of a SAVEPOINT per
+            insert. "flush" and "deferred" skip the SAVEPOINT; an error
+            then rolls back the whole transaction. With "deferred" the
+            ids of created items are only set once the session flushes.
+        :detector: :class:`QueryDetector` which counts the statements of
+            the storage. Defaults to the active detector.
 
         """
+        if transaction not in TRANSACTIONS:
+            raise ValueError("Unsupported transaction strategy {}".format(
+                transaction))
         self.engine = engine
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        self.scope = scope if engine is not None else None
+        self.transaction = transaction
+        self.cache = cache if cache is not None else get_cache()
+        if engine is None:
+            self.session = sessionmaker()()
+        else:
+            self.session = get_session(engine, scope)
+        self.detector = detector if detector is not None else get_detector()
+        if self.detector is not None:
+            self.detector.attach(self.session)
 
     def __enter__(self):
         return self
 
     def __exit__(self, e_type, e_value, tb):
-        if e_type is not None:
-            self.session.rollback()
-            raise
-        else:
-            self.session.commit()
-        self.session.close()
-        return True
+        try:
+            release_session(self.engine, self.scope, self.session,
+                            failed=e_type is not None)
+        finally:
+            if self.detector is not None:
+                self.detector.detach(self.session)
+        return False
+
+    def use_primary(self):
+        """Will send all further statements of the storage to the
+        primary database if replicas are configured. Must be called
+        before reading items which are changed afterwards, so the
+        changes are not based on a lagging replica. See
+        :mod:`tedega_storage.rdbms.routing`."""
+        if isinstance(self.session, RoutingSession):
+            self.session.to_primary()
 
     def create(self, item):
+        if self.transaction == "deferred":
+            self.session.add(item)
+            return item.id
+        if self.transaction == "flush":
+            self.session.add(item)
+            self.session.flush()
+            return item.id
         item_id = None
         self.session.begin_nested()
         try:
@@ -71,27 +300,386 @@ class Storage(object):
             raise
         return item_id
 
-    def read(self, clazz, id=None):
+    def read(self, clazz, id=None, options=None):
         if id is None:
             return self.session.query(clazz).all()
-        else:
-            return self.session.query(clazz).filter(clazz.id == id).one()
+        if options:
+            # Loader options are ignored by Session.get for already
+            # loaded items, the query fills their unloaded relations.
+            item = self.session.execute(
+                sa.select(clazz).where(clazz.id == id).options(*options)
+            ).unique().scalar_one_or_none()
+            if item is None:
+                raise NoResultFound()
+            return item
+        cached = self.cache is not None and self.cache.caches(clazz)
+        if cached:
+            item = self.cache.get(self.session, clazz, id)
+            if item is not None:
+                return item
+        # Session.get returns already loaded items from the identity map
+        # and uses a cached statement for the primary key lookup.
+        item = self.session.get(clazz, id)
+        if item is None:
+            raise NoResultFound()
+        if cached:
+            self.cache.set(item)
+        return item
+
+    def read_by_uuid(self, clazz, item_uuid):
+        """Will return the item of `clazz` with the given `item_uuid`
+        using the unique index on the uuid column.
+
+        A NoResultFound exception is raised if there is no such item.
+
+        :clazz: Class of the item.
+        :item_uuid: UUID of the item.
+        :returns: Instance of clazz
+        """
+        item = self.session.execute(
+            sa.select(clazz).where(clazz.uuid == item_uuid)).scalar_one()
+        if self.cache is not None and self.cache.caches(clazz):
+            self.cache.set(item)
+        return item
+
+    def stream(self, clazz, batch_size=STREAM_BATCH_SIZE, query=None,
+               params=None):
+        """Will yield all items of `clazz` or all items of the given
+        `query` while fetching only `batch_size` rows at once. A server
+        side cursor is used if the dialect supports it, so memory stays
+        bounded independent of the size of the result. The generator
+        must be consumed before the storage is closed.
+
+        :clazz: Class of the items.
+        :batch_size: Number of rows fetched at once.
+        :query: Optional select statement for items of `clazz`.
+        :params: Optional parameters for the statement.
+        :returns: Generator of items.
+        """
+        if query is None:
+            query = sa.select(clazz)
+        query = query.execution_options(stream_results=True,
+                                        yield_per=batch_size)
+        for item in self.session.execute(query, params or {}).scalars():
+            yield item
+
+    def read_many(self, clazz, ids, chunk_size=BULK_CHUNK_SIZE):
+        """Will return the items of `clazz` with the given `ids`. Items
+        which are already loaded in the session or cached are taken
+        from there. All other items are loaded with one
+        SELECT ... WHERE id IN (...) per chunk.
+
+        A NoResultFound exception is raised if not all items were found.
+
+        :clazz: Class of the items.
+        :ids: List of ids of the items.
+        :chunk_size: Maximum number of ids per statement.
+        :returns: List of items in the order of the given ids.
+        """
+        cached = self.cache is not None and self.cache.caches(clazz)
+        items = {}
+        missing = []
+        for item_id in ids:
+            if item_id in items:
+                continue
+            if cached:
+                item = self.cache.get(self.session, clazz, item_id)
+            else:
+                item = self.session.identity_map.get(
+                    identity_key(clazz, item_id))
+            if item is None or sa.inspect(item).expired:
+                missing.append(item_id)
+            else:
+                items[item_id] = item
+        for chunk in _chunks(missing, chunk_size):
+            for item in self.session.query(clazz).filter(clazz.id.in_(chunk)):
+                items[item.id] = item
+                if cached:
+                    self.cache.set(item)
+        if len(items) < len(set(ids)):
+            raise NoResultFound()
+        return [items[item_id] for item_id in ids]
 
     def update(self, item):
+        # Items without net changes would only emit the UPDATE of the
+        # 'before_update' listeners.
+        if (self.transaction == "deferred" or
+                not self.session.is_modified(item)):
+            return None
         return self.session.flush()
 
     def delete(self, item):
         self.session.delete(item)
 
+    def bulk_create(self, clazz, items, chunk_size=BULK_CHUNK_SIZE):
+        """Will insert all `items` of `clazz` with one executemany
+        INSERT per chunk. Unlike :meth:`create` no SAVEPOINT is used
+        and the items are not added to the session. The generated ids
+        are fetched afterwards with one query per chunk using the unique
+        uuid of the items.
+
+        :clazz: Class of the items.
+        :items: List of instances of clazz.
+        :chunk_size: Maximum number of rows per statement.
+        :returns: List of ids in the order of the given items.
+        """
+        table = clazz.__table__
+        columns = [(key, column) for key, column in _columns(clazz).items()
+                   if not table.c[column].primary_key]
+        ids = {}
+        for chunk in _chunks(items, chunk_size):
+            rows = []
+            for item in chunk:
+                if item.uuid is None:
+                    item.uuid = uuid.uuid4()
+                rows.append(dict((column, getattr(item, key))
+                                 for key, column in columns))
+            self.session.execute(table.insert(), rows)
+            query = sa.select([table.c.id, table.c.uuid]).where(
+                table.c.uuid.in_([item.uuid for item in chunk]))
+            for row in self.session.execute(query):
+                ids[str(row.uuid)] = row.id
+        return [ids[str(item.uuid)] for item in items]
+
+    def bulk_update(self, clazz, values, chunk_size=BULK_CHUNK_SIZE):
+        """Will update the rows of `clazz` with one executemany UPDATE
+        per chunk and set of changed fields. Each dictionary in `values`
+        must contain the `id` of the row which should be updated. Loaded
+        instances in the session are expired.
+
+        A NoResultFound exception is raised if the database reports less
+        matched rows than given. The version of versioned items is
+        incremented.
+
+        :clazz: Class of the items.
+        :values: List of dictionaries with the new values.
+        :chunk_size: Maximum number of rows per statement.
+        :returns: List of ids in the order of the given values.
+        """
+        table = clazz.__table__
+        columns = _columns(clazz)
+        statement = table.update().where(table.c.id == sa.bindparam("_id"))
+        version = _version_column(clazz)
+        if version is not None:
+            statement = statement.values({version.key: version + 1})
+        matched = 0
+        for chunk in _chunks(values, chunk_size):
+            groups = {}
+            for row in chunk:
+                params = dict((columns[key], value)
+                              for key, value in row.items() if key != "id")
+                params["_id"] = row["id"]
+                groups.setdefault(tuple(sorted(params)), []).append(params)
+            for params in groups.values():
+                result = self.session.execute(statement, params)
+                matched += result.rowcount
+        ids = [row["id"] for row in values]
+        self._expire(clazz, ids)
+        if (self.session.get_bind().dialect.supports_sane_multi_rowcount and
+                matched < len(values)):
+            raise NoResultFound()
+        return ids
+
+    def bulk_delete(self, clazz, ids, chunk_size=BULK_CHUNK_SIZE):
+        """Will delete the rows of `clazz` with the given `ids` using one
+        DELETE ... WHERE id IN (...) per chunk. Loaded instances are
+        removed from the session.
+
+        A NoResultFound exception is raised if not all rows were found.
+
+        :clazz: Class of the items.
+        :ids: List of ids of the rows which should be deleted.
+        :chunk_size: Maximum number of ids per statement.
+        :returns: List of deleted ids in the given order.
+        """
+        table = clazz.__table__
+        deleted = 0
+        for chunk in _chunks(ids, chunk_size):
+            result = self.session.execute(
+                table.delete().where(table.c.id.in_(chunk)))
+            deleted += result.rowcount
+        for item_id in ids:
+            item = self.session.identity_map.get(identity_key(clazz, item_id))
+            if item is not None:
+                self.session.expunge(item)
+            if self.cache is not None:
+                self.cache.invalidate(clazz, item_id)
+        if deleted < len(set(ids)):
+            raise NoResultFound()
+        return list(ids)
+
+    def update_where(self, clazz, criteria, values):
+        """Will update all rows of `clazz` matching the given `criteria`
+        with one UPDATE statement without loading them. ORM events like
+        'before_update' are not triggered. Loaded instances of `clazz`
+        are expired and all items of `clazz` are removed from the cache.
+
+        :clazz: Class of the items.
+        :criteria: List of filter criteria.
+        :values: Dictionary with the new values.
+        :returns: Number of matched rows.
+        """
+        statement = sa.update(clazz).where(*criteria).values(values)
+        result = self.session.execute(
+            statement, execution_options={"synchronize_session": False})
+        self._expire_class(clazz)
+        return result.rowcount
+
+    def delete_where(self, clazz, criteria):
+        """Will delete all rows of `clazz` matching the given `criteria`
+        with one DELETE statement without loading them. Loaded instances
+        of `clazz` are expired and raise an ObjectDeletedError on access
+        if they were deleted. All items of `clazz` are removed from the
+        cache.
+
+        :clazz: Class of the items.
+        :criteria: List of filter criteria.
+        :returns: Number of deleted rows.
+        """
+        statement = sa.delete(clazz).where(*criteria)
+        result = self.session.execute(
+            statement, execution_options={"synchronize_session": False})
+        self._expire_class(clazz)
+        return result.rowcount
+
+    def bulk_upsert(self, clazz, rows, keys, chunk_size=BULK_CHUNK_SIZE):
+        """Will insert the `rows` of `clazz` or update the existing rows
+        with the same uuid. Existing rows get the values of the given
+        `keys` only. The native upsert of the dialect is used: INSERT
+        ... ON CONFLICT on PostgreSQL and SQLite and INSERT ... ON
+        DUPLICATE KEY UPDATE on MySQL. On PostgreSQL each chunk takes one
+        statement which also returns the ids. On other databases the
+        existing uuids are selected before and the ids of the created
+        rows after the upsert. Databases without an upsert get an UPDATE
+        and an INSERT per chunk instead. Loaded instances of updated rows
+        are expired. The version of versioned items is incremented in
+        existing rows if `keys` are given.
+
+        :clazz: Class of the items.
+        :rows: List of dictionaries with the values of all columns of
+            the new rows. The uuids must be unique.
+        :keys: Keys of the values which are updated in existing rows.
+        :chunk_size: Maximum number of rows per statement.
+        :returns: List of (id, created) tuples in the order of the rows.
+        """
+        table = clazz.__table__
+        columns = _columns(clazz)
+        uuid_column = table.c[columns["uuid"]]
+        update = [columns[key] for key in keys]
+        version = _version_column(clazz) if update else None
+        dialect = self.session.get_bind().dialect
+        result = []
+        updated = []
+        for chunk in _chunks(rows, chunk_size):
+            params = [dict((columns[key], value)
+                           for key, value in row.items()) for row in chunk]
+            uuids = [row["uuid"] for row in chunk]
+            if dialect.name == "postgresql":
+                ids = self._upsert_returning(table, uuid_column, update,
+                                             params, version)
+            else:
+                ids = self._upsert(table, uuid_column, update, params,
+                                   uuids, dialect, version)
+            for row in chunk:
+                item_id, created = ids[str(row["uuid"])]
+                result.append((item_id, created))
+                if not created:
+                    updated.append(item_id)
+        self._expire(clazz, updated)
+        return result
+
+    def _upsert_returning(self, table, uuid_column, update, params, version):
+        """Will upsert the rows of one chunk with a single INSERT ... ON
+        CONFLICT ... RETURNING statement on PostgreSQL. Rows inserted by
+        the statement have no xmax."""
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table).values(params)
+        # An empty SET is not allowed but needed to return the row.
+        set_ = _upsert_set(update or [uuid_column.key], statement.excluded,
+                           version)
+        statement = statement.on_conflict_do_update(
+            index_elements=[uuid_column], set_=set_
+        ).returning(table.c.id, uuid_column,
+                    sa.literal_column("xmax = 0").label("created"))
+        return dict((str(row[1]), (row[0], row[2]))
+                    for row in self.session.execute(statement))
+
+    def _upsert(self, table, uuid_column, update, params, uuids, dialect,
+                version):
+        """Will upsert the rows of one chunk with an executemany INSERT
+        ... ON CONFLICT (SQLite) or ON DUPLICATE KEY UPDATE (MySQL). The
+        ids of existing rows are selected before, the ids of the created
+        rows after the upsert."""
+        query = sa.select([table.c.id, uuid_column]).where(
+            uuid_column.in_(uuids))
+        ids = dict((str(row[1]), (row[0], False))
+                   for row in self.session.execute(query))
+        if dialect.name == "sqlite" and _sqlite_upsert(dialect):
+            from sqlalchemy.dialects.sqlite import insert
+            statement = insert(table)
+            if update:
+                statement = statement.on_conflict_do_update(
+                    index_elements=[uuid_column],
+                    set_=_upsert_set(update, statement.excluded, version))
+            else:
+                statement = statement.on_conflict_do_nothing(
+                    index_elements=[uuid_column])
+            self.session.execute(statement, params)
+        elif dialect.name == "mysql":
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(table)
+            if update:
+                statement = statement.on_duplicate_key_update(
+                    _upsert_set(update, statement.inserted, version))
+            else:
+                statement = statement.on_duplicate_key_update(
+                    {table.c.id.key: table.c.id})
+            self.session.execute(statement, params)
+        else:
+            existing = [row for row in params
+                        if str(row[uuid_column.key]) in ids]
+            if existing and update:
+                values = dict((key, sa.bindparam("_" + key))
+                              for key in update)
+                if version is not None:
+                    values[version.key] = version + 1
+                statement = table.update().where(
+                    uuid_column == sa.bindparam("_uuid")).values(values)
+                self.session.execute(statement, [
+                    dict([("_" + key, row[key]) for key in update] +
+                         [("_uuid", row[uuid_column.key])])
+                    for row in existing])
+            new = [row for row in params
+                   if str(row[uuid_column.key]) not in ids]
+            if new:
+                self.session.execute(table.insert(), new)
+        missing = [value for value in uuids if str(value) not in ids]
+        if missing:
+            query = sa.select([table.c.id, uuid_column]).where(
+                uuid_column.in_(missing))
+            for row in self.session.execute(query):
+                ids[str(row[1])] = (row[0], True)
+        return ids
+
+    def _expire_class(self, clazz):
+        """Expire all loaded instances of `clazz` and remove all items of
+        `clazz` from the cache."""
+        for item in list(self.session.identity_map.values()):
+            if isinstance(item, clazz):
+                self.session.expire(item)
+        if self.cache is not None:
+            self.cache.invalidate_class(clazz)
+
+    def _expire(self, clazz, ids):
+        """Expire already loaded instances of `clazz` with the given
+        `ids` so they are refreshed on next access and remove them from
+        the cache."""
+        for item_id in ids:
+            item = self.session.identity_map.get(identity_key(clazz, item_id))
+            if item is not None:
+                self.session.expire(item)
+            if self.cache is not None:
+                self.cache.invalidate(clazz, item_id)
+
 
-DEFAUL_DB_URI = "sqlite:///default.db"
-DB_URI = os.environ.get("TEDEGA_STORAGE_URI", DEFAUL_DB_URI)
-ENGINE = create_engine(DB_URI, echo=False)
-if str(ENGINE.url).find("sqlite") > -1:
-    #  SQLite doesn not support nested transactions directly.
-    #  But there is a workaround. See
-    #  http://docs.sqlalchemy.org/en/rel_1_0/dialects/sqlite.html#pysqlite-serializable
-    #  for more details.
-    listen(ENGINE, "connect", sqlite_do_connect)
-    listen(ENGINE, "begin", sqlite_do_begin)
 STORAGE = Storage
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Helpers for the tests of applications using the storage.
+
+The module is a pytest plugin. Enable it in the `conftest.py` of the
+application with::
+
+    pytest_plugins = ["tedega_storage.testing"]
+
+The `query_budget` fixture returns a function which activates a
+:class:`tedega_storage.rdbms.detector.QueryDetector` for all storages
+created in a `with` block. By default the test fails as soon as an
+operation executes the same statement twice::
+
+    def test_list(query_budget):
+        with query_budget(max_statements=3):
+            with get_storage() as storage:
+                get_values_many(search(storage, Item))
+"""
+import pytest
+from tedega_storage.rdbms.detector import QueryDetector
+
+
+@pytest.fixture()
+def query_budget():
+    def budget(max_statements=None, max_repeats=1, mode="raise"):
+        return QueryDetector(max_statements, max_repeats, mode)
+    return budget
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_aio
+----------------------------------
+
+Tests for `tedega_storage.rdbms.aio` module.
+"""
+import asyncio
+import uuid
+import pytest
+import sqlalchemy as sa
+from tedega_storage.rdbms import (
+    RDBMSStorageBase as Base,
+    BaseItem
+)
+from tedega_storage.rdbms.mixins import Protocol
+
+pytest.importorskip("aiosqlite")
+
+NEW_UUID = uuid.UUID("6b4b5e1c-3a2f-4d55-9f0a-2c1d8e7b9a10")
+
+
+class AsyncDummy(Protocol, BaseItem, Base):
+    """Dummy class"""
+    __tablename__ = "asyncdummys"
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+@pytest.fixture(scope='module')
+def asyncmodel(request):
+    from tedega_storage.rdbms.aio import init_storage
+    run(init_storage())
+
+
+def test_crud(asyncmodel):
+    from tedega_view import NotFound
+    from tedega_storage.rdbms.aio import get_storage
+    from tedega_storage.rdbms.aio.crud import (
+        create, read, update, delete, search
+    )
+
+    async def crud():
+        async with get_storage() as storage:
+            item = await create(storage, AsyncDummy, {})
+            assert item.id is not None
+            assert await read(storage, AsyncDummy, item.id) is item
+        async with get_storage() as storage:
+            item = await update(storage, AsyncDummy, item.id,
+                                {"uuid": NEW_UUID})
+            assert item.uuid == NEW_UUID
+            items = await search(storage, AsyncDummy,
+                                 search="uuid::{}".format(NEW_UUID))
+            assert [i.id for i in items] == [item.id]
+            page = await search(storage, AsyncDummy, limit=1, sort="-id",
+                                cursor="")
+            assert page.cursor is not None
+        async with get_storage() as storage:
+            await delete(storage, AsyncDummy, item.id)
+        async with get_storage() as storage:
+            with pytest.raises(NotFound):
+                await read(storage, AsyncDummy, item.id)
+    run(crud())
+
+
+def test_scoped_session(asyncmodel):
+    from tedega_storage.rdbms.aio import scoped_session
+
+    async def execute(statement):
+        async with scoped_session() as session:
+            await session.execute(sa.text(statement))
+    run(execute("SELECT * from asyncdummys"))
+    with pytest.raises(Exception):
+        run(execute("Foo"))
@@ -28,3 +28,20 @@ def test_create_base(storage):
     assert isinstance(base.created, datetime.datetime)
     assert isinstance(base.updated, datetime.datetime)
     assert isinstance(base.__json__(), dict)
+
+
+def test_fields_cached(storage):
+    from tedega_storage.rdbms.base import get_fields
+    base = Dummy.get_factory(storage).create()
+    assert base.fields is Dummy.get_factory(storage).create().fields
+    assert get_fields(Dummy)[1] == frozenset(base.fields)
+    assert set(base.get_values(["id", "uuid", "xxx"])) == set(["id", "uuid"])
+
+
+def test_get_values_many(storage):
+    from tedega_storage.rdbms.base import get_values_many
+    factory = Dummy.get_factory(storage)
+    items = [factory.create(), factory.create()]
+    assert get_values_many(items) == [item.get_values() for item in items]
+    assert get_values_many(items, ["uuid"]) == [{"uuid": item.uuid}
+                                                for item in items]
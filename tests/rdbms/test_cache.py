@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cache
+----------------------------------
+
+Tests for `tedega_storage.rdbms.cache` module.
+"""
+import uuid
+import pytest
+from tedega_storage.rdbms import (
+    RDBMSStorageBase as Base,
+    BaseItem,
+    get_storage
+)
+from tedega_storage.rdbms.cache import (
+    IdentityCache, LRUBackend, configure_cache, disable_cache
+)
+from tedega_storage.rdbms.mixins import Protocol
+
+NEW_UUID = uuid.UUID("6b4b5e1c-3a2f-4d55-9f0a-2c1d8e7b9a10")
+
+
+class Cached(Protocol, BaseItem, Base):
+    """Cached class"""
+    __tablename__ = "cached"
+
+
+@pytest.fixture()
+def cache(request, dbmodel):
+    cache = configure_cache(LRUBackend(maxsize=2))
+    request.addfinalizer(disable_cache)
+    return cache
+
+
+def test_lru_backend():
+    backend = LRUBackend(maxsize=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    assert backend.get("a") == 1
+    backend.set("c", 3)
+    assert backend.get("b") is None
+    assert backend.stats() == {"hits": 1, "misses": 1, "evictions": 1}
+    backend = LRUBackend(ttl=-1)
+    backend.set("a", 1)
+    assert backend.get("a") is None
+    assert backend.evictions == 1
+
+
+def test_read_through(cache):
+    from tedega_storage.rdbms.crud import create, read, update, delete
+    with get_storage() as storage:
+        item_id = create(storage, Cached, {}).id
+    with get_storage() as storage:
+        item = read(storage, Cached, item_id)
+        uuid = item.uuid
+    assert cache.stats()["misses"] == 1
+    with get_storage() as storage:
+        item = read(storage, Cached, item_id)
+        assert item.uuid == uuid
+        assert read(storage, Cached, item_id) is item
+    assert cache.stats()["hits"] == 1
+    with get_storage() as storage:
+        update(storage, Cached, item_id, {"uuid": NEW_UUID})
+    with get_storage() as storage:
+        item = read(storage, Cached, item_id)
+        assert item.uuid == NEW_UUID
+        delete(storage, Cached, item_id)
+    assert cache.stats() == {"hits": 2, "misses": 2, "evictions": 0}
+
+
+def test_invalidate_on_flush(cache):
+    from tedega_storage.rdbms.crud import bulk_create, bulk_delete, read
+    with get_storage() as storage:
+        ids = bulk_create(storage, Cached, [{}, {}])
+    with get_storage() as storage:
+        item = read(storage, Cached, ids[0])
+        item.uuid = NEW_UUID
+    with get_storage() as storage:
+        assert read(storage, Cached, ids[0]).uuid == NEW_UUID
+        read(storage, Cached, ids[1])
+    with get_storage() as storage:
+        bulk_delete(storage, Cached, ids)
+    assert len(cache.backend) == 0
+
+
+def test_cache_classes():
+    cache = IdentityCache(classes=[Cached])
+    assert cache.caches(Cached)
+    assert not cache.caches(object)
+    with get_storage(cache=cache) as storage:
+        assert storage.cache is cache
+
+
+def test_invalidate_class(cache):
+    from tedega_storage.rdbms.crud import bulk_create, read, update_where
+    with get_storage() as storage:
+        ids = bulk_create(storage, Cached, [{}])
+    with get_storage() as storage:
+        read(storage, Cached, ids[0])
+    with get_storage() as storage:
+        update_where(storage, Cached, "id::{}".format(ids[0]),
+                     {"uuid": NEW_UUID})
+    hits = cache.stats()["hits"]
+    with get_storage() as storage:
+        item = read(storage, Cached, ids[0])
+        assert item.uuid == NEW_UUID
+        storage.delete(item)
+    assert cache.stats()["hits"] == hits
+
+
+def test_no_uncommitted_values(cache):
+    from tedega_storage.rdbms.crud import (
+        bulk_create, bulk_delete, bulk_update, read
+    )
+    with get_storage() as storage:
+        item_id = bulk_create(storage, Cached, [{}])[0]
+    with pytest.raises(ValueError):
+        with get_storage() as storage:
+            bulk_update(storage, Cached, [{"id": item_id,
+                                           "uuid": NEW_UUID}])
+            assert read(storage, Cached, item_id).uuid == NEW_UUID
+            raise ValueError()
+    with get_storage() as storage:
+        assert read(storage, Cached, item_id).uuid != NEW_UUID
+    with get_storage() as storage:
+        # Stored by the read only transaction before.
+        assert read(storage, Cached, item_id).uuid != NEW_UUID
+        bulk_delete(storage, Cached, [item_id])
+    assert cache.stats()["hits"] == 1
+
+
+def test_no_stale_values(cache, tmpdir):
+    from tedega_storage.rdbms import init_storage
+    from tedega_storage.rdbms.crud import create, read, update
+    from tedega_storage.rdbms.engine import configure_engine
+    # The write ahead log lets the writer commit while the reader's
+    # transaction is open.
+    configure_engine("stale", "sqlite:///{}".format(tmpdir.join("s.db")),
+                     sqlite_profile="durable")
+    init_storage("stale")
+    with get_storage("stale") as storage:
+        item_id = create(storage, Cached, {}).id
+    with get_storage("stale") as reader:
+        read(reader, Cached, item_id)
+        with get_storage("stale") as writer:
+            update(writer, Cached, item_id, {"uuid": NEW_UUID})
+    # The reader committed after the update, its value is outdated.
+    with get_storage("stale") as storage:
+        assert read(storage, Cached, item_id).uuid == NEW_UUID
+    with get_storage("stale") as storage:
+        assert read(storage, Cached, item_id).uuid == NEW_UUID
+    configure_engine("stale", uri="sqlite://")
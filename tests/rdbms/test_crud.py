@@ -7,12 +7,13 @@ test_crud
 
 Tests for `tedega_storage.rdbms.crud` module.
 """
+import uuid
 import pytest
 from tedega_storage.rdbms import (
     RDBMSStorageBase as Base,
     BaseItem
 )
-from tedega_storage.rdbms.mixins import Protocol
+from tedega_storage.rdbms.mixins import Protocol, Versioned
 
 
 class Dummy(Protocol, BaseItem, Base):
@@ -20,6 +21,11 @@ class Dummy(Protocol, BaseItem, Base):
     __tablename__ = "dummys"
 
 
+class VersionedDummy(Versioned, Protocol, BaseItem, Base):
+    """Dummy class with a version"""
+    __tablename__ = "versioned_dummys"
+
+
 def test_searech_fail_because_not_base(storage):
     from tedega_storage.rdbms.crud import search
     with pytest.raises(TypeError):
@@ -122,3 +128,334 @@ def test_notfound_error():
     with pytest.raises(NotFound):
         with get_storage() as storage:
             delete(storage, Dummy, 12)
+
+
+def test_bulk_crud():
+    import datetime
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import (
+        bulk_create, bulk_update, bulk_delete, read
+    )
+    created = datetime.datetime(2017, 1, 1)
+    with get_storage() as storage:
+        ids = bulk_create(storage, Dummy, [{}, {}, {}], chunk_size=2)
+        assert len(set(ids)) == 3
+        assert ids == sorted(ids)
+        values = [{"id": item_id, "created": created, "foo": "bar"}
+                  for item_id in reversed(ids)]
+        assert bulk_update(storage, Dummy, values) == list(reversed(ids))
+        item = read(storage, Dummy, ids[0])
+        assert item.created == created
+        assert item.updated > created
+        assert bulk_delete(storage, Dummy, ids, chunk_size=2) == ids
+
+
+def test_bulk_fail(storage):
+    from tedega_view import NotFound
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import (
+        bulk_create, bulk_update, bulk_delete
+    )
+    with pytest.raises(TypeError):
+        bulk_create(storage, object, [{}])
+    with pytest.raises(TypeError):
+        bulk_create(storage, Dummy, {})
+    with pytest.raises(TypeError):
+        bulk_update(storage, Dummy, [{"id": "1"}])
+    with pytest.raises(TypeError):
+        bulk_delete(storage, Dummy, ["1"])
+    with pytest.raises(NotFound):
+        with get_storage() as storage:
+            bulk_delete(storage, Dummy, [4711])
+
+
+def test_search_cursor():
+    from tedega_view import ClientError
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import bulk_create, bulk_delete, search
+    with get_storage() as storage:
+        ids = bulk_create(storage, Dummy, [{} for i in range(5)])
+        for sort in ["", "-id", "created|-id", "-created"]:
+            pages = []
+            page = search(storage, Dummy, limit=2, sort=sort, cursor="")
+            while page:
+                pages.append([item.id for item in page])
+                if page.cursor is None:
+                    break
+                page = search(storage, Dummy, limit=2, sort=sort,
+                              cursor=page.cursor)
+            found = [item_id for page in pages for item_id in page]
+            assert sorted(found) == sorted(set(found))
+            assert set(ids) <= set(found)
+        page = search(storage, Dummy, limit=2, sort="-id", cursor="")
+        with pytest.raises(ClientError):
+            search(storage, Dummy, sort="id", cursor=page.cursor)
+        with pytest.raises(ClientError):
+            search(storage, Dummy, sort="-id", cursor="xxx")
+        bulk_delete(storage, Dummy, ids)
+
+
+def test_read_many():
+    from tedega_view import NotFound
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import (
+        bulk_create, bulk_delete, read, read_many
+    )
+    with get_storage() as storage:
+        ids = bulk_create(storage, Dummy, [{}, {}, {}])
+    with get_storage() as storage:
+        first = read(storage, Dummy, ids[0])
+        assert read(storage, Dummy, ids[0]) is first
+        items = read_many(storage, Dummy, [ids[2], ids[0], ids[1], ids[2]])
+        assert [item.id for item in items] == [ids[2], ids[0], ids[1], ids[2]]
+        assert items[1] is first
+        with pytest.raises(NotFound):
+            read_many(storage, Dummy, [ids[0], 4711])
+    with pytest.raises(TypeError):
+        read_many(storage, Dummy, ["1"])
+    with get_storage() as storage:
+        bulk_delete(storage, Dummy, ids)
+
+
+def test_stream():
+    from tedega_view import ClientError
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import bulk_create, bulk_delete, stream
+    with get_storage() as storage:
+        ids = bulk_create(storage, Dummy, [{} for i in range(5)])
+        items = stream(storage, Dummy, sort="-id", batch_size=2)
+        found = [item.id for item in items]
+        assert found == sorted(found, reverse=True)
+        assert set(ids) <= set(found)
+        search = "id::{}".format(ids[0])
+        assert [item.id for item in stream(storage, Dummy, search)] == ids[:1]
+        assert len(list(storage.stream(Dummy, 2))) == len(found)
+        with pytest.raises(ClientError):
+            stream(storage, Dummy, sort="xxx")
+        bulk_delete(storage, Dummy, ids)
+
+
+def test_search_fields():
+    from tedega_view import ClientError
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import bulk_create, bulk_delete, search
+    with get_storage() as storage:
+        ids = bulk_create(storage, Dummy, [{}, {}, {}])
+        items = search(storage, Dummy, search="id::{}".format(ids[0]),
+                       fields="id|uuid")
+        assert len(items) == 1
+        assert sorted(items[0].keys()) == ["id", "uuid"]
+        assert items[0]["id"] == ids[0]
+        page = search(storage, Dummy, limit=2, sort="-created",
+                      cursor="", fields=["uuid"])
+        assert list(page[0].keys()) == ["uuid"]
+        page = search(storage, Dummy, limit=2, sort="-created",
+                      cursor=page.cursor, fields=["uuid"])
+        assert len(page) > 0
+        with pytest.raises(ClientError):
+            search(storage, Dummy, fields="id|xxx")
+        with pytest.raises(ClientError):
+            search(storage, Dummy, fields="get_values")
+        bulk_delete(storage, Dummy, ids)
+
+
+def test_read_by_uuid(dbmodel):
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import create, read_by_uuid
+    from tedega_view import NotFound
+    with get_storage() as storage:
+        item = create(storage, Dummy, {})
+        assert read_by_uuid(storage, Dummy, item.uuid) is item
+        assert read_by_uuid(storage, Dummy, str(item.uuid)) is item
+        with pytest.raises(TypeError):
+            read_by_uuid(storage, Dummy, "foo")
+        with pytest.raises(NotFound):
+            read_by_uuid(storage, Dummy, uuid.uuid4())
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_bulk_upsert(dbmodel, monkeypatch, native):
+    import datetime
+    from tedega_storage.rdbms import get_storage, storage as module
+    from tedega_storage.rdbms.crud import (
+        bulk_delete, bulk_upsert, read, upsert
+    )
+    if not native:
+        monkeypatch.setattr(module, "_sqlite_upsert", lambda dialect: False)
+    created = datetime.datetime(2017, 1, 1)
+    uuids = [uuid.uuid4() for _ in range(3)]
+    with get_storage() as storage:
+        new, updated = bulk_upsert(storage, Dummy, [
+            {"uuid": uuids[0], "created": created},
+            {"uuid": str(uuids[1])}], chunk_size=1)
+        assert len(new) == 2 and updated == []
+        item = read(storage, Dummy, new[0])
+        assert item.created == created
+    with get_storage() as storage:
+        later = datetime.datetime(2018, 1, 1)
+        third, updated = bulk_upsert(storage, Dummy, [
+            {"uuid": uuids[2]},
+            {"uuid": uuids[0], "created": later, "foo": "bar"},
+            {"uuid": uuids[1], "created": None}])
+        assert len(third) == 1 and updated == new
+        item = read(storage, Dummy, new[0])
+        assert item.created == later
+        assert item.updated > created
+        assert read(storage, Dummy, new[1]).created != later
+        assert upsert(storage, Dummy, {"uuid": uuids[2]}) == (
+            third[0], False)
+        with pytest.raises(TypeError):
+            upsert(storage, Dummy, {})
+        with pytest.raises(TypeError):
+            bulk_upsert(storage, Dummy, [{"uuid": uuids[0]},
+                                         {"uuid": str(uuids[0])}])
+        bulk_delete(storage, Dummy, new + third)
+
+
+def test_update_delete_where(dbmodel):
+    import datetime
+    from tedega_view import ClientError
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.cache import IdentityCache
+    from tedega_storage.rdbms.crud import (
+        bulk_create, delete_where, read, search, update_where
+    )
+    old = datetime.datetime(2017, 1, 1)
+    cache = IdentityCache()
+    with get_storage(cache=cache) as storage:
+        ids = bulk_create(storage, Dummy, [{}, {}, {}])
+        update_where(storage, Dummy, "id:in:{},{}".format(*ids[:2]),
+                     {"created": old})
+        loaded = read(storage, Dummy, ids[0])
+        assert loaded.created == old
+        search_old = "id:ge:{}|created:lt:2018-01-01".format(ids[0])
+        updated = loaded.updated
+        assert update_where(storage, Dummy, search_old,
+                            {"created": old, "id": 1, "foo": "bar"}) == 2
+        # Loaded and cached items are refreshed.
+        assert read(storage, Dummy, ids[0]).updated > updated
+        assert update_where(storage, Dummy, search_old, {"foo": 1}) == 0
+        assert delete_where(storage, Dummy, search_old) == 2
+        assert [item.id for item in search(storage, Dummy, limit=None,
+                search="id:ge:{}".format(ids[0]))] == ids[2:]
+        with pytest.raises(ClientError):
+            delete_where(storage, Dummy, "foo::bar")
+        with pytest.raises(TypeError):
+            update_where(storage, Dummy, "", [])
+        delete_where(storage, Dummy, "id::{}".format(ids[2]))
+
+
+def test_update_no_changes(dbmodel):
+    from sqlalchemy import event
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import create, delete, read, update
+    with get_storage() as storage:
+        item_id = create(storage, Dummy, {}).id
+    with get_storage() as storage:
+        item = read(storage, Dummy, item_id)
+        updated = item.updated
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(storage.engine, "before_cursor_execute", count)
+        try:
+            # Strings are compared with the converted values.
+            instance, changed = update(
+                storage, Dummy, item_id,
+                {"id": item_id, "created": item.created.isoformat()},
+                return_changes=True)
+            assert changed == []
+            assert update(storage, Dummy, item_id, {"id": str(item_id)}) \
+                is instance
+        finally:
+            event.remove(storage.engine, "before_cursor_execute", count)
+        assert not [stmt for stmt in statements if stmt.startswith("UPDATE")]
+        assert instance.updated == updated
+        instance, changed = update(storage, Dummy, item_id,
+                                   {"created": updated}, return_changes=True)
+        assert changed == ["created"]
+        assert instance.updated > updated
+        delete(storage, Dummy, item_id)
+
+
+def test_update_delete_versioned(dbmodel):
+    import datetime
+    from tedega_storage.rdbms import get_storage
+    from tedega_storage.rdbms.crud import (
+        ConflictError, bulk_create, create, delete, read, update,
+        update_where
+    )
+    old = datetime.datetime(2017, 1, 1)
+    with get_storage() as storage:
+        item_id = create(storage, VersionedDummy, {}).id
+    with get_storage() as storage:
+        item = update(storage, VersionedDummy, item_id, {"created": old},
+                      expected_version=1)
+        assert item.version == 2
+        # Versions can not be set and no-op updates keep the version.
+        update(storage, VersionedDummy, item_id, {"version": 5,
+                                                  "created": old})
+        assert item.version == 2
+        with pytest.raises(ConflictError):
+            update(storage, VersionedDummy, item_id, {"created": None},
+                   expected_version=1)
+        with pytest.raises(TypeError):
+            update(storage, Dummy, item_id, {}, expected_version=1)
+    table = VersionedDummy.__table__
+    bump = table.update().where(table.c.id == item_id).values(
+        version=table.c.version + 1)
+    # The failed flush rolls back the transaction.
+    with pytest.raises(ConflictError):
+        with get_storage() as storage:
+            stale = read(storage, VersionedDummy, item_id)
+            # Simulates a change by another transaction in between.
+            storage.session.execute(bump)
+            update(storage, VersionedDummy, item_id,
+                   {"created": datetime.datetime(2018, 1, 1)})
+    with get_storage() as storage:
+        # The loaded item is refreshed if the version does not match.
+        stale = read(storage, VersionedDummy, item_id)
+        storage.session.execute(bump)
+        assert stale.version == 2
+        update(storage, VersionedDummy, item_id,
+               {"created": datetime.datetime(2018, 1, 1)},
+               expected_version=3)
+        assert stale.version == 4
+        bulk_ids = bulk_create(storage, VersionedDummy, [{}])
+        assert update_where(storage, VersionedDummy,
+                            "id::{}".format(bulk_ids[0]),
+                            {"created": old}) == 1
+        assert read(storage, VersionedDummy, bulk_ids[0]).version == 2
+        with pytest.raises(ConflictError):
+            delete(storage, VersionedDummy, item_id, expected_version=3)
+        delete(storage, VersionedDummy, item_id, expected_version=4)
+        delete(storage, VersionedDummy, bulk_ids[0])
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_bulk_versioned(dbmodel, monkeypatch, native):
+    from tedega_storage.rdbms import get_storage, storage as module
+    from tedega_storage.rdbms.crud import (
+        ConflictError, bulk_create, bulk_delete, bulk_update, bulk_upsert,
+        read, update
+    )
+    if not native:
+        monkeypatch.setattr(module, "_sqlite_upsert", lambda dialect: False)
+    new_uuid = uuid.uuid4()
+    with get_storage() as storage:
+        ids = bulk_create(storage, VersionedDummy, [{}])
+        item_uuid = read(storage, VersionedDummy, ids[0]).uuid
+        bulk_update(storage, VersionedDummy, [{"id": ids[0], "version": 99,
+                                               "created": None}])
+        assert read(storage, VersionedDummy, ids[0]).version == 2
+        created, updated = bulk_upsert(storage, VersionedDummy, [
+            {"uuid": item_uuid, "version": 99},
+            {"uuid": new_uuid, "version": 99}])
+        assert updated == ids
+        assert read(storage, VersionedDummy, ids[0]).version == 3
+        assert read(storage, VersionedDummy, created[0]).version == 1
+        with pytest.raises(ConflictError):
+            update(storage, VersionedDummy, ids[0], {"created": None},
+                   expected_version=2)
+        bulk_delete(storage, VersionedDummy, ids + created)
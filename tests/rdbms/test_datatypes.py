@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_datatypes
+----------------------------------
+
+Tests for `tedega_storage.rdbms.datatypes` module.
+"""
+import uuid
+import sqlalchemy as sa
+from tedega_storage.rdbms import (
+    RDBMSStorageBase as Base,
+    BaseItem,
+    get_storage
+)
+from tedega_storage.rdbms.datatypes import migrate_uuid_column
+
+
+class Identified(BaseItem, Base):
+    """Identified class"""
+    __tablename__ = "identified"
+
+
+def test_uuid_roundtrip(dbmodel):
+    item = Identified()
+    item_uuid = item.uuid
+    with get_storage() as storage:
+        item_id = storage.create(item)
+        raw = storage.session.execute(
+            sa.text("SELECT uuid FROM identified WHERE id = :id"),
+            {"id": item_id}).scalar()
+    assert raw == item_uuid.bytes
+    with get_storage() as storage:
+        loaded = storage.read(Identified, item_id)
+        assert isinstance(loaded.uuid, uuid.UUID)
+        assert loaded.uuid == item_uuid
+
+
+def test_migrate_uuid_column(dbmodel):
+    values = [uuid.uuid4() for _ in range(3)]
+    with get_storage() as storage:
+        storage.session.execute(sa.text("DELETE FROM identified"))
+        for value in values:
+            storage.session.execute(
+                sa.text("INSERT INTO identified (uuid) VALUES (:uuid)"),
+                {"uuid": str(value)})
+    with get_storage() as storage:
+        connection = storage.session.connection()
+        assert migrate_uuid_column(connection, "identified") == 3
+        assert migrate_uuid_column(connection, "identified") == 0
+    with get_storage() as storage:
+        for value in values:
+            assert storage.read_by_uuid(Identified, value).uuid == value
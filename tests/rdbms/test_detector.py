@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_detector
+----------------------------------
+
+Tests for `tedega_storage.rdbms.detector` module.
+"""
+import pytest
+import sqlalchemy as sa
+from tedega_storage.rdbms import (
+    RDBMSStorageBase as Base,
+    BaseItem,
+    get_storage,
+    init_storage
+)
+from tedega_storage.rdbms.base import get_values_many
+from tedega_storage.rdbms.detector import (
+    QueryBudgetError, QueryBudgetWarning, QueryDetector
+)
+from tedega_storage.testing import query_budget  # noqa
+
+
+class Parent(BaseItem, Base):
+    """Parent class"""
+    __tablename__ = "parents"
+    children = sa.orm.relationship("Child", backref="parent")
+
+
+class Child(BaseItem, Base):
+    """Child class"""
+    __tablename__ = "children"
+    parent_id = sa.Column("parent_id", sa.Integer,
+                          sa.ForeignKey("parents.id"))
+
+
+@pytest.fixture()
+def parents(request):
+    init_storage()
+    with get_storage() as storage:
+        storage.session.execute(sa.delete(Child))
+        storage.session.execute(sa.delete(Parent))
+        for _ in range(3):
+            parent = Parent()
+            parent.children = [Child(), Child()]
+            storage.create(parent)
+
+
+def test_lazy_loads(parents, query_budget):  # noqa
+    from tedega_storage.rdbms.crud import search
+    with pytest.raises(QueryBudgetError):
+        with query_budget():
+            with get_storage() as storage:
+                get_values_many(search(storage, Parent))
+
+    with query_budget(max_statements=2) as detector:
+        with get_storage() as storage:
+            items = search(storage, Parent)
+            for item in items:
+                sa.orm.attributes.set_committed_value(item, "children", [])
+            get_values_many(items)
+    assert [report.name for report in detector.reports] == ["search"]
+    assert detector.statements == 1
+
+
+def test_warn(parents):
+    from tedega_storage.rdbms.crud import read, search
+    detector = QueryDetector(max_statements=2, max_repeats=1)
+    with pytest.warns(QueryBudgetWarning):
+        with get_storage(detector=detector) as storage:
+            get_values_many(search(storage, Parent))
+    assert len(detector.violations) == 2
+    # The lazy loads happen after the search.
+    search_report, other = detector.reports
+    assert (search_report.name, search_report.statements) == ("search", 1)
+    assert (other.name, other.statements, other.repeats) == ("other", 3, 3)
+
+    detector.reset()
+    with get_storage(detector=detector) as storage:
+        items = search(storage, Parent)
+        read(storage, Parent, items[0].id)
+        storage.read(Child, 1)
+    assert [r.name for r in detector.reports] == ["search", "other"]
+    # The detector is detached from the session on exit.
+    with get_storage() as storage:
+        search(storage, Parent)
+    assert detector.statements == 2
+    with pytest.raises(ValueError):
+        QueryDetector(mode="foo")
+
+
+def test_include(parents, query_budget):  # noqa
+    from tedega_view import ClientError
+    from tedega_storage.rdbms.crud import read, search
+    with query_budget(max_statements=2) as detector:
+        with get_storage() as storage:
+            items = search(storage, Parent, include="children")
+            values = get_values_many(items)
+            assert [len(v["children"]) for v in values] == [2, 2, 2]
+    assert [(r.name, r.statements) for r in detector.reports] == [
+        ("search", 2)]
+
+    with get_storage() as storage:
+        child = search(storage, Child, limit=1, include=["parent"])[0]
+        assert "parent" in child.__dict__
+        item = read(storage, Parent, child.parent_id, include="children")
+        assert "children" in item.__dict__
+        with pytest.raises(ClientError):
+            search(storage, Parent, include="foo")
+        with pytest.raises(ClientError):
+            search(storage, Parent, include="children.foo")
+        with pytest.raises(ClientError):
+            search(storage, Parent, include="children", fields="id")
+        with pytest.raises(ClientError):
+            read(storage, Parent, child.parent_id, include="id")
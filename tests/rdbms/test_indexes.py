@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_indexes
+----------------------------------
+
+Tests for `tedega_storage.rdbms.indexes` module.
+"""
+import pytest
+import sqlalchemy as sa
+from tedega_storage.rdbms import (
+    RDBMSStorageBase as Base,
+    BaseItem,
+    get_engine,
+    get_storage,
+    init_storage
+)
+from tedega_storage.rdbms.crud import search
+from tedega_storage.rdbms.indexes import (
+    configure_advisor, disable_advisor, index_columns
+)
+from tedega_storage.rdbms.mixins import Protocol
+
+
+class Ticket(Protocol, BaseItem, Base):
+    """Ticket class"""
+    __tablename__ = "tickets"
+    __searchable__ = ("state", ("owner", "priority"), "uuid")
+    __sortable__ = ("-created", ("state", "created"))
+    state = sa.Column("state", sa.String)
+    owner = sa.Column("owner", sa.Integer)
+    priority = sa.Column("priority", sa.Integer)
+
+
+@pytest.fixture()
+def advisor(request):
+    advisor = configure_advisor()
+    yield advisor
+    disable_advisor()
+
+
+def test_index_columns():
+    # The unique uuid and the prefix "state" of "state, created, id"
+    # are indexed already.
+    assert index_columns(Ticket) == [("owner", "priority"),
+                                     ("created", "id"),
+                                     ("state", "created", "id")]
+
+
+def test_init_storage_creates_indexes():
+    engine = get_engine()
+    init_storage()
+    # Existing table without the declared indexes.
+    with engine.begin() as connection:
+        for index in sa.inspect(connection).get_indexes("tickets"):
+            connection.exec_driver_sql("DROP INDEX {}".format(index["name"]))
+    init_storage()
+    indexes = dict((index["name"], tuple(index["column_names"]))
+                   for index in sa.inspect(engine).get_indexes("tickets"))
+    assert indexes["ix_tickets_owner_priority"] == ("owner", "priority")
+    assert indexes["ix_tickets_created_id"] == ("created", "id")
+    assert indexes["ix_tickets_state_created_id"] == ("state", "created",
+                                                      "id")
+
+
+def test_advisor(dbmodel, advisor):
+    init_storage()
+    with get_storage() as storage:
+        search(storage, Ticket, search="owner::1|priority:gt:2")
+        search(storage, Ticket, search="owner::2|priority:gt:3")
+        search(storage, Ticket, search="state::open", sort="-created")
+        search(storage, Ticket, search="updated:lt:2018-01-01")
+        search(storage, Ticket, search="owner::1~priority::2",
+               sort="updated")
+        reports = advisor.reports()
+        assert reports[0].count == 2
+        assert reports[0].columns == ("owner", "priority")
+        missing = advisor.missing_indexes()
+        assert [report.columns for report in missing] == [("updated",),
+                                                          ("updated",)]
+        scans = advisor.explain(storage)
+        assert set(report.columns for report in scans) == set([("updated",)])
+        assert all(report.plan for report in reports)
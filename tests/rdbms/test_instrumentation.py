@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_instrumentation
+----------------------------------
+
+Tests for `tedega_storage.rdbms.instrumentation` module.
+"""
+import logging
+import uuid
+import pytest
+import sqlalchemy as sa
+from tedega_storage.rdbms import (
+    RDBMSStorageBase as Base,
+    BaseItem,
+    get_storage
+)
+from tedega_storage.rdbms.instrumentation import (
+    MetricsSink, configure_instrumentation,
+    disable_instrumentation, redact
+)
+
+
+class Measured(BaseItem, Base):
+    """Measured class"""
+    __tablename__ = "measured"
+
+
+class RecordingSink(MetricsSink):
+
+    def __init__(self):
+        self.operations = []
+        self.statements = []
+
+    def observe_operation(self, operation, seconds, statements, rows):
+        self.operations.append((operation, statements, rows))
+
+    def observe_statement(self, operation, statement, seconds, rows):
+        self.statements.append((operation, statement))
+
+
+@pytest.fixture()
+def sink(request, dbmodel):
+    sink = configure_instrumentation(RecordingSink())
+    request.addfinalizer(disable_instrumentation)
+    return sink
+
+
+def test_operations(sink):
+    from tedega_storage.rdbms.crud import create, read, search
+    with get_storage() as storage:
+        item = create(storage, Measured, {})
+        read(storage, Measured, item.id)
+        search(storage, Measured)
+        storage.session.execute(sa.text("SELECT 1"))
+    names = [operation for operation, _, _ in sink.operations]
+    assert names == ["create", "read", "search"]
+    # The item is still in the session, so read does not query.
+    assert sink.operations[1] == ("read", 0, 1)
+    assert sink.operations[2][1] == 1
+    assert sink.operations[2][2] >= 1
+    assert sink.statements[-2][0] == "search"
+    assert sink.statements[-2][1].startswith("SELECT")
+    assert sink.statements[-1] == ("other", "SELECT 1")
+
+
+def test_operation_rows(sink):
+    from tedega_storage.rdbms.crud import (
+        bulk_upsert, delete_where, update, upsert
+    )
+    with get_storage() as storage:
+        bulk_upsert(storage, Measured, [{"uuid": str(uuid.uuid4())}
+                                        for _ in range(5)])
+        item_id, _ = upsert(storage, Measured, {"uuid": str(uuid.uuid4())})
+        update(storage, Measured, item_id, {}, return_changes=True)
+        deleted = delete_where(storage, Measured, "")
+        storage.session.rollback()
+    assert deleted >= 6
+    assert [(operation, rows) for operation, _, rows in sink.operations] == [
+        ("bulk_upsert", 5), ("upsert", 1), ("update", 1),
+        ("delete_where", deleted)]
+
+
+def test_slow_query(dbmodel, caplog):
+    from tedega_storage.rdbms.crud import search
+    sink = configure_instrumentation(slow_query=0)
+    try:
+        with caplog.at_level(logging.WARNING, "tedega_storage.slow_query"):
+            with get_storage() as storage:
+                search(storage, Measured, search="id:gt:12345")
+    finally:
+        disable_instrumentation()
+    records = [r.getMessage() for r in caplog.records
+               if r.name == "tedega_storage.slow_query"]
+    assert any("Slow query in search" in r for r in records)
+    assert not any("12345" in r for r in records)
+    text = sink.export()
+    assert "# TYPE tedega_storage_operation_seconds histogram" in text
+    assert 'tedega_storage_operation_seconds_count{operation="search"} 1' \
+        in text
+    assert 'tedega_storage_statement_seconds_bucket{operation="search",' \
+        'le="+Inf"}' in text
+    # BEGIN and SELECT
+    assert 'tedega_storage_slow_statements_total{operation="search"} 2' \
+        in text
+
+
+def test_redact():
+    assert redact({"a": 1, "b": "secret"}) == {"a": "?", "b": "?"}
+    assert redact((1, 2)) == ["?", "?"]
+    assert redact([(1,), (2,)]) == [["?"], ["?"]]
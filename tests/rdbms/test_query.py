@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_query
+----------------------------------
+
+Tests for `tedega_storage.rdbms.query` module.
+"""
+import datetime
+import decimal
+import pytest
+import sqlalchemy as sa
+from tedega_view import ClientError
+from tedega_storage.rdbms import (
+    RDBMSStorageBase as Base,
+    BaseItem,
+    get_storage
+)
+from tedega_storage.rdbms.mixins import Protocol
+
+
+class Filtered(Protocol, BaseItem, Base):
+    """Filtered class"""
+    __tablename__ = "filtered"
+    __searchable__ = ("name",)
+    name = sa.Column("name", sa.String)
+    count = sa.Column("count", sa.Integer)
+
+
+class Sampled(BaseItem, Base):
+    """Sampled class"""
+    __tablename__ = "sampled"
+    amount = sa.Column("amount", sa.Numeric(10, 2))
+    at = sa.Column("at", sa.Time)
+    data = sa.Column("data", sa.LargeBinary)
+
+
+@pytest.fixture()
+def items(request, dbmodel):
+    from tedega_storage.rdbms.crud import bulk_create, bulk_update
+    with get_storage() as storage:
+        ids = bulk_create(storage, Filtered, [{} for i in range(4)])
+        bulk_update(storage, Filtered, [
+            {"id": ids[0], "name": "foo", "count": 1},
+            {"id": ids[1], "name": "foo_bar", "count": 2},
+            {"id": ids[2], "name": "fox", "count": 10},
+            {"id": ids[3], "created": datetime.datetime(2017, 1, 1)}])
+
+    def delete():
+        from tedega_storage.rdbms.crud import bulk_delete
+        with get_storage() as storage:
+            bulk_delete(storage, Filtered, ids)
+    request.addfinalizer(delete)
+    return ids
+
+
+@pytest.mark.parametrize("search, expected", [
+    ("count::2", [1]),
+    ("count:eq:2", [1]),
+    ("count:ne:2", [0, 2]),
+    ("count:gt:1", [1, 2]),
+    ("count:ge:2", [1, 2]),
+    ("count:lt:10", [0, 1]),
+    ("count:le:2", [0, 1]),
+    ("count:in:1,10", [0, 2]),
+    ("name:prefix:foo", [0, 1]),
+    ("name:prefix:foo_", [1]),
+    ("name:prefix:fo%", []),
+    ("name:prefix:FOO", []),
+    ("name:prefix:", [0, 1, 2]),
+    ("name:isnull:true", [3]),
+    ("count:isnull:false|count:lt:5", [0, 1]),
+    ("count::1~name::fox", [0, 2]),
+    ("count:gt:1|name::foo_bar~name::fox", [1, 2]),
+    ("created:lt:2017-01-02", [3]),
+    ("created:lt:2017-01-01T12:00:00", [3]),
+])
+def test_operators(items, search, expected):
+    from tedega_storage.rdbms.crud import search as _search
+    with get_storage() as storage:
+        found = _search(storage, Filtered, limit=None, search=search,
+                        sort="id", fields="id")
+    assert [item["id"] for item in found] == [items[i] for i in expected]
+
+
+def test_prefix_uses_index(items):
+    from tedega_storage.rdbms.indexes import Explain
+    from tedega_storage.rdbms.query import _prefix_range, build_search
+    assert _prefix_range("ab") == ("ab", "ac")
+    assert _prefix_range("a\U0010ffff") == ("a\U0010ffff", "b")
+    assert _prefix_range("\ud7ff")[1] == "\ue000"
+    statement, params, _ = build_search(Filtered, 20, 0, "name:prefix:fo",
+                                        "", None)
+    # Depending on the collation the range contains other strings.
+    assert "filtered.name LIKE :p0_like ESCAPE '/'" in str(statement)
+    with get_storage() as storage:
+        plan = [row[-1] for row in storage.session.execute(
+            Explain(statement), params)]
+    assert any(line.startswith("SEARCH") and "ix_filtered_name" in line
+               for line in plan)
+
+
+@pytest.mark.parametrize("search", [
+    "name::a~b,c\\|d\\",
+    "name::a\\~b,c\\|d\\",
+    "name:in:x,a~b\\,c\\|d\\\\",
+    "name:prefix:a~b,c\\|",
+    "count::1~name::a~b,c\\|d\\",
+])
+def test_escaped_values(dbmodel, search):
+    from tedega_storage.rdbms.crud import bulk_create, bulk_update
+    from tedega_storage.rdbms.crud import search as _search
+    with get_storage() as storage:
+        ids = bulk_create(storage, Filtered, [{}])
+        bulk_update(storage, Filtered, [{"id": ids[0], "name": "a~b,c|d\\"}])
+        found = _search(storage, Filtered, search=search)
+        assert [item.id for item in found] == ids
+        storage.session.rollback()
+
+
+@pytest.mark.parametrize("search", [
+    "count:foo:1",
+    "count:gt",
+    "count:gt:x",
+    "count:isnull:maybe",
+    "xxx:gt:1",
+    "created:lt:yesterday",
+])
+def test_invalid(search):
+    from tedega_storage.rdbms.query import parse_search
+    with pytest.raises(ClientError):
+        parse_search(Filtered, search)
+
+
+def test_coerce_value():
+    from tedega_storage.rdbms.query import coerce_value
+    assert coerce_value(Filtered.count, "1") == 1
+    assert coerce_value(Filtered.name, "1") == "1"
+    flag = sa.Column("flag", sa.Boolean)
+    assert coerce_value(flag, "Yes") is True
+    assert coerce_value(flag, "0") is False
+    with pytest.raises(ValueError):
+        coerce_value(flag, "garbage")
+    assert coerce_value(Filtered.created, "2017-01-01") == \
+        datetime.datetime(2017, 1, 1)
+
+
+def test_statement_cache(items):
+    from tedega_storage.rdbms.crud import search
+    from tedega_storage.rdbms.query import STATEMENTS, search_cache_stats
+    STATEMENTS.clear()
+    before = search_cache_stats()
+    with get_storage() as storage:
+        for count in (1, 2, 10):
+            found = search(storage, Filtered,
+                           search="count:in:{},0".format(count), sort="-id")
+            assert [item.count for item in found] == [count]
+        assert len(search(storage, Filtered, search="count:in:1,2,10",
+                          sort="-id")) == 3
+    stats = search_cache_stats()
+    assert stats["misses"] - before["misses"] == 1
+    assert stats["hits"] - before["hits"] == 3
+    assert len(STATEMENTS) == 1
+
+
+def test_total(items):
+    from tedega_storage.rdbms.crud import bulk_delete, count, search
+    with get_storage() as storage:
+        page = search(storage, Filtered, limit=2, search="name:prefix:fo",
+                      total="exact")
+        assert len(page) == 2
+        assert page.total == 3
+        page = search(storage, Filtered, limit=2, cursor="", fields="id",
+                      total="estimate")
+        assert page.total == 4
+        assert page.cursor is not None
+        bulk_delete(storage, Filtered, items[:1])
+        assert count(storage, Filtered) == 3
+        # Estimates are cached
+        assert count(storage, Filtered, mode="estimate") == 4
+        with pytest.raises(ValueError):
+            count(storage, Filtered, mode="foo")
+        storage.session.rollback()
+
+
+def test_estimate_per_database(items, tmpdir, monkeypatch):
+    from tedega_storage.rdbms import init_storage
+    from tedega_storage.rdbms.crud import count
+    uri = "sqlite:///{}".format(tmpdir.join("estimates.db"))
+    monkeypatch.setenv("TEDEGA_STORAGE_ESTIMATES_URI", uri)
+    init_storage("estimates")
+    with get_storage() as storage:
+        assert count(storage, Filtered, mode="estimate") == 4
+    with get_storage("estimates") as storage:
+        assert count(storage, Filtered, mode="estimate") == 0
+
+
+@pytest.mark.parametrize("sort", ["amount", "-at", "data"])
+def test_cursor_types(dbmodel, sort):
+    from tedega_storage.rdbms.crud import bulk_create, bulk_update, search
+    with get_storage() as storage:
+        ids = bulk_create(storage, Sampled, [{} for i in range(5)])
+        bulk_update(storage, Sampled, [
+            {"id": id, "amount": decimal.Decimal("{}.50".format(i)),
+             "at": datetime.time(i, 30, 15, 5), "data": bytes([i, 255])}
+            for i, id in enumerate(ids)])
+        ids = [item.id for item in search(storage, Sampled, sort=sort)]
+        seen = []
+        page = search(storage, Sampled, limit=2, cursor="", sort=sort)
+        while True:
+            seen.extend(item.id for item in page)
+            if page.cursor is None:
+                break
+            page = search(storage, Sampled, limit=2, cursor=page.cursor,
+                          sort=sort)
+        assert seen == ids
+        storage.session.rollback()
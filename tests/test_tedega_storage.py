@@ -12,6 +12,8 @@ import pytest
 import datetime
 from tedega_storage.rdbms import (
     ENGINE,
+    BaseItem,
+    get_engine,
     RDBMSStorageBase,
     get_storage,
     scoped_session,
@@ -90,4 +92,257 @@ def test_storage_without_scope():
     storage = get_storage()
 
 
+def test_session_factory_cache():
+    import threading
+    from tedega_storage.rdbms.storage import (
+        get_sessionmaker, get_scoped_session
+    )
+    engine = get_engine()
+    assert get_sessionmaker(engine) is get_sessionmaker(engine)
+    with get_storage(scope="thread") as storage:
+        session = storage.session
+    with get_storage(scope="thread") as storage:
+        assert storage.session is session
+    with get_storage() as storage:
+        assert storage.session is not session
+    with scoped_session(scope="context") as first:
+        with scoped_session(scope="context") as second:
+            assert first is second
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(get_scoped_session(engine)()))
+    thread.start()
+    thread.join()
+    assert other[0] is not session
+    get_scoped_session(engine).remove()
+    with pytest.raises(ValueError):
+        get_scoped_session(engine, "foo")
+
+
+def test_scoped_storage_first(tmpdir):
+    # The first storage of a process uses a scoped session.
+    import os
+    import subprocess
+    import sys
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path),
+               TEDEGA_STORAGE_URI="sqlite:///{}".format(tmpdir.join("s.db")))
+    code = ("from tedega_storage.rdbms import get_storage\n"
+            "with get_storage(scope='thread') as storage:\n"
+            "    storage.session.execute('SELECT 1')\n")
+    subprocess.run([sys.executable, "-c", code], env=env, timeout=30,
+                   check=True)
+
+
+def test_context_sessions_removed():
+    import contextvars
+    from tedega_storage.rdbms.storage import get_scoped_session
+
+    def request():
+        with get_storage(scope="context") as storage:
+            with get_storage(scope="context") as inner:
+                assert inner.session is storage.session
+            assert storage.session in get_scoped_session(
+                storage.engine, "context").registry.registry.values()
+    for _ in range(10):
+        contextvars.Context().run(request)
+    registry = get_scoped_session(get_engine(), "context").registry
+    assert len(registry.registry) == 0
+
+
+def test_nested_scoped_storages():
+    def count(value):
+        with get_storage() as storage:
+            return storage.session.query(DummyModel).filter(
+                DummyModel.dummy_string == value).count()
+
+    with pytest.raises(RuntimeError):
+        with get_storage(scope="thread") as outer:
+            outer.session.add(DummyModel(dummy_string="nested-outer"))
+            with get_storage(scope="thread") as inner:
+                inner.session.add(DummyModel(dummy_string="nested-inner"))
+            raise RuntimeError()
+    assert count("nested-outer") == 0
+    assert count("nested-inner") == 0
+    # A failed inner storage rolls back the outer transaction.
+    with get_storage(scope="thread") as outer:
+        outer.session.add(DummyModel(dummy_string="nested-failed"))
+        with pytest.raises(RuntimeError):
+            with get_storage(scope="thread"):
+                raise RuntimeError()
+    assert count("nested-failed") == 0
+    with get_storage(scope="thread") as outer:
+        with get_storage(scope="thread") as inner:
+            inner.session.add(DummyModel(dummy_string="nested-commit"))
+        assert count("nested-commit") == 0
+    assert count("nested-commit") == 1
+
+
+def test_named_engine(tmpdir, monkeypatch):
+    from tedega_storage.rdbms.engine import (
+        ENGINES, configure_engine, get_engine, get_settings
+    )
+    uri = "sqlite:///{}".format(tmpdir.join("other.db"))
+    monkeypatch.setenv("TEDEGA_STORAGE_OTHER_URI", uri)
+    monkeypatch.setenv("TEDEGA_STORAGE_OTHER_POOL_PRE_PING", "true")
+    monkeypatch.setenv("TEDEGA_STORAGE_OTHER_POOL_RECYCLE", "3600")
+    assert get_settings("other") == {"uri": uri, "pool_pre_ping": True,
+                                     "pool_recycle": 3600}
+    configure_engine("other", pool_recycle=60)
+    assert "other" not in ENGINES
+    init_storage("other")
+    engine = get_engine("other")
+    assert engine is not get_engine()
+    assert engine.pool._recycle == 60
+    assert engine.pool._pre_ping
+    with get_storage("other") as storage:
+        assert storage.engine is engine
+    with scoped_session("other") as session:
+        session.execute("SELECT * from teststorage")
+    configure_engine("other", uri="sqlite://")
+    assert "other" not in ENGINES
+    assert str(get_engine("other").url) == "sqlite://"
+    configure_engine("other")
+    with pytest.raises(TypeError):
+        configure_engine("other", foo=1)
+    with pytest.raises(KeyError):
+        get_engine("missing")
+
+
 init_storage()
+
+
+def test_transaction_strategy():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = get_engine()
+    sa.event.listen(engine, "before_cursor_execute", record)
+    try:
+        ids = {}
+        for transaction in ("savepoint", "flush", "deferred"):
+            del statements[:]
+            with get_storage(transaction=transaction) as storage:
+                new = DummyModel()
+                new.dummy_string = transaction
+                new_id = storage.create(new)
+                if transaction == "deferred":
+                    assert new_id is None
+                else:
+                    assert new_id == new.id
+            ids[transaction] = new_id
+            savepoints = [s for s in statements if s.startswith("SAVEPOINT")]
+            assert len(savepoints) == (transaction == "savepoint")
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", record)
+    with get_storage() as storage:
+        loaded = storage.read(DummyModel, ids["flush"])
+        assert loaded.dummy_string == "flush"
+    with pytest.raises(ValueError):
+        get_storage(transaction="foo")
+
+
+def test_sqlite_profile(tmpdir, monkeypatch):
+    from tedega_storage.rdbms.engine import (
+        configure_engine, get_settings, get_sqlite_pragmas
+    )
+    monkeypatch.setenv("TEDEGA_STORAGE_TUNED_SQLITE_PRAGMAS",
+                       "cache_size=-2000, busy_timeout=100")
+    configure_engine("tuned", "sqlite:///{}".format(tmpdir.join("tuned.db")),
+                     sqlite_profile="performance")
+    assert get_settings("tuned")["sqlite_pragmas"] == {
+        "cache_size": "-2000", "busy_timeout": "100"}
+    assert isinstance(get_engine("tuned").pool, sa.pool.QueuePool)
+    with get_engine("tuned").connect() as connection:
+        pragma = connection.exec_driver_sql
+        assert pragma("PRAGMA journal_mode").scalar() == "wal"
+        assert pragma("PRAGMA synchronous").scalar() == 1
+        assert pragma("PRAGMA cache_size").scalar() == -2000
+        assert pragma("PRAGMA busy_timeout").scalar() == 100
+    configure_engine("tuned", uri="sqlite://")
+    with pytest.raises(ValueError):
+        get_sqlite_pragmas("foo")
+    with pytest.raises(TypeError):
+        get_sqlite_pragmas(pragmas={"foo": 1})
+    with pytest.raises(ValueError):
+        get_sqlite_pragmas(pragmas={"cache_size": "1; DROP TABLE foo"})
+
+
+def test_replica_routing(tmpdir):
+    from tedega_storage.rdbms.engine import configure_engine
+    names = ["primary", "replica1", "replica2"]
+    for name in names:
+        configure_engine(name, "sqlite:///{}".format(
+            tmpdir.join("{}.db".format(name))))
+        init_storage(name)
+        # Different content per database to see where a read goes to.
+        with scoped_session(name) as session:
+            session.add(DummyModel(id=1, dummy_string=name))
+    configure_engine("primary", "sqlite:///{}".format(
+        tmpdir.join("primary.db")), replicas=["replica1", "replica2"])
+
+    read = []
+    for _ in range(3):
+        with get_storage("primary") as storage:
+            read.append(storage.read(DummyModel, 1).dummy_string)
+    assert read == ["replica1", "replica2", "replica1"]
+
+    with get_storage("primary") as storage:
+        new = DummyModel(dummy_string="new")
+        new_id = storage.create(new)
+        # Read after write within the same storage uses the primary.
+        assert storage.read(DummyModel, 1).dummy_string == "primary"
+        assert storage.read(DummyModel, new_id) is new
+    with get_storage("primary") as storage:
+        storage.session.use_primary = True
+        assert storage.read(DummyModel, new_id).dummy_string == "new"
+
+    configure_engine("primary", "sqlite:///{}".format(
+        tmpdir.join("primary.db")), replicas=["replica1", "replica2"],
+        replica_strategy="least_connections")
+    with get_storage("primary") as storage:
+        assert storage.read(DummyModel, 1).dummy_string == "replica1"
+    with get_engine("replica1").connect():
+        for _ in range(2):
+            with get_storage("primary") as storage:
+                assert storage.read(DummyModel, 1).dummy_string == "replica2"
+    with get_storage("primary") as storage:
+        assert storage.read(DummyModel, 1).dummy_string == "replica1"
+    for name in names:
+        configure_engine(name, uri="sqlite://")
+
+
+class RoutedItem(BaseItem, RDBMSStorageBase):
+    __tablename__ = "routeditems"
+    name = sa.Column("name", sa.String)
+
+
+def test_replica_routing_writes(tmpdir):
+    from tedega_storage.rdbms.crud import delete, search, update
+    from tedega_storage.rdbms.engine import configure_engine
+    names = ["primary", "replica"]
+    for name in names:
+        configure_engine(name, "sqlite:///{}".format(
+            tmpdir.join("{}.db".format(name))))
+        init_storage(name)
+        with scoped_session(name) as session:
+            # The replica lags behind the primary.
+            item = RoutedItem()
+            item.name = "b" if name == "primary" else "a"
+            session.add(item)
+    configure_engine("primary", "sqlite:///{}".format(
+        tmpdir.join("primary.db")), replicas=["replica"])
+    with get_storage("primary") as storage:
+        item = search(storage, RoutedItem)[0]
+        assert item.name == "a"
+        item_id = item.id
+        item, changed = update(storage, RoutedItem, item_id, {"name": "a"},
+                               return_changes=True)
+        assert changed == ["name"]
+    with get_storage("primary") as storage:
+        storage.use_primary()
+        assert storage.read(RoutedItem, item_id).name == "a"
+        delete(storage, RoutedItem, item_id)
+    for name in names:
+        configure_engine(name, uri="sqlite://")